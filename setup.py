@@ -57,12 +57,17 @@ setup(
 
     keywords='gul vidmaster gultalks video edition composition automated',
 
-    packages=find_packages(),
+    packages=find_packages(exclude=['tests']),
 
     install_requires=[
         'moviepy == 0.2.2.11'
     ],
 
+    extras_require={
+        # Faster resizes, see vidmaster.kernels
+        'opencv': ['opencv-python'],
+    },
+
     entry_points={
         'console_scripts': [
             'vidmaster = vidmaster.cli:main'
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 Rafael Medina García
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+from moviepy.video.compositing.CompositeVideoClip import CompositeVideoClip
+from moviepy.video.VideoClip import ColorClip, ImageClip, VideoClip
+from vidmaster.compositor import Compositor, composite
+
+import numpy as np
+
+SIZE = (64, 48)
+
+
+def layers():
+    """ Return the clips of a composition with moving layers. """
+    noise = np.random.RandomState(0).randint(0, 256, (48, 64, 3))
+    background = ImageClip(noise.astype('uint8'), duration=4)
+
+    # Moves right and stops at the middle, a second later
+    inset = ColorClip((16, 12), col=(255, 0, 0), duration=4)
+    inset = inset.set_position(lambda t: (int(10 * min(t, 3)), 5))
+
+    logo = np.zeros((10, 10, 4), dtype='uint8')
+    logo[:, :, 1] = 200
+    logo[:, :, 3] = np.arange(10) * 25
+    logo = ImageClip(logo, duration=2).set_start(1).set_position((40, 30))
+
+    return [background, inset, logo]
+
+def test_frames_match_moviepy():
+    """ Frames are the ones MoviePy composes, whatever the order. """
+    clips = layers()
+    expected = CompositeVideoClip(clips, size=SIZE)
+    result = composite(clips, SIZE)
+
+    for t in [0, 0.5, 1, 1.5, 2.5, 3.5, 3.9, 0, 3, 1.2]:
+        assert np.array_equal(result.get_frame(t), expected.get_frame(t))
+
+def test_dirty_rectangles():
+    """ Only the rectangles the layers drew are restored. """
+    clips = layers()
+    compositor = Compositor(np.zeros((48, 64, 3), dtype='uint8'), clips[1:])
+
+    compositor.make_frame(0)
+    assert compositor.drawn == [[(0, 5, 16, 17)], []]
+
+    compositor.make_frame(1.5)
+    assert compositor.drawn == [[(0, 5, 16, 17)],
+            [(15, 5, 31, 17), (40, 30, 50, 40)]]
+
+    # The inset left the first rectangle, so it shows the background again
+    frame = compositor.make_frame(3.5)
+    assert compositor.drawn[0] == [(30, 5, 46, 17)]
+    assert not frame[5:17, 0:30].any()
+    assert (frame[5:17, 30:46] == [255, 0, 0]).all()
+
+def test_covered_layers_skipped():
+    """ Layers under an opaque one are not even computed. """
+    def broken(t):
+        raise Exception("Covered layer computed")
+
+    hidden = VideoClip(lambda t: np.zeros((8, 8, 3)), duration=2)
+    hidden = hidden.set_position((10, 10))
+    hidden.make_frame = broken
+    cover = ColorClip((20, 20), col=(0, 0, 255), duration=2)
+    cover = cover.set_position((5, 5))
+
+    compositor = Compositor(np.zeros((48, 64, 3), dtype='uint8'),
+            [hidden, cover])
+    frame = compositor.make_frame(1)
+
+    assert [layer[0] for layer in compositor.visible(1)] == [cover]
+    assert (frame[5:25, 5:25] == [0, 0, 255]).all()
+    assert not frame[25:].any()
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 Rafael Medina García
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+from vidmaster.distributed import LEASE, MAX_ATTEMPTS, WorkQueue
+
+import os
+import pytest
+import time
+
+
+@pytest.fixture
+def queue(tmp_path):
+    """ Return a queue with two published jobs. """
+    queue = WorkQueue(str(tmp_path / 'queue'))
+    queue.publish({'id': 'job2'})
+    queue.publish({'id': 'job1'})
+
+    return queue
+
+def age(queue, job_id, worker, seconds):
+    """ Make the lease of a claimed job older. """
+    path = queue.path('claimed', '%s@%s' % (job_id, worker))
+    then = time.time() - seconds
+
+    os.utime(path, (then, then))
+
+def test_claim(queue):
+    """ Each job is claimed once, oldest first. """
+    assert queue.claim('w1')['id'] == 'job1'
+    assert queue.claim('w2')['id'] == 'job2'
+    assert queue.claim('w1') is None
+
+    assert queue.state('job1') == ('claimed', None)
+    assert sorted(os.listdir(queue.path('claimed', ''))) == ['job1@w1',
+            'job2@w2']
+
+def test_expire(queue):
+    """ Jobs whose lease is not renewed are given back. """
+    job = queue.claim('w1')
+    age(queue, 'job1', 'w1', LEASE + 1)
+
+    assert queue.expire() == 1
+    assert queue.expire() == 0
+    assert not queue.renew(job, 'w1')
+
+    state, job = queue.state('job1')
+    assert state == 'pending'
+    assert job['attempts'] == 1
+    assert job['error'] == "Lease of worker w1 expired"
+
+def test_renew(queue):
+    """ Renewed leases do not expire. """
+    job = queue.claim('w1')
+    age(queue, 'job1', 'w1', LEASE + 1)
+
+    assert queue.renew(job, 'w1')
+    assert queue.expire() == 0
+
+def test_complete(queue, tmp_path):
+    """ Completed jobs move their files into place. """
+    job = queue.claim('w1')
+    tmp = tmp_path / 'part.mp4'
+    tmp.write_text('frames')
+    out = tmp_path / 'out.mp4'
+
+    assert queue.complete(job, 'w1', {str(tmp): str(out)})
+    assert out.read_text() == 'frames'
+    assert not tmp.exists()
+    assert queue.state('job1')[0] == 'done'
+    assert os.listdir(queue.path('work', '')) == []
+
+def test_complete_lost(queue, tmp_path):
+    """ Files of a job whose lease was lost are not moved. """
+    job = queue.claim('w1')
+    age(queue, 'job1', 'w1', LEASE + 1)
+    queue.expire()
+
+    tmp = tmp_path / 'part.mp4'
+    tmp.write_text('frames')
+    out = tmp_path / 'out.mp4'
+
+    assert not queue.complete(job, 'w1', {str(tmp): str(out)})
+    assert tmp.exists()
+    assert not out.exists()
+    assert queue.state('job1')[0] == 'pending'
+
+def test_complete_error(queue, tmp_path):
+    """ Jobs whose files cannot be moved stay claimed. """
+    job = queue.claim('w1')
+    tmp = tmp_path / 'part.mp4'
+    tmp.write_text('frames')
+
+    with pytest.raises(Exception):
+        queue.complete(job, 'w1', {str(tmp): str(tmp_path / 'no' / 'out')})
+
+    assert queue.state('job1') == ('claimed', None)
+    assert queue.renew(job, 'w1')
+
+def test_fail(queue):
+    """ Jobs are tried up to MAX_ATTEMPTS times. """
+    for attempt in range(MAX_ATTEMPTS):
+        job = queue.claim('w1')
+        assert job['id'] == 'job1'
+
+        queue.fail(job, 'w1', "Broken")
+
+    state, job = queue.state('job1')
+    assert state == 'failed'
+    assert job['attempts'] == MAX_ATTEMPTS
+    assert job['error'] == "Broken"
+    assert queue.claim('w1')['id'] == 'job2'
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 Rafael Medina García
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+from vidmaster.parser import OpDefine, OpExport, OpSubclip, PARSER_VERSION
+from vidmaster.parser import load_script, parse_stream
+
+import json
+import os
+import pytest
+
+SCRIPT = """#do define
+name = a
+type = video
+source = /media/a.mp4
+hasaudio = 1
+#end
+
+// Comments are skipped
+#do subclip
+clip = a
+start = 00:01:02
+out = b
+#end
+
+#do export
+clip = b
+out = /media/b.mp4
+fps = 25
+codec = libx264
+#end
+"""
+
+
+def test_parse_stream():
+    """ Blocks are parsed in order with the line they start at. """
+    ops = list(parse_stream(SCRIPT.splitlines(True)))
+
+    assert [type(op) for op in ops] == [OpDefine, OpSubclip, OpExport]
+    assert [op.lineno for op in ops] == [1, 9, 15]
+    assert ops[0].hasaudio is True
+    assert ops[1].start == (0, 1, 2)
+    assert ops[1].end is None
+    assert ops[2].fps == 25
+
+def test_parse_error():
+    """ The first error is raised with the script and line. """
+    text = SCRIPT.replace("fps = 25\n", "")
+
+    with pytest.raises(Exception) as info:
+        list(parse_stream(text.splitlines(True), 'talk.txt'))
+
+    assert str(info.value) == "talk.txt:15: Missing parameter 'fps'"
+
+def test_parse_errors_collected():
+    """ Every error is collected and the rest of blocks are parsed. """
+    text = (SCRIPT.replace("hasaudio = 1", "hasaudio = yes")
+            + "\n#do resize\nclip = b\nout = c\n")
+    errors = []
+
+    ops = list(parse_stream(text.splitlines(True), errors=errors))
+
+    assert [type(op) for op in ops] == [OpSubclip, OpExport]
+    assert errors == [(1, "Invalid boolean value", ['a']),
+            (22, "Block is not closed with #end", ['c'])]
+
+def test_op_cache(tmp_path):
+    """ Compiled operations are reused until the script changes. """
+    script = tmp_path / 'talk.txt'
+    script.write_text(SCRIPT)
+    compiled = tmp_path / '.talk.txt.ops'
+
+    ops = load_script(str(script), cache=True)
+    stamp, saved = json.loads(compiled.read_text())
+
+    assert stamp[0] == PARSER_VERSION
+    assert [op.lineno for op in ops] == [1, 9, 15]
+
+    # A valid stamp means the compiled file is trusted
+    saved[2]['vars']['fps'] = 50
+    compiled.write_text(json.dumps([stamp, saved]))
+
+    ops = load_script(str(script), cache=True)
+    assert ops[2].fps == 50
+    assert ops[1].start == (0, 1, 2)
+
+    # As long as it comes from this version of the parser
+    compiled.write_text(json.dumps([[PARSER_VERSION - 1] + stamp[1:], saved]))
+    assert load_script(str(script), cache=True)[2].fps == 25
+
+    compiled.write_text(json.dumps([stamp, saved]))
+    script.write_text(SCRIPT.replace("fps = 25", "fps = 30"))
+    assert load_script(str(script), cache=True)[2].fps == 30
+
+def test_op_cache_disabled(tmp_path):
+    """ Nothing is written unless the cache is enabled. """
+    script = tmp_path / 'talk.txt'
+    script.write_text(SCRIPT)
+
+    assert len(load_script(str(script))) == 3
+    assert os.listdir(str(tmp_path)) == ['talk.txt']
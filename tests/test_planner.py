@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 Rafael Medina García
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+from vidmaster.parser import parse_stream
+from vidmaster.planner import Graph
+
+import pytest
+
+SCRIPT = """#do define
+name = a
+type = video
+source = /media/a.mp4
+#end
+
+#do define
+name = unused
+type = video
+source = /media/unused.mp4
+#end
+
+#do subclip
+clip = a
+start = 00:00:02
+out = b
+#end
+
+#do resize
+clip = b
+height = 360
+out = b
+#end
+
+#do export
+clip = b
+out = /media/b.mp4
+fps = 25
+codec = libx264
+#end
+
+#do export
+clip = b
+out = /media/b.webm
+fps = 25
+codec = libvpx
+#end
+
+#do export
+clip = b
+out = /media/b30.mp4
+fps = 30
+codec = libx264
+#end
+
+#do export
+clip = a
+out = /media/a.mp4
+fps = 25
+codec = libx264
+segments = 2
+#end
+
+#do resize
+clip = ghost
+height = 360
+out = ghost
+#end
+"""
+
+
+def graph(text=SCRIPT):
+    """ Return the graph of a script. """
+    return Graph(list(parse_stream(text.splitlines(True))))
+
+def test_names_resolve_to_last_writer():
+    """ Each read is bound to the last operation that wrote the name. """
+    g = graph()
+
+    assert g.inputs[3] == [2]
+    assert g.inputs[4] == [3]
+    assert g.consumers[0] == [2, 7]
+    assert g.missing == [(8, 'ghost')]
+
+def test_prune():
+    """ Only the operations the roots depend on are kept. """
+    g = graph()
+
+    assert g.prune() == [0, 2, 3, 4, 5, 6, 7]
+    assert g.prune([4]) == [0, 2, 3, 4]
+    assert g.prune([4], stop=[3]) == [3, 4]
+
+def test_prune_missing():
+    """ Undefined clips are an error only when they are needed. """
+    g = graph()
+
+    with pytest.raises(Exception) as info:
+        g.prune([8])
+
+    assert "'ghost'" in str(info.value)
+    assert "line 54" in str(info.value)
+
+def test_last_uses():
+    """ Clips are needed until the last operation built on them. """
+    g = graph()
+
+    assert g.last_uses([0, 2, 3, 4]) == {0: 4, 2: 4, 3: 4, 4: 4}
+    assert g.last_uses([0, 2, 3, 4, 7]) == {0: 7, 2: 4, 3: 4, 4: 4, 7: 7}
+    assert g.last_uses([0, 7]) == {0: 7, 7: 7}
+
+def test_renditions():
+    """ Exports of the same clip and fps are written together. """
+    g = graph()
+
+    assert g.renditions(g.prune()) == {4: [4, 5], 5: [], 6: [6], 7: [7]}
+    assert g.renditions([0, 2, 3, 5, 6]) == {5: [5], 6: [6]}
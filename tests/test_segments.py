@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 Rafael Medina García
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+from vidmaster.segments import KEYFRAME_INTERVAL, split_timeline
+
+import pytest
+
+
+def test_split_on_keyframe_interval():
+    """ Boundaries fall on multiples of the keyframe interval. """
+    assert split_timeline(10, 25, 3) == [(0.0, 4.0), (4.0, 8.0),
+            (8.0, 10.0)]
+    assert split_timeline(10, 25, 1) == [(0.0, 10.0)]
+
+def test_split_short():
+    """ Segments shorter than the interval are still aligned to frames. """
+    assert split_timeline(1, 25, 4) == [(0.0, 0.28), (0.28, 0.56),
+            (0.56, 0.84), (0.84, 1.0)]
+    assert split_timeline(0.1, 25, 8) == [(0.0, 0.04), (0.04, 0.08)]
+
+@pytest.mark.parametrize('duration, fps, count', [(10, 25, 4), (61.3, 24, 7),
+    (3600, 30, 16), (7, 30000.0 / 1001, 3)])
+def test_split_covers_timeline(duration, fps, count):
+    """ Segments are consecutive and cover every frame of the clip. """
+    bounds = split_timeline(duration, fps, count)
+    frames = [(int(round(a * fps)), int(round(b * fps))) for a, b in bounds]
+
+    assert 0 < len(bounds) <= count
+    assert frames[0][0] == 0
+    assert frames[-1][1] == int(duration * fps)
+
+    for (a, b), (c, d) in zip(frames[:-1], frames[1:]):
+        assert b == c
+        assert b % int(KEYFRAME_INTERVAL * fps) == 0
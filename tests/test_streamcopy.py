@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 Rafael Medina García
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+from vidmaster.ffmpeg import run_ffmpeg
+from vidmaster.parser import OpDefine, OpExport, OpMix, OpSubclip
+from vidmaster.planner import Graph
+from vidmaster.streamcopy import _cut, _snap, copy_export, find_pieces
+
+import os
+import pytest
+
+# Frame rate of the generated video, one keyframe every two seconds
+FPS = 24
+DURATION = 10
+
+
+@pytest.fixture(scope='module')
+def video(tmp_path_factory):
+    """ Generate the video the tests cut with FFMPEG.
+
+        Its frames are stored out of order (with B-frames), so cuts that
+        end between keyframes cannot be copied exactly.
+    """
+    path = os.path.join(str(tmp_path_factory.mktemp('media')), 'video.mp4')
+
+    try:
+        run_ffmpeg(['-f', 'lavfi', '-i', 'testsrc=size=160x120:rate=%d:'
+            'duration=%d' % (FPS, DURATION), '-c:v', 'libx264', '-preset',
+            'ultrafast', '-pix_fmt', 'yuv420p', '-x264-params',
+            'keyint=%d:min-keyint=%d:scenecut=0:bframes=3:b-adapt=0'
+            % (2 * FPS, 2 * FPS), path])
+
+    except Exception as e:
+        pytest.skip("Cannot generate media: %s" % e)
+
+    return path
+
+def frames(path):
+    """ Return the checksums of the decoded frames of a video. """
+    out = run_ffmpeg(['-i', path, '-map', '0:v:0', '-f', 'framemd5', '-'])
+
+    return [line.split(',')[-1].strip() for line in
+            out.decode('utf-8').splitlines() if not line.startswith('#')]
+
+def export(source, start, out):
+    """ Return the operations of a script cutting two pieces of a video. """
+    return [OpDefine(name='a', type='video', source=source),
+            OpSubclip(clip='a', start=start, end=(0, 0, 4), out='b'),
+            OpSubclip(clip='a', start=(0, 0, 6), out='c'),
+            OpMix(type='concatenate', clips='b c', out='d'),
+            OpExport(clip='d', out=out, fps=FPS, codec='libx264')]
+
+def test_cut():
+    """ Time ranges of the clip are mapped to ranges of the sources. """
+    pieces = [('a', 10.0, 14.0, True), ('b', 0.0, 6.0, True),
+            ('a', 20.0, 22.0, True)]
+
+    assert _cut(pieces, 0, None) == pieces
+    assert _cut(pieces, 2, 8) == [('a', 12.0, 14.0, True),
+            ('b', 0.0, 4.0, True)]
+    assert _cut(pieces, 4, 10) == [('b', 0.0, 6.0, True)]
+    assert _cut(pieces, 11, None) == [('a', 21.0, 22.0, True)]
+    assert _cut(pieces, 12, None) == []
+
+def test_snap():
+    """ Cuts only move to a keyframe closer than the tolerance. """
+    times = [0.0, 2.0, 4.0, 6.0]
+
+    assert _snap(times, 2.01, 0.04) == 2.0
+    assert _snap(times, 3.99, 0.04) == 4.0
+    assert _snap(times, 3.0, 0.04) is None
+    assert _snap(times, 6.5, 0.04) is None
+    assert _snap([], 1.0, 0.04) is None
+
+def test_find_pieces(video, tmp_path):
+    """ Cuts on keyframes can be copied, the rest cannot. """
+    out = str(tmp_path / 'out.mp4')
+    ops = export(video, (0, 0, 2), out)
+
+    assert find_pieces(Graph(ops), 4) == [(video, 2.0, 4.0, False),
+            (video, 6.0, float(DURATION), False)]
+
+    ops[1].start = (0, 0, 3)
+    assert find_pieces(Graph(ops), 4) is None
+
+    ops[1].start = (0, 0, 2)
+    ops[4].streamcopy = False
+    assert find_pieces(Graph(ops), 4) is None
+
+def test_copy_export(video, tmp_path):
+    """ Copies hold exactly the frames of the pieces. """
+    op = OpExport(clip='d', out=str(tmp_path / 'out.mp4'), fps=FPS,
+            codec='libx264')
+
+    assert copy_export([(video, 2.0, 4.0, False),
+        (video, 6.0, float(DURATION), False)], op)
+
+    source = frames(video)
+    assert frames(op.out) == source[2 * FPS:4 * FPS] + source[6 * FPS:]
+
+def test_copy_export_inexact(video, tmp_path):
+    """ Cuts that end between keyframes are left to be rendered. """
+    op = OpExport(clip='d', out=str(tmp_path / 'out.mp4'), fps=FPS,
+            codec='libx264')
+
+    assert not copy_export([(video, 2.0, 3.0, False)], op)
+    assert not copy_export([(video, 0.0, 2.0, False),
+        (video, 2.0, 3.0, False)], op)
+    assert os.listdir(str(tmp_path)) == []
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 Rafael Medina García
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+from imageio import imread
+
+import collections
+import hashlib
+import numpy as np
+import os
+import threading
+
+# Default maximum size in bytes of the images decoded in memory
+DEFAULT_SIZE = 512 * 1024 ** 2
+
+# Cache used by load_image(), see install_cache()
+_cache = None
+
+
+class ImageCache(object):
+    """ Decoded images shared by every clip defined from them.
+
+        Images are keyed by their path and are valid while the size and
+        modification time of the file do not change. They are handed out
+        as read-only (RGB, mask) arrays, the mask being None for opaque
+        images, so every clip can share them. The least recently used
+        images are dropped when the decoded images exceed the size of the
+        cache (clips still using them keep them alive).
+
+        If a directory is given, images are decoded once into raw files
+        there and memory mapped, so the processes using the directory
+        (workers, other scripts...) share the same pages of memory.
+        Mapped images do not count towards the size of the cache.
+    """
+
+    def __init__(self, max_size=DEFAULT_SIZE, directory=None):
+        """ Create a cache.
+
+            max_size  - maximum size of the decoded images in bytes
+            directory - optional directory to keep the raw images in
+        """
+        self.max_size = max_size
+        self.directory = directory
+        self.size = 0
+
+        # (stamp, img, mask, size) by absolute path, least recently used
+        # first
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def get(self, path):
+        """ Return the (RGB, mask) arrays of an image file. """
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        stamp = (st.st_size, st.st_mtime)
+
+        with self.lock:
+            entry = self.entries.pop(path, None)
+
+            if entry is None or entry[0] != stamp:
+                if entry is not None:
+                    self.size -= entry[3]
+
+                entry = self._load(path, stamp)
+                self.size += entry[3]
+
+            self.entries[path] = entry
+            self._evict()
+
+        return entry[1], entry[2]
+
+    def clear(self):
+        """ Drop every image. """
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def _evict(self):
+        """ Drop the least recently used images until the cache fits. """
+        for path in list(self.entries)[:-1]:
+            if self.size <= self.max_size:
+                break
+
+            self.size -= self.entries.pop(path)[3]
+
+    def _load(self, path, stamp):
+        """ Decode an image, or map its raw files, into a new entry. """
+        if self.directory:
+            prefix = os.path.join(self.directory,
+                    hashlib.sha1(path.encode('utf-8')).hexdigest())
+            name = '%s.%d.%d' % (prefix, stamp[0], stamp[1] * 1000)
+
+            if not os.path.isfile(name + '.rgb.npy'):
+                img, mask = decode(path)
+                _save_raw(prefix, name, img, mask)
+
+            img = np.load(name + '.rgb.npy', mmap_mode='r')
+            mask = None
+
+            if os.path.isfile(name + '.mask.npy'):
+                mask = np.load(name + '.mask.npy', mmap_mode='r')
+
+            return (stamp, img, mask, 0)
+
+        img, mask = decode(path)
+        size = img.nbytes
+
+        img.setflags(write=False)
+
+        if mask is not None:
+            mask.setflags(write=False)
+            size += mask.nbytes
+
+        return (stamp, img, mask, size)
+
+
+def decode(path):
+    """ Decode an image file into RGB and mask arrays.
+
+        The alpha channel, if any, becomes a mask with values between 0
+        and 1, as MoviePy does for transparent images.
+    """
+    img = imread(path)
+    mask = None
+
+    if img.ndim == 3 and img.shape[2] == 4:
+        mask = 1.0 * img[:, :, 3] / 255
+        img = np.ascontiguousarray(img[:, :, :3])
+
+    return img, mask
+
+def install_cache(cache):
+    """ Use a cache for the images of every clip defined in the process.
+
+        cache - ImageCache to use
+    """
+    global _cache
+    _cache = cache
+
+def load_image(path):
+    """ Return the shared (RGB, mask) arrays of an image file. """
+    if _cache is None:
+        install_cache(ImageCache())
+
+    return _cache.get(path)
+
+def _save_raw(prefix, name, img, mask):
+    """ Write the raw files of an image, removing older versions. """
+    directory = os.path.dirname(prefix)
+    base = os.path.basename(prefix) + '.'
+
+    for old in os.listdir(directory):
+        if old.startswith(base) and not old.startswith(
+                os.path.basename(name) + '.'):
+            try:
+                os.remove(os.path.join(directory, old))
+
+            except OSError:
+                pass
+
+    # Written under a temporary name, as other processes may map them
+    suffix = '.%d.npy' % os.getpid()
+    arrays = [('.rgb', img)] + ([('.mask', mask)] if mask is not None else [])
+
+    # The mask goes first, the RGB file marks the image as complete
+    for kind, array in reversed(arrays):
+        np.save(name + kind + suffix, array)
+        os.rename(name + kind + suffix, name + kind + '.npy')
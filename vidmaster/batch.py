@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 Rafael Medina García
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+from vidmaster.assets import load_image
+from vidmaster.cache import ClipCache
+from vidmaster.parser import OpDefine, OpExport
+
+import json
+import multiprocessing
+import os
+import time
+import traceback
+
+try:
+    from queue import Empty
+except ImportError:
+    from Queue import Empty
+
+
+def read_manifest(path):
+    """ Return the script paths listed in a manifest file.
+
+        The manifest has a script per line, relative to the directory of
+        the manifest. Empty lines and lines starting with '//' are ignored.
+    """
+    base = os.path.dirname(os.path.abspath(path))
+    scripts = []
+
+    with open(path, 'r') as f:
+        for line in f.read().splitlines():
+            line = line.strip()
+
+            if not line or line.startswith('//'):
+                continue
+
+            scripts.append(os.path.join(base, line))
+
+    return scripts
+
+def preload_assets(scripts):
+    """ Decode the images used by more than one script.
+
+        scripts - list of script paths
+
+        Returns the list of paths loaded. Scripts that cannot be parsed are
+        ignored here, their job will report the error.
+    """
+    from vidmaster.workbench import start_workbench
+
+    uses = {}
+
+    for script in scripts:
+        try:
+            ops = start_workbench(script).ops
+
+        except Exception:
+            continue
+
+        sources = set(os.path.abspath(op.source) for op in ops
+                if type(op) == OpDefine and op.type == 'image')
+
+        for source in sources:
+            uses[source] = uses.get(source, 0) + 1
+
+    shared = sorted(s for s, n in uses.items() if n > 1)
+
+    for source in shared:
+        load_image(source)
+
+    return shared
+
+def run_batch(scripts, jobs=None, summary=None, cache_dir=None,
+        cache_size=None, backend='moviepy', draft=None, op_cache=False):
+    """ Render several scripts with a pool of worker processes.
+
+        scripts    - list of script paths
+        jobs       - maximum number of scripts rendered at once, defaults
+            to the number of CPUs
+        summary    - optional path of a JSON file to write the results to
+        cache_dir  - directory of the clip cache, None to disable it
+        cache_size - maximum size of the clip cache in bytes
+        backend    - backend used to render the exports
+        draft      - optional scale factor to render previews instead
+        op_cache   - whether to reuse the parsed operations of scripts
+
+        Images shared by several scripts are decoded once, before forking
+        the workers. Each script is rendered by its own process, so a
+        failure (or crash) only affects that script. Returns the list of
+        results, one dict per script in the same order.
+    """
+    jobs = jobs or multiprocessing.cpu_count()
+    options = {'cache_dir': cache_dir, 'cache_size': cache_size,
+            'backend': backend, 'draft': draft, 'op_cache': op_cache}
+
+    shared = preload_assets(scripts)
+    if shared:
+        print("Preloaded %d shared images" % len(shared))
+
+    queue = multiprocessing.Queue()
+    results = [None] * len(scripts)
+    pending = list(range(len(scripts)))
+    running = {}
+
+    while pending or running:
+        while pending and len(running) < jobs:
+            index = pending.pop(0)
+
+            proc = multiprocessing.Process(target=_run_job,
+                    args=(index, scripts[index], options, queue))
+            proc.start()
+
+            running[index] = (proc, time.time())
+
+        try:
+            index, result = queue.get(timeout=0.5)
+
+            running.pop(index)[0].join()
+            _finish(results, index, result)
+
+        except Empty:
+            pass
+
+        # Processes that died without reporting
+        for index, (proc, started) in list(running.items()):
+            if not proc.is_alive() and proc.exitcode != 0:
+                del running[index]
+                _finish(results, index, {
+                    'script': scripts[index],
+                    'status': 'failed',
+                    'error': "Process exited with code %d" % proc.exitcode,
+                    'elapsed': time.time() - started,
+                })
+
+    if summary:
+        with open(summary, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    failed = len([r for r in results if r['status'] != 'ok'])
+    print("%d scripts rendered, %d failed" % (len(results) - failed, failed))
+
+    return results
+
+def _finish(results, index, result):
+    """ Store and print the result of a job. """
+    results[index] = result
+
+    print("[%s] %s (%.1fs)%s" % (result['status'], result['script'],
+        result['elapsed'],
+        ": " + result['error'] if result.get('error') else ''))
+
+def _run_job(index, script, options, queue):
+    """ Render a script in a worker process and report the result. """
+    from vidmaster.workbench import start_workbench
+
+    started = time.time()
+    result = {'script': script, 'status': 'ok', 'error': None}
+
+    try:
+        workbench = start_workbench(script, options['draft'],
+                options['op_cache'])
+        workbench.backend = options['backend']
+
+        if options['cache_dir']:
+            workbench.cache = ClipCache(options['cache_dir'],
+                    options['cache_size'])
+
+        workbench.build()
+        result['exports'] = [op.out for op in workbench.ops
+                if type(op) == OpExport]
+
+    except Exception as e:
+        result['status'] = 'failed'
+        result['error'] = str(e)
+        result['traceback'] = traceback.format_exc()
+
+    result['elapsed'] = time.time() - started
+    queue.put((index, result))
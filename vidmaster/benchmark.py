@@ -0,0 +1,549 @@
+# -*- coding: utf-8 -*-
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 Rafael Medina García
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+""" Benchmarks of the parser, the clip operations and whole exports.
+
+    Every source is generated locally with FFMPEG, so results only depend
+    on the machine and the versions of the libraries. Run with:
+
+        python -m vidmaster.benchmark [--output results.json]
+            [--baseline baseline.json] [--threshold 0.2]
+"""
+
+from moviepy.config import get_setting
+from moviepy.video.VideoClip import ImageClip
+import moviepy.video.fx.all as vfx
+import moviepy.video.fx.resize
+from vidmaster.clip_builder import define_image, define_video
+from vidmaster.clip_builder import do_composite, do_concatenate, do_subclip
+from vidmaster.clip_builder import effect_margin, effect_position, effect_resize
+from vidmaster.compiler import compare as compare_backends, TOLERANCE
+from vidmaster.ffmpeg import run_ffmpeg
+from vidmaster.kernels import Resize, TOLERANCE as KERNEL_TOLERANCE, margin
+from vidmaster.parser import OpDefine, OpEffect, OpSubclip
+from vidmaster.planner import Graph
+from vidmaster.workbench import start_workbench
+
+import argparse
+import json
+import numpy as np
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+# Changing the benchmarks requires a new baseline
+BENCHMARK_VERSION = 1
+RESOLUTIONS = [('360p', 640, 360), ('720p', 1280, 720), ('1080p', 1920, 1080)]
+# Frames computed by each clip benchmark
+FRAMES = 50
+# Kinds of benchmarks that compute FRAMES frames of a clip
+CLIP_BENCHMARKS = ['decode', 'effect_resize', 'effect_margin', 'do_subclip',
+        'do_concatenate', 'do_composite']
+FPS = 25
+# Length in seconds of the generated videos
+DURATION = 6
+# Operations in the script parsed by the parser benchmark
+SCRIPT_BLOCKS = 5000
+
+
+def make_media(directory, resolutions=RESOLUTIONS):
+    """ Generate the sources used by the benchmarks.
+
+        directory   - directory to write the files to
+        resolutions - list of (label, width, height) tuples
+
+        Returns a dict of paths by name: 'video_<label>', 'color_<label>'
+        and 'noise_<label>' for each resolution, 'logo' (a transparent
+        image) and 'tone'.
+    """
+    media = {}
+
+    for label, w, h in resolutions:
+        size = '%dx%d' % (w, h)
+
+        path = os.path.join(directory, 'video_%s.mp4' % label)
+        run_ffmpeg(['-f', 'lavfi', '-i', 'testsrc=size=%s:rate=%d:duration=%d'
+            % (size, FPS, DURATION), '-c:v', 'libx264', '-preset',
+            'ultrafast', '-pix_fmt', 'yuv420p', path])
+        media['video_' + label] = path
+
+        path = os.path.join(directory, 'color_%s.png' % label)
+        run_ffmpeg(['-f', 'lavfi', '-i', 'color=c=0x336699:size=%s' % size,
+            '-frames:v', '1', path])
+        media['color_' + label] = path
+
+        path = os.path.join(directory, 'noise_%s.png' % label)
+        run_ffmpeg(['-f', 'lavfi', '-i', 'color=c=gray:size=%s' % size,
+            '-vf', 'noise=alls=100:allf=u', '-frames:v', '1', path])
+        media['noise_' + label] = path
+
+    path = os.path.join(directory, 'logo.png')
+    run_ffmpeg(['-f', 'lavfi', '-i', 'color=c=white:size=160x90', '-vf',
+        "format=rgba,geq=r='X':g='Y':b=128:a='255*X/W'", '-frames:v', '1',
+        path])
+    media['logo'] = path
+
+    path = os.path.join(directory, 'tone.mp3')
+    run_ffmpeg(['-f', 'lavfi', '-i', 'sine=frequency=440:duration=%d'
+        % DURATION, path])
+    media['tone'] = path
+
+    return media
+
+def benchmarks(media, directory, resolutions=RESOLUTIONS):
+    """ Return the list of (name, function) benchmarks.
+
+        media       - paths returned by make_media()
+        directory   - directory for scripts and exports
+        resolutions - list of (label, width, height) tuples
+
+        Each function performs one run and may be called several times.
+    """
+    result = [('parse/%d_blocks' % SCRIPT_BLOCKS,
+        lambda: _bench_parse(media, directory))]
+
+    for label, w, h in resolutions:
+        video = media['video_' + label]
+        color = media['color_' + label]
+        noise = media['noise_' + label]
+
+        result += [
+            ('decode/%s' % label,
+                lambda video=video: _frames(_video(video))),
+            ('effect_resize/%s' % label,
+                lambda video=video, h=h: _frames(effect_resize(_video(video),
+                    OpEffect(clip='v', type='resize', out='v',
+                        height=h // 2)))),
+            ('effect_margin/%s' % label,
+                lambda video=video: _frames(effect_margin(_video(video),
+                    OpEffect(clip='v', type='margin', out='v', size=20,
+                        red=255, green=255, blue=255)))),
+            ('do_subclip/%s' % label,
+                lambda video=video: _frames(do_subclip(_video(video),
+                    OpSubclip(clip='v', start=(0, 0, 2), end=(0, 0, 4),
+                        out='v')))),
+            ('do_concatenate/%s' % label,
+                lambda video=video: _frames(_concatenation(video))),
+            ('do_composite/%s' % label,
+                lambda video=video, color=color, noise=noise, w=w, h=h:
+                    _frames(_composition(video, color, noise, w, h))),
+            ('kernels/%s' % label,
+                lambda video=video, noise=noise, w=w, h=h:
+                    _bench_kernels(video, noise, w, h)),
+            ('compare/%s' % label,
+                lambda video=video, w=w, h=h, label=label:
+                    _bench_compare(video, media['logo'], w, h,
+                        os.path.join(directory, 'compare_%s' % label))),
+            ('build/%s' % label,
+                lambda video=video, color=color, w=w, h=h, label=label:
+                    _bench_build(video, color, media['tone'], w, h,
+                        os.path.join(directory, 'build_%s' % label))),
+        ]
+
+    return result
+
+def run(names=None, repeat=3, resolutions=RESOLUTIONS):
+    """ Generate the media and run the benchmarks.
+
+        names       - optional list of substrings, only benchmarks whose
+            name contains one of them are run
+        repeat      - number of runs of each benchmark
+        resolutions - list of (label, width, height) tuples
+
+        Returns a dict with the environment, the frames computed by each
+        kind of benchmark, the size of each resolution and, for each
+        benchmark, the best and median times of the runs in seconds (or
+        the error).
+    """
+    # Script values cannot contain dashes
+    directory = tempfile.mkdtemp(prefix='vidmaster_bench_')
+
+    try:
+        media = make_media(directory, resolutions)
+        results = {}
+
+        for name, function in benchmarks(media, directory, resolutions):
+            if names and not any(n in name for n in names):
+                continue
+
+            times = []
+
+            try:
+                for _ in range(repeat):
+                    start = time.time()
+                    function()
+                    times.append(time.time() - start)
+
+            except Exception as e:
+                results[name] = {'error': str(e)}
+                print("%-32s failed: %s" % (name, e))
+                continue
+
+            times.sort()
+            results[name] = {'best': times[0],
+                    'median': times[len(times) // 2], 'runs': times}
+
+            print("%-32s %9.3fs best %9.3fs median" % (name, times[0],
+                times[len(times) // 2]))
+
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    # Frames computed by each run, so that the results can calibrate the
+    # estimates of vidmaster.check
+    frames = dict((kind, FRAMES) for kind in CLIP_BENCHMARKS)
+    frames['build'] = DURATION * FPS
+
+    return {
+        'version': BENCHMARK_VERSION,
+        'environment': environment(),
+        'results': results,
+        'frames': frames,
+        'resolutions': dict((label, [w, h]) for label, w, h in resolutions),
+    }
+
+def compare(current, baseline, threshold=0.2):
+    """ Compare benchmark results against a baseline.
+
+        current   - results returned by run()
+        baseline  - results of a previous run()
+        threshold - relative slowdown considered a regression
+
+        Returns a list of (name, baseline seconds, current seconds) tuples
+        for the benchmarks that regressed. Best times are compared, as
+        they are the least affected by other load on the machine.
+    """
+    if baseline.get('version') != current.get('version'):
+        raise Exception("Baseline was made with a different benchmark "
+                "version")
+
+    regressions = []
+
+    for name, result in sorted(current['results'].items()):
+        base = baseline['results'].get(name)
+
+        if not base or 'best' not in base or 'best' not in result:
+            continue
+
+        if result['best'] > base['best'] * (1 + threshold):
+            regressions.append((name, base['best'], result['best']))
+
+    return regressions
+
+def environment():
+    """ Describe the software the benchmarks ran with. """
+    import moviepy
+    import numpy
+
+    proc = subprocess.Popen([get_setting('FFMPEG_BINARY'), '-version'],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    ffmpeg = proc.communicate()[0].decode('utf-8', 'replace')
+
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'moviepy': moviepy.__version__,
+        'numpy': numpy.__version__,
+        'ffmpeg': ffmpeg.splitlines()[0] if ffmpeg else None,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(prog='vidmaster.benchmark',
+            description='Benchmarks of vidmaster operations')
+    parser.add_argument('names', nargs='*',
+            help='only run benchmarks whose name contains one of these')
+    parser.add_argument('--output', help='write the results to a JSON file')
+    parser.add_argument('--baseline',
+            help='JSON results to compare against')
+    parser.add_argument('--threshold', type=float, default=0.2,
+            help='relative slowdown considered a regression (default 0.2)')
+    parser.add_argument('--repeat', type=int, default=3,
+            help='number of runs of each benchmark')
+    parser.add_argument('--quick', action='store_true',
+            help='only use the smallest resolution')
+
+    args = parser.parse_args()
+
+    results = run(args.names, args.repeat,
+            RESOLUTIONS[:1] if args.quick else RESOLUTIONS)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+
+        regressions = compare(results, baseline, args.threshold)
+
+        for name, before, after in regressions:
+            print("REGRESSION %-32s %9.3fs -> %9.3fs (%+.0f%%)" % (name,
+                before, after, 100.0 * (after / before - 1)))
+
+        if regressions:
+            sys.exit(1)
+
+def _bench_build(video, image, tone, w, h, directory):
+    """ Render a composition with a soundtrack through a script. """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    script = os.path.join(directory, 'script.txt')
+
+    with open(script, 'w') as f:
+        f.write(BUILD_SCRIPT % {'video': video, 'image': image, 'tone': tone,
+            'width': w, 'height': h, 'small': h // 2, 'x': w // 8,
+            'y': h // 8, 'out': os.path.join(directory, 'out.mp4')})
+
+    start_workbench(script).build()
+
+def _bench_compare(video, logo, w, h, directory):
+    """ Render a composition with a transparent logo with both backends.
+
+        Raises an exception if their frames differ more than the
+        tolerance, so a mismatch shows up as a failed benchmark.
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    script = os.path.join(directory, 'script.txt')
+
+    with open(script, 'w') as f:
+        f.write(COMPARE_SCRIPT % {'video': video, 'logo': logo, 'width': w,
+            'height': h, 'small': h * 3 // 4, 'x': w // 8, 'y': h // 8,
+            'out': os.path.join(directory, 'out.mp4')})
+
+    workbench = start_workbench(script)
+
+    for node in Graph(workbench.ops).exports():
+        for t, diff in compare_backends(workbench, node):
+            if diff > TOLERANCE:
+                raise Exception("Backends differ by %.2f at %.3fs" % (diff,
+                    t))
+
+def _bench_kernels(video, noise, w, h):
+    """ Resize frames and add margins with the kernels and with MoviePy.
+
+        Frames are resized to smaller, larger and mixed sizes with the
+        sampling tables, and compared when MoviePy resizes with OpenCV.
+        Raises an exception if they differ more than kernels.TOLERANCE
+        levels, or if margins differ at all, so a mismatch shows up as a
+        failed benchmark.
+    """
+    resizer = getattr(moviepy.video.fx.resize, 'resizer', None)
+    frames = [_video(video).get_frame(1.0), define_image(OpDefine(name='n',
+        type='image', source=noise, duration=DURATION)).get_frame(0)]
+    sizes = [(w // 2, h // 2), (w * 2 // 3, h * 2 // 3),
+            (w * 3 // 2, h * 3 // 2), (w * 5 // 4, h * 3 // 4)]
+
+    for frame in frames:
+        if resizer is not None and resizer.origin == 'cv2':
+            for size in sizes:
+                diff = np.abs(Resize(size, tables=True)(frame).astype(int)
+                        - resizer(frame, size)).max()
+
+                if diff > KERNEL_TOLERANCE:
+                    raise Exception("Resize to %dx%d differs by %d levels"
+                            % (size + (diff,)))
+
+        clip = ImageClip(frame)
+        diff = np.abs(margin(clip, 20, (255, 128, 0)).get_frame(0).astype(int)
+                - vfx.margin(clip, 20, color=(255, 128, 0)).get_frame(0)).max()
+
+        if diff:
+            raise Exception("Margin differs by %d levels" % diff)
+
+def _bench_parse(media, directory):
+    """ Parse a long script. """
+    script = os.path.join(directory, 'parse.txt')
+
+    if not os.path.isfile(script):
+        with open(script, 'w') as f:
+            for i in range(SCRIPT_BLOCKS // 2):
+                f.write(PARSE_BLOCKS % {'i': i,
+                    'video': media['video_' + RESOLUTIONS[0][0]]})
+
+    start_workbench(script)
+
+def _composition(video, color, noise, w, h):
+    """ Return a composition of a background, a video and an overlay. """
+    background = define_image(OpDefine(name='bg', type='image', source=color,
+        duration=DURATION))
+    overlay = define_image(OpDefine(name='ov', type='image', source=noise,
+        duration=DURATION))
+    overlay = effect_position(effect_resize(overlay, OpEffect(clip='ov',
+        type='resize', out='ov', height=h // 4)), OpEffect(clip='ov',
+        type='position', out='ov', x=0, y=0))
+
+    clip = effect_position(effect_resize(_video(video), OpEffect(clip='v',
+        type='resize', out='v', height=h // 2)), OpEffect(clip='v',
+        type='position', out='v', x=w // 8, y=h // 8))
+
+    return do_composite([background, clip, overlay], h, w)
+
+def _concatenation(video):
+    """ Return a concatenation of three pieces of a video. """
+    clip = _video(video)
+    pieces = [do_subclip(clip, OpSubclip(clip='v', start=(0, 0, s),
+        end=(0, 0, s + 1), out='v')) for s in (0, 2, 4)]
+
+    return do_concatenate(pieces)
+
+def _frames(clip):
+    """ Compute the first frames of a clip. """
+    for i in range(FRAMES):
+        clip.get_frame(float(i) / FPS)
+
+def _video(path):
+    """ Open a generated video without audio. """
+    return define_video(OpDefine(name='v', type='video', source=path))
+
+
+BUILD_SCRIPT = """#do define
+name = talk
+type = video
+source = %(video)s
+#end
+
+#do define
+name = bg
+type = image
+source = %(image)s
+duration_from = talk
+#end
+
+#do define
+name = tone
+type = audio
+source = %(tone)s
+#end
+
+#do resize
+clip = talk
+out = talk
+height = %(small)d
+#end
+
+#do position
+clip = talk
+out = talk
+x = %(x)d
+y = %(y)d
+#end
+
+#do composition
+clips = bg talk
+out = final
+width = %(width)d
+height = %(height)d
+#end
+
+#do setaudio
+clip = final
+audio = tone
+out = final
+#end
+
+#do export
+clip = final
+out = %(out)s
+fps = 25
+codec = libx264
+preset = ultrafast
+streamcopy = 0
+#end
+
+"""
+
+COMPARE_SCRIPT = """#do define
+name = talk
+type = video
+source = %(video)s
+#end
+
+#do define
+name = logo
+type = image
+source = %(logo)s
+duration_from = talk
+#end
+
+#do resize
+clip = logo
+out = logo
+height = %(small)d
+#end
+
+#do margin
+clip = logo
+out = logo
+size = 4
+red = 255
+#end
+
+#do position
+clip = logo
+out = logo
+x = %(x)d
+y = %(y)d
+#end
+
+#do composition
+clips = talk logo
+out = final
+width = %(width)d
+height = %(height)d
+#end
+
+#do export
+clip = final
+out = %(out)s
+fps = 25
+codec = libx264
+#end
+
+"""
+
+PARSE_BLOCKS = """#do define
+name = clip%(i)d
+type = video
+source = %(video)s
+hasaudio = 0
+#end
+
+#do resize
+clip = clip%(i)d
+out = clip%(i)d
+height = 360
+#end
+
+"""
+
+
+if __name__ == '__main__':
+    main()
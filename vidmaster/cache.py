@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 Rafael Medina García
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+from moviepy.video.io.VideoFileClip import VideoFileClip
+from moviepy.video.VideoClip import ImageClip
+from vidmaster.parser import OpDefine, OpEffect, OpMix
+
+import hashlib
+import json
+import os
+import time
+
+# Changing this invalidates every existing cache entry
+CACHE_VERSION = 2
+DEFAULT_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'vidmaster')
+DEFAULT_SIZE = 10 * 1024 ** 3
+# Parameters that only name clips, the clips themselves are hashed instead
+NAME_VARS = ['name', 'out', 'clip', 'clips', 'audio', 'duration_from']
+# Attributes that do not change the clip an operation produces
+IGNORED_VARS = NAME_VARS + ['lineno']
+
+
+class ClipCache(object):
+    """ Content addressed on-disk cache of intermediate clips.
+
+        Clips are stored as lossless PNG encoded AVI files along with an
+        index that keeps track of their size and last use. The least
+        recently used entries are removed when the cache exceeds its size.
+    """
+
+    def __init__(self, directory=DEFAULT_DIR, max_size=DEFAULT_SIZE):
+        """ Open (or create) a cache.
+
+            directory - directory to store the clips in
+            max_size  - maximum size of the stored clips in bytes
+        """
+        self.directory = directory
+        self.max_size = max_size
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self.index_path = os.path.join(directory, 'index.json')
+        self.index = {}
+
+        if os.path.isfile(self.index_path):
+            with open(self.index_path, 'r') as f:
+                self.index = json.load(f)
+
+        # Forget entries whose files were removed by hand
+        for key in list(self.index):
+            if not os.path.isfile(self._path(key)):
+                del self.index[key]
+
+    def fits(self, clip):
+        """ Check whether a clip can be stored without exceeding the size.
+
+            Stored frames are compressed losslessly, so their uncompressed
+            size is used as an upper bound, checked before writing them.
+        """
+        w, h = clip.size
+
+        return w * h * 3 * clip.duration * clip.fps <= self.max_size
+
+    def get(self, key):
+        """ Return the cached clip for the given key, or None.
+
+            Check whether there is a clip by getting it, as other processes
+            sharing the cache may remove it at any time. Once opened, the
+            clip stays readable.
+        """
+        entry = self.index.get(key)
+
+        if entry is None:
+            return None
+
+        path = self._path(key)
+        clip = None
+
+        if os.path.isfile(path):
+            try:
+                clip = VideoFileClip(path, audio=entry['audio'])
+
+            except (IOError, OSError):
+                # Removed right after checking it
+                pass
+
+        if clip is None:
+            # Evicted by another process
+            del self.index[key]
+            self._save()
+            return None
+
+        entry['used'] = time.time()
+        self._save()
+
+        if entry['pos'] is not None:
+            clip = clip.set_position(tuple(entry['pos']))
+
+        return clip
+
+    def put(self, key, clip):
+        """ Store a clip in the cache.
+
+            Returns the stored clip, read back from the cache file. Clips
+            that do not fit (see fits()) must not be stored.
+        """
+        path = self._path(key)
+        tmp = path + '.%d.avi' % os.getpid()
+
+        clip.write_videofile(tmp, fps=clip.fps, codec='png',
+                audio_codec='pcm_s16le', temp_audiofile=tmp + '.wav',
+                verbose=False)
+        os.rename(tmp, path)
+
+        pos = clip.pos(0)
+
+        self.index[key] = {
+            'size': os.path.getsize(path),
+            'used': time.time(),
+            'audio': clip.audio is not None,
+            'pos': list(pos) if isinstance(pos, (list, tuple)) else None,
+        }
+
+        self.evict(keep=key)
+
+        return self.get(key)
+
+    def evict(self, keep=None):
+        """ Remove least recently used clips until the cache fits.
+
+            keep - key of an entry that must not be removed
+        """
+        total = sum(e['size'] for e in self.index.values())
+
+        for key in sorted(self.index, key=lambda k: self.index[k]['used']):
+            if total <= self.max_size:
+                break
+
+            if key == keep:
+                continue
+
+            total -= self.index[key]['size']
+            del self.index[key]
+
+            try:
+                os.remove(self._path(key))
+
+            except OSError:
+                pass
+
+        self._save()
+
+    def _path(self, key):
+        """ Return the path of the file for a key. """
+        return os.path.join(self.directory, key + '.avi')
+
+    def _save(self):
+        """ Atomically write the index.
+
+            Entries added by other processes sharing the cache are kept.
+        """
+        if os.path.isfile(self.index_path):
+            with open(self.index_path, 'r') as f:
+                for key, entry in json.load(f).items():
+                    if key not in self.index and os.path.isfile(
+                            self._path(key)):
+                        self.index[key] = entry
+
+        tmp = self.index_path + '.%d' % os.getpid()
+
+        with open(tmp, 'w') as f:
+            json.dump(self.index, f)
+
+        os.rename(tmp, self.index_path)
+
+
+def can_store(clip):
+    """ Check whether a clip can be stored without losing information.
+
+        Masks are not kept in the cache files and static images are not
+        worth storing as video.
+    """
+    return (clip.mask is None and not isinstance(clip, ImageClip)
+            and clip.duration is not None
+            and getattr(clip, 'fps', None) is not None)
+
+def fingerprint(graph, node, memo):
+    """ Return the cache key of the clip produced by an operation.
+
+        graph - dependency graph of the workbench operations
+        node  - index of the operation
+        memo  - dict of already computed keys by node
+
+        The key covers the parameters of the operation and all the ones it
+        depends on, as well as the path, size and modification time of
+        the source files. Clip names are not part of the key.
+    """
+    if node in memo:
+        return memo[node]
+
+    op = graph.ops[node]
+    h = hashlib.sha1()
+
+    params = sorted((k, v) for k, v in vars(op).items()
+            if k not in IGNORED_VARS)
+
+    h.update(repr((CACHE_VERSION, type(op).__name__,
+        params)).encode('utf-8'))
+
+    if type(op) == OpDefine:
+        st = os.stat(op.source)
+        h.update(repr((os.path.abspath(op.source), st.st_size,
+            st.st_mtime)).encode('utf-8'))
+
+    for child in graph.inputs[node]:
+        h.update(fingerprint(graph, child, memo).encode('utf-8'))
+
+    memo[node] = h.hexdigest()
+
+    return memo[node]
+
+def is_expensive(op):
+    """ Check whether an operation is worth caching. """
+    if type(op) == OpEffect:
+        return op.type in ['margin', 'resize']
+
+    elif type(op) == OpMix:
+        return op.type == 'composition'
+
+    return False
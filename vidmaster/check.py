@@ -0,0 +1,358 @@
+# -*- coding: utf-8 -*-
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 Rafael Medina García
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+from vidmaster.draft import apply_draft
+from vidmaster.parser import OpDefine, OpEffect, OpExport, OpMix, OpSubclip
+from vidmaster.parser import get_seconds, parse_stream
+from vidmaster.planner import Graph, infer, op_output
+from vidmaster.probe import probe
+
+import json
+import math
+import os
+
+# Benchmarks used to calibrate the estimates, most complete first
+CALIBRATION = ['build', 'do_composite']
+ENGINES = ['moviepy', 'pipeline']
+# Kinds of clips that have frames
+VISUAL = ['video', 'image']
+
+
+def check_ops(ops, unparsed=()):
+    """ Look for mistakes in the operations of a script.
+
+        ops      - ordered list of operations, as parsed from the script
+        unparsed - names of the clips defined by blocks that could not be
+            parsed, which are not reported as undefined
+
+        No media is opened, only the existence of the sources is checked.
+        Returns a list of issues, dicts with the keys 'line' (None if
+        unknown), 'level' ('error' or 'warning') and 'message'. Scripts
+        with errors would fail to build.
+    """
+    graph = Graph(ops)
+    needed = _needed(graph)
+    issues = []
+
+    for node, name in graph.missing:
+        # Images without duration_from are reported below, and blocks that
+        # could not be parsed with their errors
+        if name is None or name in unparsed:
+            continue
+
+        issues.append(_issue(ops[node], 'error',
+            "clip '%s' is used before being defined" % name))
+
+    if not graph.exports():
+        issues.append(_issue(None, 'warning', "script has no exports"))
+
+    producers = {}
+    shadowed = set()
+    kinds = {}
+
+    for node, op in enumerate(ops):
+        if type(op) == OpDefine and not os.path.isfile(op.source):
+            # Only fails the build if an export needs it
+            issues.append(_issue(op, 'error' if node in needed else 'warning',
+                "source %s does not exist" % op.source))
+
+        if type(op) == OpExport and op.engine not in ENGINES:
+            # Unknown engines fall back to MoviePy
+            issues.append(_issue(op, 'warning',
+                "unknown engine '%s', MoviePy is used" % op.engine))
+
+        inputs = [kinds.get(i) for i in graph.inputs[node]]
+
+        for message in _type_errors(op, inputs):
+            issues.append(_issue(op, 'error', message))
+
+        kinds[node] = _kind(op, inputs)
+
+        out = op_output(op)
+        previous = producers.get(out)
+
+        if previous is not None and not graph.consumers[previous]:
+            issues.append(_issue(ops[previous], 'warning',
+                "clip '%s' is overwritten at line %s before being used" % (
+                    out, getattr(op, 'lineno', '?'))))
+            shadowed.add(previous)
+
+        if out:
+            producers[out] = node
+
+    for node, op in enumerate(ops):
+        if node not in needed and node not in shadowed:
+            issues.append(_issue(op, 'warning',
+                "result is not used by any export"))
+
+    issues.sort(key=lambda i: (i['line'] or 0))
+
+    return issues
+
+def check_script(script, calibration=None, draft=None):
+    """ Check a script and estimate the cost of rendering it.
+
+        script      - path to the script
+        calibration - optional calibration returned by load_calibration()
+        draft       - optional scale factor of a draft render
+
+        Returns a dict with the keys 'script', 'issues' (see check_ops())
+        and 'exports' (see estimate(), empty if there are errors).
+    """
+    report = {'script': script, 'issues': [], 'exports': []}
+
+    if not os.path.isfile(script):
+        report['issues'].append({'line': None, 'level': 'error',
+            'message': "Cannot access script"})
+        return report
+
+    # Every block that parses is checked, whatever the errors in the rest
+    errors = []
+    with open(script, 'r') as f:
+        ops = list(parse_stream(f, script, errors))
+
+    if draft:
+        apply_draft(ops, draft)
+
+    unparsed = set()
+    for line, message, names in errors:
+        report['issues'].append({'line': line, 'level': 'error',
+            'message': message})
+        unparsed.update(names)
+
+    report['issues'] += check_ops(ops, unparsed)
+    report['issues'].sort(key=lambda i: (i['line'] or 0))
+
+    if any(i['level'] == 'error' for i in report['issues']):
+        return report
+
+    try:
+        report['exports'] = estimate(ops, calibration)
+
+    except Exception as e:
+        report['issues'].append({'line': None, 'level': 'error',
+            'message': "Cannot read the metadata of the sources: %s" % e})
+
+    return report
+
+def estimate(ops, calibration=None):
+    """ Estimate the cost of the exports of a script.
+
+        ops         - ordered list of operations, without errors
+        calibration - optional calibration returned by load_calibration()
+
+        Only the metadata of the sources is probed. Returns a list of
+        dicts by export with the keys 'line', 'out', 'frames', 'size'
+        (width and height), 'composited' (average pixels blitted per
+        frame by the compositions) and 'seconds' (expected render time,
+        None without calibration).
+    """
+    graph = Graph(ops)
+    meta = infer(graph, graph.prune(), probe)
+    result = []
+
+    for node in graph.exports():
+        op = ops[node]
+        info = meta[node]
+
+        duration = info['duration'] or 0
+        frames = int(math.ceil(duration * op.fps))
+        w, h = info['size']
+
+        # Pixels blitted by the compositions, for the time they play
+        composited = 0.0
+        for i in graph.prune([node]):
+            if type(ops[i]) == OpMix and ops[i].type == 'composition':
+                composited += (_composited(meta, graph.inputs[i],
+                    meta[i]['size']) * (meta[i]['duration'] or 0))
+
+        result.append({
+            'line': getattr(op, 'lineno', None),
+            'out': op.out,
+            'frames': frames,
+            'size': [w, h],
+            'composited': int(composited / duration) if duration else 0,
+            'seconds': _seconds(calibration, frames, w * h),
+        })
+
+    return result
+
+def load_calibration(path):
+    """ Read the calibration of the estimates from benchmark results.
+
+        path - JSON results written by 'python -m vidmaster.benchmark'
+
+        Returns a list of (pixels, seconds per frame) tuples, one per
+        resolution, from the most complete benchmark that succeeded.
+        The estimates scale them to the frames and size of each export,
+        so they are only as accurate as the benchmark is similar to the
+        script.
+    """
+    with open(path, 'r') as f:
+        data = json.load(f)
+
+    # Recorded by the benchmarks along with the results
+    frames = data.get('frames', {})
+    sizes = data.get('resolutions', {})
+
+    for kind in CALIBRATION:
+        rates = []
+
+        for name, result in data['results'].items():
+            if (name.split('/')[0] != kind or kind not in frames
+                    or 'best' not in result):
+                continue
+
+            label = name.split('/', 1)[1]
+
+            if label in sizes:
+                w, h = sizes[label]
+                rates.append((w * h, result['best'] / frames[kind]))
+
+        if rates:
+            return sorted(rates)
+
+    raise Exception("No calibration benchmarks in %s" % path)
+
+def _composited(meta, inputs, size):
+    """ Return the pixels blitted on a composition canvas per frame. """
+    w, h = size
+    total = 0
+
+    for i in inputs:
+        if meta[i]['size'] is None:
+            continue
+
+        x, y = meta[i]['pos']
+        cw, ch = meta[i]['size']
+
+        total += (max(0, min(w, x + cw) - max(0, x))
+                * max(0, min(h, y + ch) - max(0, y)))
+
+    return total
+
+def _issue(op, level, message):
+    """ Return an issue found in an operation. """
+    return {'line': getattr(op, 'lineno', None), 'level': level,
+            'message': message}
+
+def _kind(op, inputs):
+    """ Return the kind of clip produced by an operation, or None. """
+    if type(op) == OpDefine:
+        return op.type if op.type in VISUAL + ['audio'] else None
+
+    elif type(op) in [OpEffect, OpSubclip]:
+        return inputs[0] if inputs else None
+
+    elif type(op) == OpMix:
+        return 'video'
+
+    return None
+
+def _needed(graph):
+    """ Return the set of nodes the exports depend on. """
+    needed = set()
+    pending = graph.exports()
+
+    while pending:
+        node = pending.pop()
+
+        if node not in needed:
+            needed.add(node)
+            pending.extend(graph.inputs[node])
+
+    return needed
+
+def _seconds(calibration, frames, pixels):
+    """ Return the expected time to render frames of a size, or None. """
+    if not calibration:
+        return None
+
+    # The closest resolution, rendering time grows with the pixels
+    base, rate = min(calibration, key=lambda c: abs(c[0] - pixels))
+
+    return frames * rate * pixels / base
+
+def _type_errors(op, inputs):
+    """ Return the messages of the errors in the parameters of an
+        operation, given the kinds of its inputs (None if unknown).
+    """
+    errors = []
+
+    def expect(kinds, what, allowed):
+        for kind in kinds:
+            if kind is not None and kind not in allowed:
+                errors.append("%s must be %s, not %s" % (what,
+                    " or ".join(allowed), kind))
+
+    if type(op) == OpDefine:
+        if op.type not in VISUAL + ['audio']:
+            errors.append("unknown clip type '%s'" % op.type)
+
+        elif op.type == 'image' and not op.duration and not op.duration_from:
+            errors.append("images need a duration or duration_from")
+
+        elif op.scale <= 0:
+            errors.append("scale must be positive")
+
+    elif type(op) == OpEffect:
+        expect(inputs, "clip", VISUAL)
+
+        if op.type == 'resize' and not (op.width or op.height):
+            errors.append("resize needs a width or a height")
+
+        elif op.type == 'position' and (op.x is None or op.y is None):
+            errors.append("position needs x and y")
+
+        elif op.type == 'margin' and op.size is None:
+            errors.append("margin needs a size")
+
+    elif type(op) == OpMix:
+        if op.type == 'setaudio':
+            expect(inputs[:1], "clip", VISUAL)
+            expect(inputs[1:], "audio", ['audio'])
+
+        else:
+            expect(inputs, "clips", VISUAL)
+
+            if not op.clips:
+                errors.append("%s needs clips" % op.type)
+
+        if op.type == 'composition' and not (op.width and op.height):
+            errors.append("composition needs a width and a height")
+
+    elif type(op) == OpSubclip:
+        if op.end and get_seconds(op.end) <= get_seconds(op.start):
+            errors.append("subclip ends before it starts")
+
+    elif type(op) == OpExport:
+        expect(inputs, "clip", VISUAL)
+
+        if op.fps <= 0:
+            errors.append("fps must be positive")
+
+        if op.segments < 1:
+            errors.append("segments must be at least 1")
+
+    return errors
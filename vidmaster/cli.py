@@ -21,14 +21,299 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+from vidmaster.assets import DEFAULT_SIZE as IMAGES_SIZE
+from vidmaster.assets import ImageCache, install_cache
+from vidmaster.batch import read_manifest, run_batch
+from vidmaster.cache import ClipCache, DEFAULT_DIR, DEFAULT_SIZE
+from vidmaster.check import check_script, load_calibration
+from vidmaster.compiler import compare, TOLERANCE
+from vidmaster.daemon import Daemon, DEFAULT_SOCKET, FINISHED
+from vidmaster.daemon import request, submit, wait
+from vidmaster.distributed import Coordinator, LEASE, Worker, WorkQueue
+from vidmaster.planner import Graph, describe
+from vidmaster.probe import DEFAULT_INDEX, ProbeIndex, install_index
+from vidmaster.profiler import Profiler
+from vidmaster.watch import Watcher
 from vidmaster.workbench import start_workbench
+import argparse
+import json
 import sys
 
 def main():
-    if len(sys.argv) != 2:
-        print("Usage: vidmaster.py <video script file>")
-        sys.exit()
+    parser = argparse.ArgumentParser(prog='vidmaster',
+            description='Automated video compositions')
+    parser.add_argument('scripts', nargs='*', metavar='script',
+            help='video script file')
+    parser.add_argument('--manifest',
+            help='file listing the scripts to render, one per line')
+    parser.add_argument('--jobs', type=int,
+            help='number of scripts rendered at once')
+    parser.add_argument('--summary',
+            help='write the result of each script to a JSON file')
+    parser.add_argument('--draft', type=float, metavar='SCALE',
+            help='render a low resolution preview scaled by SCALE (0-1)')
+    parser.add_argument('--profile', metavar='TRACE',
+            help='time every operation and frame, writing a Chrome trace')
+    parser.add_argument('--op-cache', action='store_true',
+            help='keep the parsed script next to it to skip parsing later')
+    parser.add_argument('--probe-index', default=DEFAULT_INDEX,
+            help='database of the metadata of the media files')
+    parser.add_argument('--no-probe-index', action='store_true',
+            help='probe every media file again')
+    parser.add_argument('--warm', metavar='DIRECTORY',
+            help='probe every media file in a directory and exit')
+    parser.add_argument('--plan', action='store_true',
+            help='show the operations that would be performed and exit')
+    parser.add_argument('--check', action='store_true',
+            help='look for mistakes in the scripts and estimate the cost '
+            'of rendering them without rendering, then exit')
+    parser.add_argument('--calibration', metavar='RESULTS',
+            help='benchmark results (see vidmaster.benchmark) used by '
+            '--check to estimate render times')
+    parser.add_argument('--watch', action='store_true',
+            help='rebuild what changes whenever the script or its sources '
+            'change')
+    parser.add_argument('--cache', action='store_true',
+            help='keep expensive intermediate clips on disk for later runs')
+    parser.add_argument('--cache-dir', default=DEFAULT_DIR,
+            help='directory of the cache of intermediate clips')
+    parser.add_argument('--cache-size', type=float,
+            default=DEFAULT_SIZE / 1024 ** 3,
+            help='maximum size of the cache in GiB')
+    parser.add_argument('--image-cache-size', type=float,
+            default=IMAGES_SIZE / 1024 ** 2,
+            help='maximum size of the decoded images kept in memory in MiB')
+    parser.add_argument('--image-cache-dir',
+            help='directory to keep the decoded images in, mapped into '
+            'memory and shared by every process using it')
+    parser.add_argument('--backend', choices=['moviepy', 'ffmpeg'],
+            default='moviepy', help='library used to render the exports')
+    parser.add_argument('--compare', action='store_true',
+            help='compare the frames rendered by both backends and exit')
+    parser.add_argument('--daemon', action='store_true',
+            help='render the scripts submitted through the socket')
+    parser.add_argument('--socket', default=DEFAULT_SOCKET,
+            help='socket of the daemon')
+    parser.add_argument('--submit', action='store_true',
+            help='submit the scripts to the daemon instead (- reads one '
+            'from the standard input)')
+    parser.add_argument('--priority', type=int, default=0,
+            help='priority of the submitted scripts (higher first)')
+    parser.add_argument('--wait', action='store_true',
+            help='wait for the submitted scripts to be rendered')
+    parser.add_argument('--status', action='store_true',
+            help='show the jobs of the daemon and exit')
+    parser.add_argument('--cancel', type=int, metavar='JOB',
+            help='cancel a job of the daemon and exit')
+    parser.add_argument('--stop', action='store_true',
+            help='stop the daemon once its running jobs finish and exit')
+    parser.add_argument('--distribute', metavar='QUEUE',
+            help='render the script through the jobs of a shared queue '
+            'directory, with --jobs local workers')
+    parser.add_argument('--worker', metavar='QUEUE',
+            help='perform the jobs of a shared queue directory')
+    parser.add_argument('--lease', type=float, default=LEASE,
+            help='seconds after which the jobs of a silent worker are '
+            'given to others')
 
-    workbench = start_workbench(sys.argv[1])
+    args = parser.parse_args()
+
+    install_cache(ImageCache(int(args.image_cache_size * 1024 ** 2),
+        args.image_cache_dir))
+
+    index = None
+    if not args.no_probe_index:
+        index = ProbeIndex(args.probe_index)
+        install_index(index)
+
+    if args.warm:
+        if index is None:
+            parser.error('--warm cannot be used with --no-probe-index')
+
+        print("%d files probed" % index.warm(args.warm, args.jobs))
+        return
+
+    if args.daemon:
+        daemon = Daemon(args.socket, args.jobs,
+                args.cache_dir if args.cache else None,
+                int(args.cache_size * 1024 ** 3), args.op_cache)
+
+        try:
+            daemon.serve()
+
+        except KeyboardInterrupt:
+            pass
+
+        return
+
+    if args.worker:
+        cache = None
+        if args.cache:
+            cache = ClipCache(args.cache_dir, int(args.cache_size * 1024 ** 3))
+
+        try:
+            Worker(WorkQueue(args.worker), lease=args.lease,
+                    cache=cache).run()
+
+        except KeyboardInterrupt:
+            pass
+
+        return
+
+    if args.status:
+        for job in request({'command': 'status'}, args.socket)['jobs']:
+            print_job(job)
+
+        return
+
+    if args.cancel is not None:
+        print_job(request({'command': 'cancel', 'job': args.cancel},
+            args.socket)['job'])
+        return
+
+    if args.stop:
+        request({'command': 'stop'}, args.socket)
+        return
+
+    scripts = list(args.scripts)
+    if args.manifest:
+        scripts += read_manifest(args.manifest)
+
+    if not scripts:
+        parser.error('no script given')
+
+    if args.check:
+        calibration = None
+        if args.calibration:
+            calibration = load_calibration(args.calibration)
+
+        reports = [check_script(script, calibration, args.draft)
+                for script in scripts]
+
+        for report in reports:
+            print_report(report)
+
+        if args.summary:
+            with open(args.summary, 'w') as f:
+                json.dump(reports, f, indent=2)
+
+        if any(i['level'] == 'error' for r in reports for i in r['issues']):
+            sys.exit(1)
+
+        return
+
+    if args.submit:
+        jobs = []
+
+        for script in scripts:
+            text = sys.stdin.read() if script == '-' else None
+            job = submit(script, text, args.priority, args.draft,
+                    args.backend, args.socket)
+
+            print("Submitted job %d" % job['id'])
+            jobs.append(job['id'])
+
+        if args.wait:
+            results = wait(jobs, args.socket, print_job)
+
+            if any(job['state'] != 'ok' for job in results):
+                sys.exit(1)
+
+        return
+
+    if len(scripts) > 1 or args.manifest:
+        if args.plan or args.compare or args.watch or args.distribute:
+            parser.error('--plan, --compare, --watch and --distribute take '
+                    'a single script')
+
+        results = run_batch(scripts, args.jobs, args.summary,
+                args.cache_dir if args.cache else None,
+                int(args.cache_size * 1024 ** 3), args.backend,
+                args.draft, args.op_cache)
+
+        if any(r['status'] != 'ok' for r in results):
+            sys.exit(1)
+
+        return
+
+    if args.watch:
+        cache = None
+        if args.cache:
+            cache = ClipCache(args.cache_dir, int(args.cache_size * 1024 ** 3))
+
+        try:
+            Watcher(scripts[0], args.draft, cache, args.backend).watch()
+
+        except KeyboardInterrupt:
+            pass
+
+        return
+
+    if args.distribute:
+        Coordinator(scripts[0], WorkQueue(args.distribute), args.draft,
+                args.backend, args.lease).run(args.jobs or 0)
+        return
+
+    workbench = start_workbench(scripts[0], args.draft, args.op_cache)
+
+    if args.plan:
+        for op in workbench.plan():
+            print("%5d  %s" % (op.lineno, describe(op)))
+
+        return
+
+    if args.compare:
+        for node in Graph(workbench.ops).exports():
+            print("Export '%s'" % workbench.ops[node].out)
+
+            for t, diff in compare(workbench, node):
+                print("  %8.3fs  difference %6.2f  %s" % (t, diff,
+                    'ok' if diff <= TOLERANCE else 'MISMATCH'))
+
+        return
+
+    workbench.backend = args.backend
+
+    if args.cache:
+        workbench.cache = ClipCache(args.cache_dir,
+                int(args.cache_size * 1024 ** 3))
+
+    if args.profile:
+        workbench.profiler = Profiler()
 
     workbench.build()
+
+    if args.profile:
+        workbench.profiler.save(args.profile)
+
+def print_job(job):
+    """ Print the state of a job of the daemon. """
+    if job['state'] in FINISHED:
+        detail = job['error'] or ''
+
+    elif job['state'] == 'running':
+        detail = "%d/%s %s" % (job['done'], job['total'] or '?',
+                job['operation'] or '')
+
+    else:
+        detail = "priority %d" % job['priority']
+
+    print("%5d  %-9s %7s  %s  %s" % (job['id'], job['state'],
+        '' if job['elapsed'] is None else '%.1fs' % job['elapsed'],
+        job['script'], detail))
+
+def print_report(report):
+    """ Print the issues and estimates of a checked script. """
+    def where(line):
+        return report['script'] + (':%d' % line if line else '')
+
+    for issue in report['issues']:
+        print("%s: %s: %s" % (where(issue['line']), issue['level'],
+            issue['message']))
+
+    for export in report['exports']:
+        print("%s: export %s: %d frames at %dx%d, %d pixels composited "
+                "per frame%s" % (where(export['line']), export['out'],
+                    export['frames'], export['size'][0], export['size'][1],
+                    export['composited'], '' if export['seconds'] is None
+                    else ', about %.1fs' % export['seconds']))
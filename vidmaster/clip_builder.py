@@ -23,15 +23,39 @@
 
 
 from moviepy.audio.io.AudioFileClip import AudioFileClip
-from moviepy.video.compositing.CompositeVideoClip import CompositeVideoClip
-from moviepy.video.compositing.concatenate import concatenate_videoclips
 from moviepy.video.tools.cuts import find_video_period
 from moviepy.video.VideoClip import ImageClip
 from moviepy.video.io.VideoFileClip import VideoFileClip
-import moviepy.video.fx.all as vfx
+from vidmaster.assets import load_image
+from vidmaster.compositor import composite
+from vidmaster.draft import scale_video, scaled_size
+from vidmaster.kernels import margin, resize
+from vidmaster.planner import export_size, resize_size
+from vidmaster.seeking import Seeker
+from vidmaster.timeline import concatenate
 
-import os
 
+def close_clip(clip):
+    """ Close the files a clip reads from.
+
+        The clip, and every clip derived from it, cannot be used after
+        this.
+    """
+    reader = getattr(clip, 'reader', None)
+
+    if isinstance(clip, VideoFileClip):
+        reader.close()
+        reader.lastread = None
+
+    elif isinstance(clip, AudioFileClip):
+        reader.close_proc()
+        reader.buffer = None
+
+    audio = getattr(clip, 'audio', None)
+
+    if isinstance(audio, AudioFileClip):
+        audio.reader.close_proc()
+        audio.reader.buffer = None
 
 def define_audio(op):
     """ Define an audio clip from source file.
@@ -51,12 +75,17 @@ def define_image(op, ext_duration=None):
 
         Mainly used for intro/outro and static background.
     """
-    if ext_duration:
-        # clip = ImageClip(op.source, duration=find_video_period(ext_duration))
-        clip = ImageClip(op.source, duration=ext_duration.duration)
+    duration = ext_duration.duration if ext_duration else op.duration
+    img, mask = load_image(op.source)
 
-    else:
-        clip = ImageClip(op.source, duration=op.duration)
+    # clip = ImageClip(op.source, duration=find_video_period(ext_duration))
+    clip = ImageClip(img, duration=duration)
+
+    if mask is not None:
+        clip.mask = ImageClip(mask, ismask=True)
+
+    if op.scale != 1:
+        clip = resize(clip, scaled_size(clip.size, op.scale))
 
     return clip
 
@@ -68,14 +97,22 @@ def define_video(op):
     """
     clip = VideoFileClip(op.source, audio=op.hasaudio)
 
+    if op.scale != 1:
+        clip = scale_video(clip, op.scale)
+
+    # Subclips of the clip seek through the source using its keyframes
+    Seeker(clip.reader).install()
+
     return clip
 
 def do_concatenate(clips):
     """ Concatenate clips into one.
 
         clips - ordered list of clips to concatenate
+
+        Nested concatenations are flattened into a single timeline.
     """
-    result = concatenate_videoclips(clips)
+    result = concatenate(clips)
 
     return result
 
@@ -85,8 +122,11 @@ def do_composite(clips, height, width):
         clips  - list of clips to composite ordered by layer
         height - height of the final composition
         width  - width of the final composition
+
+        Static bottom layers are flattened once, and each frame only the
+        visible layers are drawn (see vidmaster.compositor).
     """
-    result = CompositeVideoClip(clips, size=(width, height))
+    result = composite(clips, (width, height))
 
     return result
 
@@ -122,8 +162,7 @@ def effect_margin(clip, op):
         green   - amount of green for the color of the margin
         blue    - amount of blue for the color of the margin
     """
-    result = clip.fx(vfx.margin, mar=op.size,
-            color=(op.red, op.green, op.blue), opacity=op.opacity)
+    result = margin(clip, op.size, (op.red, op.green, op.blue), op.opacity)
 
     return result
 
@@ -144,11 +183,27 @@ def effect_resize(clip, op):
         clip   - clip to apply the effect to
         height - new height for the clip
         width  - new width for the clip
+
+        If only one of them is given, the aspect ratio is kept.
     """
-    result = clip.fx(vfx.resize, height=op.height, width=op.width)
+    result = resize(clip, resize_size(op, clip.size))
 
     return result
 
+def find_readers(clips):
+    """ Return the video file readers used by a list of clips.
+
+        Clips derived from the same file share its reader, so each reader
+        appears only once.
+    """
+    readers = {}
+
+    for clip in clips:
+        if isinstance(clip, VideoFileClip):
+            readers[id(clip.reader)] = clip.reader
+
+    return list(readers.values())
+
 def export_video(clip, op):
     """ Export the clip to a file.
 
@@ -163,4 +218,30 @@ def export_video(clip, op):
             codec=op.codec,
             preset=op.preset,
             threads=op.threads,
-            ffmpeg_params=op.params)
+            ffmpeg_params=export_params(op, clip.size))
+
+def export_params(op, size):
+    """ Return the additional FFMPEG parameters of an export.
+
+        op   - export operation
+        size - (width, height) of the frames given to the encoder
+
+        If the export sets a size, the encoder scales the frames to it.
+    """
+    params = list(op.params)
+    out = export_size(op, size)
+
+    if out == tuple(size):
+        return params
+
+    scale = 'scale=%d:%d:flags=area' % out
+
+    # Scale before the filters of the export, if any
+    if '-vf' in params:
+        i = params.index('-vf') + 1
+        params[i] = scale + ',' + params[i]
+
+    else:
+        params += ['-vf', scale]
+
+    return params
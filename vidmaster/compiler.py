@@ -0,0 +1,443 @@
+# -*- coding: utf-8 -*-
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 Rafael Medina García
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+from vidmaster.ffmpeg import run_ffmpeg
+from vidmaster.parser import OpDefine, OpEffect, OpMix, OpSubclip, get_seconds
+from vidmaster.planner import Graph, export_size, infer
+from vidmaster.probe import probe
+
+import copy
+import numpy as np
+import os
+import shutil
+import tempfile
+
+# Every audio stream is converted to this format before being mixed
+AUDIO_FORMAT = 'aformat=sample_fmts=fltp:sample_rates=44100:channel_layouts=stereo'
+# Pixel formats of images with an alpha channel, which MoviePy turns
+# into masks
+ALPHA_FORMATS = ['rgba', 'bgra', 'argb', 'abgr', 'ya8', 'ya16be', 'ya16le',
+        'rgba64be', 'rgba64le']
+# Maximum mean absolute difference (in 8-bit levels) accepted between the
+# frames of both backends
+TOLERANCE = 6.0
+
+
+class Compiler(object):
+    """ Compiles the operations behind an export into a FFMPEG command.
+
+        The whole render is expressed as a single filter_complex graph:
+        subclips become trim, resizes scale, margins pad, compositions
+        overlay on a color source, concatenations concat and audio is
+        mixed with amix.
+    """
+
+    def __init__(self, graph, node, op=None):
+        """ Compile an export.
+
+            graph - dependency graph of the workbench operations
+            node  - index of the export operation
+            op    - export operation to use instead of the one in the graph
+        """
+        self.graph = graph
+        self.op = op or graph.ops[node]
+        self.meta = infer(graph, graph.prune([node]), probe)
+
+        self.inputs = []
+        self.filters = []
+
+        # Stream label of each (node, kind) and the labels of its readers
+        self.streams = {}
+        self.readers = {}
+        self.count = 0
+
+        child = graph.inputs[node][0]
+        meta = self.meta[child]
+
+        video = self._take(child, 'v')
+
+        # Pick the frames MoviePy would pick at the export rate
+        if self._rate(child) != self.op.fps:
+            video = self._chain(video, 'fps=%s:round=up' % self.op.fps)
+
+        size = export_size(self.op, meta['size'])
+        if size != tuple(meta['size']):
+            video = self._chain(video, 'scale=%d:%d:flags=area' % size)
+
+        if self._yuv420p(size):
+            video = self._chain(video, 'format=yuv420p')
+
+        # Same number of frames MoviePy writes
+        self.maps = ['-map', '[%s]' % video, '-r', str(self.op.fps)]
+
+        if meta['duration'] is not None:
+            self.maps += ['-frames:v',
+                    str(int(meta['duration'] * self.op.fps))]
+
+        if meta['audio']:
+            self.maps += ['-map', '[%s]' % self._take(child, 'a')]
+
+        self._split()
+
+    def args(self, out=None):
+        """ Return the FFMPEG arguments for the export.
+
+            out - path of the output file, defaults to the export one
+        """
+        op = self.op
+        out = out or op.out
+
+        args = list(self.inputs)
+        args += ['-filter_complex', ';'.join(self.filters)] + self.maps
+        args += ['-c:v', op.codec]
+
+        if op.preset:
+            args += ['-preset', op.preset]
+
+        if op.threads:
+            args += ['-threads', str(op.threads)]
+
+        if os.path.splitext(out)[1].lower() in ['.ogv', '.webm']:
+            args += ['-c:a', 'libvorbis']
+
+        else:
+            args += ['-c:a', 'libmp3lame']
+
+        return args + op.params + [out]
+
+    def _build(self, node, kind):
+        """ Add the filters producing a stream of a node.
+
+            Returns the label of the stream.
+        """
+        op = self.graph.ops[node]
+        meta = self.meta[node]
+        inputs = self.graph.inputs[node]
+
+        if type(op) == OpDefine:
+            index = len([a for a in self.inputs if a == '-i'])
+
+            if op.type == 'image':
+                self.inputs += ['-loop', '1', '-framerate', str(self.op.fps),
+                        '-t', '%.6f' % meta['duration'], '-i', op.source]
+
+            else:
+                self.inputs += ['-i', op.source]
+
+            if kind == 'v':
+                # Frames are handled in RGB from here on, as in MoviePy,
+                # keeping the alpha channel that would be their mask
+                chain = 'setpts=PTS-STARTPTS'
+                if op.scale != 1:
+                    chain += ',scale=%d:%d' % meta['size']
+
+                    # MoviePy shrinks images itself, with area averaging
+                    if op.type == 'image':
+                        chain += ':flags=area'
+
+                return self._chain('%d:v' % index, chain + ',format=%s' % (
+                    'rgba' if self._alpha(node) else 'rgb24'))
+
+            return self._chain('%d:a' % index,
+                    AUDIO_FORMAT + ',asetpts=PTS-STARTPTS')
+
+        elif type(op) == OpEffect:
+            source = self._take(inputs[0], kind)
+
+            if kind == 'a' or op.type == 'position':
+                return source
+
+            if op.type == 'resize':
+                return self._chain(source,
+                        'scale=%d:%d:flags=area' % meta['size'])
+
+            color = '0x%02x%02x%02x' % (op.red or 0, op.green or 0,
+                    op.blue or 0)
+            chain = 'format=rgba,' if self._alpha(node) else 'format=rgb24,'
+
+            if op.opacity is not None and op.opacity < 1:
+                color += '@%s' % op.opacity
+
+            return self._chain(source, chain + 'pad=%d:%d:%d:%d:color=%s' % (
+                meta['size'] + (op.size, op.size, color)))
+
+        elif type(op) == OpSubclip:
+            source = self._take(inputs[0], kind)
+
+            trim = 'start=%.6f' % get_seconds(op.start)
+            if op.end:
+                trim += ':end=%.6f' % get_seconds(op.end)
+
+            if kind == 'v':
+                return self._chain(source,
+                        'trim=%s,setpts=PTS-STARTPTS' % trim)
+
+            return self._chain(source, 'atrim=%s,asetpts=PTS-STARTPTS' % trim)
+
+        elif type(op) == OpMix:
+            if op.type == 'setaudio':
+                if kind == 'v':
+                    return self._take(inputs[0], 'v')
+
+                return self._chain(self._take(inputs[1], 'a'),
+                        'atrim=duration=%.6f' % meta['duration'])
+
+            elif op.type == 'composition':
+                return self._composition(node, kind)
+
+            return self._concatenation(node, kind)
+
+        raise Exception("Cannot compile operation")
+
+    def _alpha(self, node):
+        """ Check whether the video stream of a node has an alpha channel.
+
+            Streams have one where MoviePy would give the clip a mask, so
+            overlay blends them the same way.
+        """
+        op = self.graph.ops[node]
+        inputs = self.graph.inputs[node]
+
+        if type(op) == OpDefine:
+            return (op.type == 'image'
+                    and probe(op.source)['pix_fmt'] in ALPHA_FORMATS)
+
+        elif type(op) == OpEffect and op.type == 'margin':
+            return (self._alpha(inputs[0])
+                    or op.opacity is not None and op.opacity < 1)
+
+        elif type(op) == OpMix:
+            if op.type == 'composition':
+                # Composed over an opaque background
+                return False
+
+            elif op.type == 'setaudio':
+                return self._alpha(inputs[0])
+
+            return any(self._alpha(i) for i in inputs)
+
+        return self._alpha(inputs[0])
+
+    def _chain(self, source, chain):
+        """ Add a filter chain and return the label of its output. """
+        out = self._label()
+        self.filters.append('[%s]%s[%s]' % (source, chain, out))
+
+        return out
+
+    def _composition(self, node, kind):
+        """ Add the filters of a composition. """
+        meta = self.meta[node]
+        layers = self.graph.inputs[node]
+
+        if kind == 'a':
+            sources = ['[%s]' % self._take(l, 'a') for l in layers
+                    if self.meta[l]['audio']]
+
+            if len(sources) == 1:
+                return sources[0][1:-1]
+
+            out = self._label()
+            self.filters.append(
+                    '%samix=inputs=%d:duration=longest:normalize=0[%s]' % (
+                    ''.join(sources), len(sources), out))
+
+            return out
+
+        base = self._label()
+        self.filters.append('color=c=black:s=%dx%d:r=%s:d=%.6f[%s]' % (
+            meta['size'] + (self.op.fps, meta['duration'], base)))
+
+        for layer in layers:
+            x, y = self.meta[layer]['pos']
+            out = self._label()
+
+            self.filters.append('[%s][%s]overlay=x=%d:y=%d:'
+                    'eof_action=pass:format=rgb[%s]' % (
+                    base, self._take(layer, 'v'), x, y, out))
+            base = out
+
+        return base
+
+    def _concatenation(self, node, kind):
+        """ Add the filters of a concatenation.
+
+            Both streams are produced at once, as concat needs them
+            together.
+        """
+        meta = self.meta[node]
+        clips = self.graph.inputs[node]
+
+        if len(set(self.meta[c]['size'] for c in clips)) != 1:
+            raise Exception("Cannot compile concatenation of clips with "
+                    "different sizes")
+
+        sources = ''
+
+        for clip in clips:
+            sources += '[%s]' % self._chain(self._take(clip, 'v'), 'setsar=1')
+
+            if meta['audio'] and self.meta[clip]['audio']:
+                sources += '[%s]' % self._take(clip, 'a')
+
+            elif meta['audio']:
+                silence = self._label()
+                self.filters.append('anullsrc=r=44100:cl=stereo,'
+                        'atrim=duration=%.6f,%s[%s]' % (
+                        self.meta[clip]['duration'], AUDIO_FORMAT, silence))
+                sources += '[%s]' % silence
+
+        video = self._label()
+        audio = self._label()
+
+        self.filters.append('%sconcat=n=%d:v=1:a=%d[%s]%s' % (sources,
+            len(clips), 1 if meta['audio'] else 0, video,
+            '[%s]' % audio if meta['audio'] else ''))
+
+        self.streams[(node, 'a')] = audio
+
+        return video
+
+    def _label(self):
+        """ Return a new, unique stream label. """
+        self.count += 1
+
+        return 's%d' % self.count
+
+    def _rate(self, node):
+        """ Return the frame rate of the video stream of a node, or None. """
+        op = self.graph.ops[node]
+        inputs = self.graph.inputs[node]
+
+        if type(op) == OpDefine:
+            return self.meta[node]['fps'] if op.type == 'video' else self.op.fps
+
+        elif type(op) == OpMix and op.type == 'composition':
+            # The background sets the rate
+            return self.op.fps
+
+        rates = set(self._rate(i) for i in inputs[:1 if type(op) != OpMix
+            or op.type == 'setaudio' else None])
+
+        return rates.pop() if len(rates) == 1 else None
+
+    def _split(self):
+        """ Connect every stream to its readers, splitting it if needed. """
+        for key, readers in self.readers.items():
+            source = self.streams[key]
+            kind = '' if key[1] == 'v' else 'a'
+
+            if len(readers) == 1:
+                self.filters.append('[%s]%snull[%s]' % (
+                    source, kind, readers[0]))
+
+            else:
+                self.filters.append('[%s]%ssplit=%d%s' % (source, kind,
+                    len(readers), ''.join('[%s]' % r for r in readers)))
+
+    def _take(self, node, kind):
+        """ Return a label to read a stream of a node from.
+
+            kind - 'v' for video or 'a' for audio
+        """
+        key = (node, kind)
+
+        if key not in self.streams:
+            self.streams[key] = self._build(node, kind)
+
+        label = self._label()
+        self.readers.setdefault(key, []).append(label)
+
+        return label
+
+    def _yuv420p(self, size):
+        """ Check whether MoviePy would encode in yuv420p. """
+        return (self.op.codec == 'libx264' and size[0] % 2 == 0
+                and size[1] % 2 == 0)
+
+
+def compare(workbench, node, samples=5):
+    """ Compare the frames rendered by both backends for an export.
+
+        workbench - workbench the export belongs to
+        node      - index of the export operation
+        samples   - number of frames to compare, evenly spread
+
+        The FFMPEG backend renders a lossless file, which is compared
+        against the frames MoviePy computes. The clips are released
+        afterwards, closing their sources. Returns a list of
+        (time, mean absolute difference) tuples.
+    """
+    graph = Graph(workbench.ops)
+    op = workbench.ops[node]
+
+    lossless = copy.copy(op)
+    lossless.codec = 'png'
+    lossless.preset = None
+    lossless.params = []
+    # Frames are compared at the size of the clip
+    lossless.width = lossless.height = None
+
+    compiler = Compiler(graph, node, lossless)
+
+    tmpdir = tempfile.mkdtemp(prefix='.vidmaster-')
+
+    try:
+        path = os.path.join(tmpdir, 'compare.mkv')
+        run_ffmpeg(compiler.args(path))
+
+        workbench.prepare(node)
+        clip = workbench.clips[op.clip]
+        w, h = clip.size
+
+        nframes = int(clip.duration * op.fps)
+        result = []
+
+        for i in range(samples):
+            frame = i * (nframes - 1) // max(1, samples - 1)
+            t = float(frame) / op.fps
+
+            raw = run_ffmpeg(['-i', path, '-vf', 'select=eq(n\\,%d)' % frame,
+                '-frames:v', '1', '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-'])
+            test = np.frombuffer(raw, dtype='uint8').reshape((h, w, 3))
+            reference = clip.get_frame(t).astype('uint8')
+
+            diff = np.abs(test.astype(int) - reference.astype(int)).mean()
+            result.append((t, diff))
+
+        return result
+
+    finally:
+        for i in graph.prune([node]):
+            if i != node:
+                workbench.release(i)
+
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+def render(graph, node):
+    """ Render an export with FFMPEG alone.
+
+        graph - dependency graph of the workbench operations
+        node  - index of the export operation
+    """
+    run_ffmpeg(Compiler(graph, node).args())
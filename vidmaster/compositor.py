@@ -0,0 +1,285 @@
+# -*- coding: utf-8 -*-
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 Rafael Medina García
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+from moviepy.video.compositing.CompositeVideoClip import CompositeVideoClip
+from moviepy.video.VideoClip import ImageClip
+from vidmaster.kernels import BUFFERS
+
+import numpy as np
+
+# Names MoviePy accepts as positions, as (x, y)
+POSITIONS = {
+    'center': ['center', 'center'],
+    'left': ['left', 'center'],
+    'right': ['right', 'center'],
+    'top': ['center', 'top'],
+    'bottom': ['center', 'bottom'],
+}
+
+
+class Compositor(object):
+    """ Composes the frames of the layers of a composition.
+
+        Each frame, only the layers that are visible are computed: layers
+        outside their time window, out of the canvas or covered by an
+        opaque layer above them are skipped, so their sources are not
+        even decoded.
+
+        Frames are composed on canvases that keep the background between
+        frames. Only the rectangles drawn on a canvas are restored before
+        drawing the layers again, so a small inset over a still
+        background only costs its own area. Canvases are reused in turns
+        (see vidmaster.kernels.BUFFERS), so a frame stays valid while the
+        next one is computed.
+    """
+
+    def __init__(self, background, clips):
+        """ Create a compositor.
+
+            background - frame the layers are drawn on, it does not change
+            clips      - clips of the layers, bottom first
+        """
+        self.background = np.ascontiguousarray(background, dtype='uint8')
+        self.clips = clips
+
+        self.canvases = [self.background.copy() for _ in range(BUFFERS)]
+        # Rectangles drawn on each canvas, as (x1, y1, x2, y2)
+        self.drawn = [[] for _ in range(BUFFERS)]
+        self.turn = 0
+
+    def make_frame(self, t):
+        """ Return the frame of the composition at time t. """
+        canvas = self.canvases[self.turn]
+        drawn = self.drawn[self.turn]
+
+        layers = self.visible(t)
+        covered = [rect for clip, ct, pos, rect in layers
+                if clip.mask is None]
+
+        # Restore what the layers drew last time, except where an opaque
+        # layer draws over it again
+        for rect in set(drawn + [rect for _, _, _, rect in layers]):
+            if not any(_inside(rect, c) for c in covered):
+                x1, y1, x2, y2 = rect
+                canvas[y1:y2, x1:x2] = self.background[y1:y2, x1:x2]
+
+        rects = []
+
+        for clip, ct, pos, rect in layers:
+            img = clip.get_frame(ct)
+            mask = None if clip.mask is None else clip.mask.get_frame(ct)
+
+            if img.shape[1::-1] != tuple(clip.size):
+                # The size was not known beforehand, place it again
+                pos = _position(clip, ct, canvas.shape[1::-1], img.shape)
+
+            rect = blit(img, canvas, pos, mask)
+
+            if rect is not None:
+                rects.append(rect)
+
+        self.drawn[self.turn] = rects
+        self.turn = (self.turn + 1) % len(self.canvases)
+
+        return canvas
+
+    def visible(self, t):
+        """ Find the layers that can be seen at time t.
+
+            Returns a list of (clip, clip time, position, rectangle)
+            tuples, bottom first, with the rectangle of the canvas each
+            layer covers.
+        """
+        h, w = self.background.shape[:2]
+        covered = []
+        layers = []
+
+        for clip in reversed(self.clips):
+            if not clip.is_playing(t):
+                continue
+
+            ct = t - clip.start
+            cw, ch = clip.size
+            pos = _position(clip, ct, (w, h), (ch, cw))
+
+            rect = (max(0, pos[0]), max(0, pos[1]), min(w, pos[0] + cw),
+                    min(h, pos[1] + ch))
+
+            if rect[0] >= rect[2] or rect[1] >= rect[3]:
+                continue
+
+            if any(_inside(rect, c) for c in covered):
+                continue
+
+            if clip.mask is None:
+                covered.append(rect)
+
+            layers.append((clip, ct, pos, rect))
+
+        layers.reverse()
+
+        return layers
+
+
+def blit(img, canvas, pos, mask=None):
+    """ Draw an image on a canvas in place, as MoviePy's blit() does.
+
+        img    - frame to draw
+        canvas - uint8 frame to draw on
+        pos    - (x, y) of the top left corner of the image on the canvas
+        mask   - optional mask of the image, with values from 0 to 1
+
+        Returns the rectangle drawn, as (x1, y1, x2, y2), or None.
+    """
+    x, y = pos
+    h, w = img.shape[:2]
+    ch, cw = canvas.shape[:2]
+
+    x1, y1 = max(0, -x), max(0, -y)
+    x2, y2 = min(w, cw - x), min(h, ch - y)
+
+    if x1 >= x2 or y1 >= y2:
+        return None
+
+    region = canvas[y + y1:y + y2, x + x1:x + x2]
+    part = img[y1:y2, x1:x2]
+
+    if mask is None:
+        region[...] = part
+
+    else:
+        mask = mask[y1:y2, x1:x2]
+
+        if part.ndim == 3:
+            mask = mask[:, :, np.newaxis]
+
+        # Same operations as MoviePy, so the result is identical
+        region[...] = 1.0 * mask * part + (1.0 - mask) * region
+
+    return (x + x1, y + y1, x + x2, y + y2)
+
+def composite(clips, size):
+    """ Create a composition of clips.
+
+        clips - list of clips to composite ordered by layer
+        size  - (width, height) of the composition
+
+        The bottom layers that do not change over time are flattened
+        once into a single image, the background of the rest of layers.
+        Frames are composed by a Compositor, the rest of the clip (mask,
+        audio, duration...) is the same MoviePy would create.
+    """
+    ends = [c.end for c in clips]
+    end = None if None in ends else max(ends)
+
+    static = 0
+    while static < len(clips) and is_static(clips[static], end):
+        static += 1
+
+    if not static:
+        result = CompositeVideoClip(clips, size=size)
+
+    else:
+        flat = CompositeVideoClip(clips[:static], size=size)
+        base = ImageClip(flat.get_frame(0), duration=flat.duration)
+
+        mask = flat.mask.get_frame(0)
+        if static == len(clips):
+            # Nothing moves, the image is the composition
+            base.mask = ImageClip(mask, ismask=True)
+
+            return base
+
+        elif mask.min() < 1:
+            # Part of the canvas is not covered, keep the transparency
+            base.mask = ImageClip(mask, ismask=True)
+
+            result = CompositeVideoClip([base] + clips[static:],
+                    size=size)
+
+        else:
+            result = CompositeVideoClip([base] + clips[static:],
+                    size=size, use_bgclip=True)
+
+    compositor = Compositor(result.bg.get_frame(0), result.clips)
+    result.make_frame = compositor.make_frame
+
+    return result
+
+def is_static(clip, end=None):
+    """ Check whether a clip looks the same during a whole composition.
+
+        clip - clip to check
+        end  - end of the composition, or None if unknown
+
+        Static clips are images (and their masks) that stay in the same
+        position from the start to the end of the composition.
+    """
+    if not isinstance(clip, ImageClip) or clip.start != 0:
+        return False
+
+    if clip.mask is not None and not isinstance(clip.mask, ImageClip):
+        return False
+
+    if clip.end is not None and (end is None or clip.end < end):
+        return False
+
+    return clip.pos(0) == clip.pos(clip.end or 0)
+
+def _inside(rect, other):
+    """ Check whether a rectangle is inside another one. """
+    return (other[0] <= rect[0] and other[1] <= rect[1]
+            and rect[2] <= other[2] and rect[3] <= other[3])
+
+def _position(clip, ct, size, shape):
+    """ Return the integer (x, y) of a layer on a canvas, as MoviePy does.
+
+        clip  - clip of the layer
+        ct    - time in the clip
+        size  - (width, height) of the canvas
+        shape - shape of the frame of the clip
+    """
+    wf, hf = size
+    hi, wi = shape[:2]
+    pos = clip.pos(ct)
+
+    if isinstance(pos, str):
+        pos = POSITIONS[pos]
+
+    pos = list(pos)
+
+    if clip.relative_pos:
+        for i, dim in enumerate([wf, hf]):
+            if not isinstance(pos[i], str):
+                pos[i] = dim * pos[i]
+
+    if isinstance(pos[0], str):
+        pos[0] = {'left': 0, 'center': (wf - wi) / 2, 'right': wf - wi}[
+                pos[0]]
+
+    if isinstance(pos[1], str):
+        pos[1] = {'top': 0, 'center': (hf - hi) / 2, 'bottom': hf - hi}[
+                pos[1]]
+
+    return [int(p) for p in pos]
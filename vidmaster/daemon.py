@@ -0,0 +1,637 @@
+# -*- coding: utf-8 -*-
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 Rafael Medina García
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+from vidmaster.cache import ClipCache
+from vidmaster.parser import OpExport
+from vidmaster.planner import describe
+from vidmaster.profiler import Profiler
+
+import errno
+import heapq
+import json
+import multiprocessing
+import os
+import select
+import shutil
+import signal
+import socket
+import time
+import traceback
+
+DEFAULT_SOCKET = os.path.join(os.path.expanduser('~'), '.cache', 'vidmaster',
+        'daemon.sock')
+# Seconds between two checks of the running jobs
+POLL_INTERVAL = 0.2
+# Seconds a client has to send its request and read the response
+REQUEST_TIMEOUT = 5
+# Number of finished jobs that are remembered
+HISTORY = 1000
+# Seconds a cancelled job has to exit before it is killed
+KILL_TIMEOUT = 5
+FINISHED = ['ok', 'failed', 'cancelled']
+
+
+class Daemon(object):
+    """ Renders the scripts submitted through a local socket.
+
+        MoviePy, NumPy and the rest of libraries are imported once, when
+        the daemon starts. Each job is rendered by a process forked from
+        the daemon, so it starts with everything already imported and a
+        failure (or crash) only affects that job. Each job reports through
+        its own pipe and runs in its own process group, so cancelling it
+        stops the programs it started (like ffmpeg) too, and leaves the
+        rest of jobs alone.
+
+        Clients send a JSON object per connection, in a single line, and
+        receive another one with the result (see request()). Connections
+        are read and written without blocking, so a slow client does not
+        hold up the jobs. Jobs are rendered by priority, and in order of
+        submission within the same priority.
+    """
+
+    def __init__(self, path=DEFAULT_SOCKET, jobs=None, cache_dir=None,
+            cache_size=None, op_cache=False):
+        """ Create a daemon.
+
+            path       - path of the Unix socket to listen on
+            jobs       - maximum number of scripts rendered at once,
+                defaults to the number of CPUs
+            cache_dir  - directory of the clip cache, None to disable it
+            cache_size - maximum size of the clip cache in bytes
+            op_cache   - whether to reuse the parsed operations of scripts
+        """
+        self.path = path
+        self.jobs = jobs or multiprocessing.cpu_count()
+        self.options = {'cache_dir': cache_dir, 'cache_size': cache_size,
+                'op_cache': op_cache}
+
+        # Inline scripts are written here, one file per job
+        self.spool = os.path.join(os.path.dirname(os.path.abspath(path)),
+                'spool')
+
+        # Job dicts by id, in order of submission
+        self.table = {}
+        # (-priority, id) of the queued jobs
+        self.queue = []
+        # (process, connection) of the running jobs by id
+        self.running = {}
+        # State of the open connections by socket
+        self.clients = {}
+        self.counter = 0
+        self.stopping = False
+
+    def serve(self):
+        """ Accept requests and render the jobs until asked to stop. """
+        # Imported here so that every job inherits it
+        import vidmaster.workbench
+
+        server = self._listen()
+        print("Listening on %s with %d workers" % (self.path, self.jobs))
+
+        try:
+            while not self.stopping or self.running or self.clients:
+                reading = [server] + [conn for conn, state
+                        in self.clients.items() if state['response'] is None]
+                writing = [conn for conn, state in self.clients.items()
+                        if state['response'] is not None]
+                readable, writable = select.select(reading, writing, [],
+                        POLL_INTERVAL)[:2]
+
+                for conn in readable:
+                    if conn is server:
+                        self._accept(server)
+                    else:
+                        self._receive(conn)
+
+                for conn in writable:
+                    self._send(conn)
+
+                self._expire()
+                self._collect()
+
+                if not self.stopping:
+                    self._schedule()
+
+        finally:
+            for job_id in list(self.running):
+                self._kill(job_id)
+
+            for conn in list(self.clients):
+                self._drop(conn)
+
+            server.close()
+            os.remove(self.path)
+            shutil.rmtree(self.spool, ignore_errors=True)
+
+    def handle(self, message):
+        """ Perform a request and return the response.
+
+            message - dict with the 'command' to perform, one of:
+
+                submit - queue a script, given by its absolute 'script'
+                    path or its 'text', with optional 'priority' (higher
+                    first), 'cwd' (to resolve the relative paths of
+                    inline scripts), 'draft' and 'backend'
+                status - return the job with the given 'job' id, or every
+                    job if none is given
+                cancel - cancel the queued or running job with the given
+                    'job' id
+                stop   - stop accepting jobs, exiting when the running
+                    ones finish
+        """
+        command = message.get('command')
+
+        if command == 'submit':
+            return {'job': self.submit(message)}
+
+        elif command == 'status':
+            if message.get('job') is None:
+                return {'jobs': [self._public(self.table[i])
+                    for i in sorted(self.table)]}
+
+            return {'job': self._job(message['job'])}
+
+        elif command == 'cancel':
+            return {'job': self.cancel(message['job'])}
+
+        elif command == 'stop':
+            self.stopping = True
+            return {}
+
+        raise Exception("Unknown command '%s'" % command)
+
+    def submit(self, message):
+        """ Queue a job and return it. See handle() for the message. """
+        if self.stopping:
+            raise Exception("The daemon is stopping")
+
+        self.counter += 1
+        job_id = self.counter
+
+        if message.get('text') is not None:
+            if not os.path.isdir(self.spool):
+                os.makedirs(self.spool)
+
+            script = os.path.join(self.spool, 'job%d.txt' % job_id)
+
+            with open(script, 'w') as f:
+                f.write(message['text'])
+
+        elif message.get('script'):
+            script = message['script']
+
+        else:
+            raise Exception("A script or its text is required")
+
+        job = {
+            'id': job_id,
+            'script': script,
+            'inline': message.get('text') is not None,
+            'priority': message.get('priority', 0),
+            'state': 'queued',
+            'submitted': time.time(),
+            'started': None,
+            'finished': None,
+            'wait': None,
+            'elapsed': None,
+            'operation': None,
+            'done': 0,
+            'total': None,
+            'operations': [],
+            'exports': [],
+            'error': None,
+        }
+
+        options = {'cwd': message.get('cwd') or os.path.dirname(script),
+                'draft': message.get('draft'),
+                'backend': message.get('backend', 'moviepy')}
+        options.update(self.options)
+
+        job['options'] = options
+        self.table[job_id] = job
+        heapq.heappush(self.queue, (-job['priority'], job_id))
+
+        self._forget()
+
+        return self._public(job)
+
+    def cancel(self, job_id):
+        """ Cancel a queued or running job and return it. """
+        job = self.table.get(job_id)
+
+        if job is None:
+            raise Exception("Unknown job %s" % job_id)
+
+        if job['state'] == 'queued':
+            self.queue.remove((-job['priority'], job_id))
+            heapq.heapify(self.queue)
+            self._finish(job, {'state': 'cancelled'})
+
+        elif job['state'] == 'running':
+            self._kill(job_id)
+            self._finish(job, {'state': 'cancelled'})
+
+        return self._public(job)
+
+    def _accept(self, server):
+        """ Accept a new connection. """
+        conn = server.accept()[0]
+        conn.setblocking(False)
+
+        self.clients[conn] = {'data': b'', 'response': None,
+                'deadline': time.time() + REQUEST_TIMEOUT}
+
+    def _receive(self, conn):
+        """ Read what a connection sent and answer the request once it is
+            complete.
+        """
+        state = self.clients[conn]
+
+        try:
+            chunk = conn.recv(65536)
+
+        except socket.error as e:
+            if e.errno not in [errno.EAGAIN, errno.EWOULDBLOCK]:
+                self._drop(conn)
+
+            return
+
+        if not chunk and not state['data']:
+            # The client went away, nothing to answer
+            self._drop(conn)
+            return
+
+        state['data'] += chunk
+
+        if chunk and not state['data'].endswith(b'\n'):
+            return
+
+        try:
+            response = self.handle(json.loads(state['data'].decode('utf-8')))
+            response['ok'] = True
+
+        except Exception as e:
+            response = {'ok': False, 'error': str(e)}
+
+        state['response'] = json.dumps(response).encode('utf-8') + b'\n'
+
+    def _send(self, conn):
+        """ Write as much of the response of a connection as possible, and
+            close it once it is all sent.
+        """
+        state = self.clients[conn]
+
+        try:
+            sent = conn.send(state['response'])
+
+        except socket.error as e:
+            if e.errno not in [errno.EAGAIN, errno.EWOULDBLOCK]:
+                self._drop(conn)
+
+            return
+
+        state['response'] = state['response'][sent:]
+
+        if not state['response']:
+            self._drop(conn)
+
+    def _expire(self):
+        """ Close the connections that took too long to send their request
+            or read the response.
+        """
+        now = time.time()
+
+        for conn, state in list(self.clients.items()):
+            if state['deadline'] < now:
+                self._drop(conn)
+
+    def _drop(self, conn):
+        """ Close a connection and forget it. """
+        del self.clients[conn]
+        conn.close()
+
+    def _collect(self):
+        """ Update the jobs with the messages of their processes. """
+        for job_id, (proc, conn) in list(self.running.items()):
+            job = self.table[job_id]
+
+            try:
+                while conn.poll():
+                    update = conn.recv()
+
+                    if update.get('state') in FINISHED:
+                        del self.running[job_id]
+                        conn.close()
+                        proc.join()
+                        self._finish(job, update)
+                        break
+
+                    job.update(update)
+
+            except (EOFError, IOError):
+                # Died without reporting
+                del self.running[job_id]
+                conn.close()
+                proc.join()
+                self._finish(job, {'state': 'failed',
+                    'error': "Process exited with code %s" % proc.exitcode})
+
+    def _kill(self, job_id):
+        """ Stop a running job and every process started by it. """
+        proc, conn = self.running.pop(job_id)
+        conn.close()
+
+        try:
+            os.killpg(proc.pid, signal.SIGTERM)
+
+        except OSError:
+            # Not in its own group yet
+            proc.terminate()
+
+        proc.join(KILL_TIMEOUT)
+
+        try:
+            # Whatever is left, like encoders still finishing their files
+            os.killpg(proc.pid, signal.SIGKILL)
+
+        except OSError:
+            pass
+
+        proc.join()
+
+    def _finish(self, job, update):
+        """ Mark a job as finished and print its result. """
+        job.update(update)
+        job['finished'] = time.time()
+
+        if job['started'] is not None:
+            job['elapsed'] = job['finished'] - job['started']
+
+        if job['inline']:
+            try:
+                os.remove(job['script'])
+
+            except OSError:
+                pass
+
+        print("[%s] job %d %s%s%s" % (job['state'], job['id'], job['script'],
+            " (%.1fs)" % job['elapsed'] if job['elapsed'] is not None else '',
+            ": " + job['error'] if job['error'] else ''))
+
+    def _forget(self):
+        """ Drop the oldest finished jobs beyond the history limit. """
+        finished = [i for i in sorted(self.table)
+                if self.table[i]['state'] in FINISHED]
+
+        for job_id in finished[:max(0, len(finished) - HISTORY)]:
+            del self.table[job_id]
+
+    def _job(self, job_id):
+        """ Return the public view of a job by id. """
+        if job_id not in self.table:
+            raise Exception("Unknown job %s" % job_id)
+
+        return self._public(self.table[job_id])
+
+    def _listen(self):
+        """ Bind the socket, replacing the one of a daemon that died. """
+        directory = os.path.dirname(os.path.abspath(self.path))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        if os.path.exists(self.path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+            try:
+                probe.connect(self.path)
+                raise Exception("A daemon is already listening on %s"
+                        % self.path)
+
+            except socket.error as e:
+                if e.errno not in [errno.ECONNREFUSED, errno.ENOENT]:
+                    raise
+
+                os.remove(self.path)
+
+            finally:
+                probe.close()
+
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self.path)
+        server.listen(64)
+
+        return server
+
+    def _public(self, job):
+        """ Return a copy of a job without the internal fields. """
+        result = dict(job)
+        del result['options']
+
+        if job['state'] == 'running':
+            result['elapsed'] = time.time() - job['started']
+
+        return result
+
+    def _schedule(self):
+        """ Start the queued jobs with the highest priority. """
+        while self.queue and len(self.running) < self.jobs:
+            job_id = heapq.heappop(self.queue)[1]
+            job = self.table[job_id]
+
+            conn, child = multiprocessing.Pipe(False)
+            proc = multiprocessing.Process(target=_run_job,
+                    args=(job_id, job['script'], job['options'], child))
+            proc.start()
+            # Only the job writes to it, so that the end is noticed if it dies
+            child.close()
+
+            try:
+                # Also done by the job, whichever runs first
+                os.setpgid(proc.pid, proc.pid)
+
+            except OSError:
+                pass
+
+            job['state'] = 'running'
+            job['started'] = time.time()
+            job['wait'] = job['started'] - job['submitted']
+            self.running[job_id] = (proc, conn)
+
+
+class _Progress(Profiler):
+    """ Profiler that reports the operations of a job to the daemon.
+
+        Only operations are timed, frames are left alone.
+    """
+
+    def __init__(self, job_id, conn):
+        Profiler.__init__(self)
+        self.job_id = job_id
+        self.conn = conn
+        self.total = None
+
+    def begin(self, node, op):
+        Profiler.begin(self, node, op)
+
+        self.conn.send({'operation': describe(op),
+            'done': len(self.stats) - 1, 'total': self.total})
+
+    def instrument(self, node, clip):
+        pass
+
+    def summary(self):
+        return "Job %d: %d operations performed" % (self.job_id,
+                len(self.stats))
+
+
+def request(message, path=DEFAULT_SOCKET):
+    """ Send a request to a daemon and return its response.
+
+        message - dict with the command and its arguments, see
+            Daemon.handle()
+        path    - path of the socket of the daemon
+
+        Raises an exception with the error reported by the daemon, if any.
+    """
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+    try:
+        conn.connect(path)
+        conn.sendall(json.dumps(message).encode('utf-8') + b'\n')
+
+        data = b''
+        while True:
+            chunk = conn.recv(65536)
+
+            if not chunk:
+                break
+
+            data += chunk
+
+    finally:
+        conn.close()
+
+    response = json.loads(data.decode('utf-8'))
+
+    if not response.pop('ok'):
+        raise Exception(response['error'])
+
+    return response
+
+def submit(script=None, text=None, priority=0, draft=None,
+        backend='moviepy', path=DEFAULT_SOCKET):
+    """ Submit a script to a daemon and return the queued job.
+
+        script   - path to the script file
+        text     - contents of an inline script, instead of a file. Its
+            relative paths are resolved from the current directory
+        priority - jobs with higher priority are rendered first
+        draft    - optional scale factor to render previews instead
+        backend  - backend used to render the exports
+        path     - path of the socket of the daemon
+    """
+    message = {'command': 'submit', 'priority': priority, 'draft': draft,
+            'backend': backend, 'cwd': os.getcwd()}
+
+    if text is not None:
+        message['text'] = text
+
+    else:
+        message['script'] = os.path.abspath(script)
+
+    return request(message, path)['job']
+
+def wait(job_ids, path=DEFAULT_SOCKET, callback=None):
+    """ Wait for some jobs of a daemon to finish.
+
+        job_ids  - ids of the jobs
+        path     - path of the socket of the daemon
+        callback - optional function called with each job whenever its
+            state or operation changes
+
+        Returns the finished jobs, in the same order.
+    """
+    jobs = {}
+    seen = {}
+
+    while len(jobs) < len(job_ids):
+        for job_id in job_ids:
+            if job_id in jobs:
+                continue
+
+            job = request({'command': 'status', 'job': job_id}, path)['job']
+            key = (job['state'], job['operation'])
+
+            if callback and seen.get(job_id) != key:
+                callback(job)
+
+            seen[job_id] = key
+
+            if job['state'] in FINISHED:
+                jobs[job_id] = job
+
+        if len(jobs) < len(job_ids):
+            time.sleep(POLL_INTERVAL)
+
+    return [jobs[i] for i in job_ids]
+
+def _run_job(job_id, script, options, conn):
+    """ Render a script in a worker process and report the result. """
+    from vidmaster.workbench import start_workbench
+
+    # Its own group, so that cancelling it reaches the processes it starts
+    os.setpgid(0, 0)
+
+    result = {'state': 'ok', 'error': None}
+    progress = _Progress(job_id, conn)
+
+    try:
+        os.chdir(options['cwd'])
+
+        workbench = start_workbench(script, options['draft'],
+                options['op_cache'])
+        workbench.backend = options['backend']
+        workbench.profiler = progress
+        progress.total = len(workbench.plan())
+
+        if options['cache_dir']:
+            workbench.cache = ClipCache(options['cache_dir'],
+                    options['cache_size'])
+
+        workbench.build()
+        result['exports'] = [op.out for op in workbench.ops
+                if type(op) == OpExport]
+
+    except Exception as e:
+        result['state'] = 'failed'
+        result['error'] = str(e)
+        result['traceback'] = traceback.format_exc()
+
+    result['operation'] = None
+    result['done'] = len(progress.stats)
+    result['operations'] = [{'operation': s.description, 'wall': s.wall}
+            for _, s in sorted(progress.stats.items())]
+
+    conn.send(result)
+    conn.close()
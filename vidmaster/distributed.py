@@ -0,0 +1,632 @@
+# -*- coding: utf-8 -*-
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 Rafael Medina García
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+from vidmaster.ffmpeg import concat_files
+from vidmaster.planner import Graph
+from vidmaster.profiler import Profiler
+from vidmaster.segments import render_segment, split_timeline, write_audio
+from vidmaster.streamcopy import find_pieces
+
+import json
+import multiprocessing
+import os
+import shutil
+import socket
+import threading
+import time
+
+# Seconds a worker keeps a job without renewing its lease. Workers renew
+# it every third of this, the clocks of the nodes must agree within it
+LEASE = 60
+# Seconds between two checks of the queue
+POLL_INTERVAL = 0.5
+# Number of times a job is tried before giving up
+MAX_ATTEMPTS = 3
+STATES = ['pending', 'claimed', 'done', 'failed', 'work']
+
+
+class WorkQueue(object):
+    """ Queue of render jobs kept in a shared directory.
+
+        Each job is a JSON file that moves between the 'pending',
+        'claimed', 'done' and 'failed' subdirectories. Moves are atomic
+        renames, so no broker or lock is needed as long as every node
+        sees the directory through the same filesystem: when several
+        processes try to move the same file, only one of them succeeds.
+
+        Claimed jobs are named after the worker that holds them, which
+        renews the lease by touching the file. Jobs whose lease expires
+        are moved back to 'pending' by whoever notices first.
+    """
+
+    def __init__(self, directory):
+        """ Open (or create) a queue.
+
+            directory - shared directory of the queue
+        """
+        self.directory = os.path.abspath(directory)
+
+        for state in STATES:
+            path = os.path.join(self.directory, state)
+
+            if not os.path.isdir(path):
+                try:
+                    os.makedirs(path)
+
+                except OSError:
+                    # Created by another process meanwhile
+                    if not os.path.isdir(path):
+                        raise
+
+    def path(self, state, name):
+        """ Return the path of a file in one of the subdirectories. """
+        return os.path.join(self.directory, state, name)
+
+    def publish(self, job):
+        """ Add a job, a dict with a unique 'id', to the queue. """
+        job.setdefault('attempts', 0)
+        job.setdefault('error', None)
+
+        self._write('pending', job['id'] + '.json', job)
+
+    def claim(self, worker):
+        """ Take the oldest pending job for a worker.
+
+            Returns the job, or None if there are no pending jobs.
+        """
+        for name in sorted(os.listdir(self.path('pending', ''))):
+            if not name.endswith('.json'):
+                continue
+
+            claimed = self.path('claimed', '%s@%s' % (name[:-5], worker))
+
+            try:
+                os.rename(self.path('pending', name), claimed)
+
+            except OSError:
+                # Claimed by another worker first
+                continue
+
+            # The lease starts now, not when the job was published
+            os.utime(claimed, None)
+
+            with open(claimed, 'r') as f:
+                return json.load(f)
+
+        return None
+
+    def renew(self, job, worker):
+        """ Extend the lease of a claimed job.
+
+            Returns False if the lease was lost.
+        """
+        try:
+            os.utime(self.path('claimed', '%s@%s' % (job['id'], worker)),
+                    None)
+
+        except OSError:
+            return False
+
+        return True
+
+    def complete(self, job, worker, files=None):
+        """ Mark a claimed job as done.
+
+            files - optional dict with the destination of the files
+                rendered by the job, by their temporary path. They are
+                moved into place only if the job is still claimed
+
+            Returns False if the lease was lost, in which case the job is
+            performed (or was already) by another worker.
+        """
+        claimed = self.path('claimed', '%s@%s' % (job['id'], worker))
+        # Out of 'claimed', so that the lease cannot expire meanwhile
+        moving = self.path('work', '%s@%s.complete' % (job['id'], worker))
+
+        try:
+            os.rename(claimed, moving)
+
+        except OSError:
+            return False
+
+        try:
+            for tmp, path in sorted((files or {}).items()):
+                shutil.move(tmp, path)
+
+        except Exception:
+            # Given back to the worker, which fails it
+            os.rename(moving, claimed)
+            raise
+
+        os.rename(moving, self.path('done', job['id'] + '.json'))
+
+        return True
+
+    def fail(self, job, worker, error):
+        """ Give a claimed job back after an error.
+
+            The job is tried again by any worker, up to MAX_ATTEMPTS times.
+        """
+        self._release('%s@%s' % (job['id'], worker), error)
+
+    def expire(self, lease=LEASE):
+        """ Give back the claimed jobs whose lease expired.
+
+            Returns the number of jobs given back.
+        """
+        count = 0
+        now = time.time()
+
+        for name in os.listdir(self.path('claimed', '')):
+            try:
+                age = now - os.path.getmtime(self.path('claimed', name))
+
+            except OSError:
+                continue
+
+            if age > lease and self._release(name, "Lease of worker %s "
+                    "expired" % name.split('@', 1)[1]):
+                count += 1
+
+        return count
+
+    def state(self, job_id):
+        """ Return the state of a job and the job as last saved.
+
+            Jobs that are being moved may not be found, (None, None) is
+            returned then.
+        """
+        for state in ['done', 'failed', 'pending']:
+            path = self.path(state, job_id + '.json')
+
+            if os.path.isfile(path):
+                try:
+                    with open(path, 'r') as f:
+                        return state, json.load(f)
+
+                except (IOError, ValueError):
+                    return None, None
+
+        for name in os.listdir(self.path('claimed', '')):
+            if name.split('@', 1)[0] == job_id:
+                return 'claimed', None
+
+        return None, None
+
+    def remove(self, job_id):
+        """ Forget a finished job. """
+        for state in ['done', 'failed']:
+            path = self.path(state, job_id + '.json')
+
+            if os.path.isfile(path):
+                os.remove(path)
+
+    def _release(self, name, error):
+        """ Move a claimed job back to pending, or to failed.
+
+            Returns False if the job was not claimed under that name.
+        """
+        # Whoever moves it out of 'claimed' first releases it
+        moving = self.path('work', name + '.release')
+
+        try:
+            os.rename(self.path('claimed', name), moving)
+
+        except OSError:
+            return False
+
+        with open(moving, 'r') as f:
+            job = json.load(f)
+
+        job['attempts'] += 1
+        job['error'] = error
+
+        self._write('pending' if job['attempts'] < MAX_ATTEMPTS else 'failed',
+                job['id'] + '.json', job)
+        os.remove(moving)
+
+        return True
+
+    def _write(self, state, name, job):
+        """ Atomically write a job file. """
+        tmp = self.path('work', '%s.%s.%d' % (name, socket.gethostname(),
+            os.getpid()))
+
+        with open(tmp, 'w') as f:
+            json.dump(job, f)
+
+        os.rename(tmp, self.path(state, name))
+
+
+class Worker(object):
+    """ Performs the jobs of a queue, on any node that can see it. """
+
+    def __init__(self, queue, name=None, lease=LEASE, cache=None):
+        """ Create a worker.
+
+            queue - WorkQueue to take the jobs from
+            name  - unique name of the worker, defaults to the host name
+                and process id
+            lease - seconds a job is kept without renewing its lease
+            cache - optional ClipCache for the intermediate clips
+        """
+        self.queue = queue
+        self.name = name or '%s.%d' % (socket.gethostname(), os.getpid())
+        self.lease = lease
+        self.cache = cache
+
+    def run(self, stop=None):
+        """ Perform jobs until the stop event, if any, is set. """
+        while stop is None or not stop.is_set():
+            self.queue.expire(self.lease)
+            job = self.queue.claim(self.name)
+
+            if job is None:
+                time.sleep(POLL_INTERVAL)
+                continue
+
+            self.perform(job)
+
+    def perform(self, job):
+        """ Perform a claimed job, renewing its lease meanwhile.
+
+            The job is abandoned as soon as its lease is lost.
+        """
+        done = threading.Event()
+        lost = threading.Event()
+
+        def heartbeat():
+            while not done.wait(self.lease / 3.0):
+                if not self.queue.renew(job, self.name):
+                    lost.set()
+                    break
+
+        thread = threading.Thread(target=heartbeat)
+        thread.daemon = True
+        thread.start()
+
+        started = time.time()
+
+        try:
+            files = self._render(job, _Lease(job['id'], lost))
+
+        except Exception as e:
+            if lost.is_set():
+                print("[lost] %s (%.1fs)" % (job['id'],
+                    time.time() - started))
+
+            else:
+                print("[failed] %s: %s" % (job['id'], e))
+                self.queue.fail(job, self.name, str(e))
+
+            return
+
+        finally:
+            done.set()
+            thread.join()
+
+        try:
+            completed = self.queue.complete(job, self.name, files)
+
+        except Exception as e:
+            print("[failed] %s: %s" % (job['id'], e))
+            self.queue.fail(job, self.name, str(e))
+            return
+
+        finally:
+            # Left when the lease was lost
+            for path in files:
+                if os.path.exists(path):
+                    os.remove(path)
+
+        status = 'ok' if completed else 'lost'
+        print("[%s] %s (%.1fs)" % (status, job['id'], time.time() - started))
+
+    def _render(self, job, lease):
+        """ Rebuild the workbench of a job and render its part.
+
+            job   - claimed job
+            lease - _Lease that aborts the render once the lease is lost
+
+            Returns a dict with the destination of the files rendered, by
+            their temporary path (see WorkQueue.complete()).
+        """
+        # Imported here to avoid a circular import
+        from vidmaster.workbench import start_workbench
+
+        workbench = start_workbench(job['script'], job['draft'])
+
+        if job['kind'] == 'segment':
+            node = job['node']
+            op = workbench.ops[node]
+            path = self.queue.path('work', job['path'])
+            partial = self.queue.path('work', '%s.%s%s' % (job['id'],
+                self.name, os.path.splitext(path)[1]))
+
+            workbench.prepare(node)
+            lease.instrument(node, workbench.clips[op.clip])
+            render_segment(workbench.clips[op.clip], op, job['start'],
+                    job['end'], partial)
+
+            # The same segment rendered twice has the same contents
+            os.rename(partial, path)
+
+            return {}
+
+        # Rendered aside, so that a worker that lost the job cannot
+        # overwrite the exports of the one that took it
+        files = {}
+        for node in job['exports']:
+            op = workbench.ops[node]
+            tmp = self.queue.path('work', '%s.%s.%d%s' % (job['id'],
+                self.name, node, os.path.splitext(op.out)[1]))
+
+            files[tmp] = op.out
+            op.out = tmp
+
+        workbench.backend = job['backend']
+        workbench.cache = self.cache
+        workbench.profiler = lease
+
+        try:
+            workbench.build(job['exports'])
+
+        except Exception:
+            for tmp in files:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+
+            raise
+
+        return files
+
+
+class Coordinator(object):
+    """ Splits the exports of a script into jobs of a queue.
+
+        Exports rendered in several segments become a job per segment,
+        which are joined by the coordinator when every segment is done.
+        The rest of exports become a job per group of renditions (see
+        Graph.renditions()), rendered by the worker to the queue and moved
+        into place when the job is done.
+
+        Workers rebuild the workbench from a copy of the script in the
+        queue, so every path in the script must be absolute and valid on
+        every node.
+    """
+
+    def __init__(self, script, queue, draft=None, backend='moviepy',
+            lease=LEASE):
+        """ Create a coordinator.
+
+            script  - path to the script file
+            queue   - WorkQueue to publish the jobs to
+            draft   - optional scale factor to render previews instead
+            backend - backend used to render the exports
+            lease   - seconds a job is kept by a worker without renewing
+                its lease
+        """
+        self.script = script
+        self.queue = queue
+        self.draft = draft
+        self.backend = backend
+        self.lease = lease
+
+        self.run_id = '%d.%s.%d' % (time.time() * 1000,
+                socket.gethostname(), os.getpid())
+        self.count = 0
+
+    def run(self, workers=0):
+        """ Render the script through the queue.
+
+            workers - number of worker processes to start on this machine,
+                besides any others using the queue
+
+            Raises an exception if a job fails MAX_ATTEMPTS times.
+        """
+        from vidmaster.workbench import start_workbench
+
+        script = self.queue.path('work', self.run_id + '.txt')
+        shutil.copyfile(self.script, script)
+
+        workbench = start_workbench(script, self.draft)
+
+        stop = multiprocessing.Event()
+        procs = []
+
+        for i in range(workers):
+            worker = Worker(self.queue, '%s.local%d' % (self.run_id, i),
+                    self.lease)
+
+            procs.append(multiprocessing.Process(target=worker.run,
+                args=(stop,)))
+            procs[-1].start()
+
+        try:
+            jobs, segmented = self._publish(workbench, script)
+            print("Published %d jobs to %s" % (len(jobs),
+                self.queue.directory))
+
+            # The audio of the segmented exports is rendered meanwhile
+            audio = {}
+            for node in segmented:
+                clip = workbench.clips[workbench.ops[node].clip]
+
+                if clip.audio is not None:
+                    audio[node] = write_audio(clip, workbench.ops[node],
+                            self.queue.path('work', '%s.%d' % (
+                                self.run_id, node)))
+
+            self._wait(jobs)
+
+            for node, paths in segmented.items():
+                concat_files(paths, workbench.ops[node].out, audio.get(node))
+
+        finally:
+            stop.set()
+
+            for proc in procs:
+                proc.join()
+
+            self._clean(script)
+
+    def _clean(self, script):
+        """ Remove the files of this run from the queue.
+
+            Jobs still pending or claimed, after a failure, are withdrawn
+            too, and the workers performing them give up.
+        """
+        os.remove(script)
+
+        for state in ['pending', 'claimed', 'done', 'failed', 'work']:
+            for name in os.listdir(self.queue.path(state, '')):
+                path = self.queue.path(state, name)
+
+                # Including the '.<name>.parts' checkpoints of resumable
+                # exports rendered to the queue
+                if not name.lstrip('.').startswith(self.run_id + '.'):
+                    continue
+
+                if os.path.isdir(path):
+                    shutil.rmtree(path, ignore_errors=True)
+
+                else:
+                    try:
+                        os.remove(path)
+
+                    except OSError:
+                        # Claimed meanwhile
+                        pass
+
+    def _publish(self, workbench, script):
+        """ Publish the jobs of a workbench.
+
+            Returns the list of job ids and a dict with the ordered paths
+            of the segments of each segmented export.
+        """
+        graph = Graph(workbench.ops)
+        groups = graph.renditions(graph.prune())
+        jobs = []
+        segmented = {}
+
+        for node, group in sorted(groups.items()):
+            op = workbench.ops[node]
+
+            if not group:
+                continue
+
+            job = {'script': script, 'draft': self.draft,
+                    'backend': self.backend}
+
+            if (op.segments > 1 and not op.resumable
+                    and self.backend != 'ffmpeg'
+                    and not find_pieces(graph, node)):
+                workbench.prepare(node)
+                clip = workbench.clips[op.clip]
+
+                if clip.duration is None:
+                    raise Exception("Cannot split a clip without duration")
+
+                os.makedirs(self.queue.path('work', '%s.%d' % (self.run_id,
+                    node)))
+                segmented[node] = []
+
+                for i, (start, end) in enumerate(split_timeline(
+                        clip.duration, op.fps, op.segments)):
+                    path = '%s.%d/segment%05d%s' % (self.run_id, node, i,
+                            os.path.splitext(op.out)[1])
+
+                    jobs.append(self._job(job, kind='segment', node=node,
+                        start=start, end=end, path=path))
+                    segmented[node].append(self.queue.path('work', path))
+
+            else:
+                jobs.append(self._job(job, kind='exports', exports=group))
+
+        return jobs, segmented
+
+    def _job(self, base, **kwargs):
+        """ Publish a job and return its id. """
+        job = dict(base, **kwargs)
+        job['id'] = '%s.%04d' % (self.run_id, self.count)
+        self.count += 1
+
+        self.queue.publish(job)
+
+        return job['id']
+
+    def _wait(self, jobs):
+        """ Wait for some jobs to be done. """
+        pending = list(jobs)
+
+        while pending:
+            self.queue.expire(self.lease)
+
+            for job_id in list(pending):
+                state, job = self.queue.state(job_id)
+
+                if state == 'failed':
+                    raise Exception("Job %s failed %d times: %s" % (job_id,
+                        job['attempts'], job['error']))
+
+                elif state == 'done':
+                    self.queue.remove(job_id)
+                    pending.remove(job_id)
+
+            if pending:
+                time.sleep(POLL_INTERVAL)
+
+
+class _Lease(Profiler):
+    """ Profiler that aborts a job once its lease is lost.
+
+        Checked before each operation and each frame, nothing is timed.
+    """
+
+    def __init__(self, job_id, lost):
+        Profiler.__init__(self)
+        self.job_id = job_id
+        self.lost = lost
+
+    def begin(self, node, op):
+        self.check()
+        Profiler.begin(self, node, op)
+
+    def instrument(self, node, clip):
+        make_frame = clip.make_frame
+
+        def checked(t):
+            self.check()
+            return make_frame(t)
+
+        clip.make_frame = checked
+
+    def check(self):
+        """ Raise an exception if the lease was lost. """
+        if self.lost.is_set():
+            raise Exception("Lease of job %s lost" % self.job_id)
+
+    def summary(self):
+        return "Job %s: %d operations performed" % (self.job_id,
+                len(self.stats))
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 Rafael Medina García
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+from vidmaster.parser import OpDefine, OpEffect, OpMix, OpExport
+from vidmaster.seeking import initialize
+
+import os
+
+# Frame rate and preset of draft exports
+DRAFT_FPS = 12
+DRAFT_PRESET = 'ultrafast'
+
+
+def apply_draft(ops, scale):
+    """ Turn a list of operations into a low resolution preview.
+
+        ops   - operations parsed from a script, modified in place
+        scale - factor applied to every dimension (0 < scale <= 1)
+
+        Sources are decoded at the reduced size and every size, position
+        and margin is scaled by the same factor, so the layout is kept.
+        Sizes of exports are scaled too, so renditions stay drafts.
+        Exports are written next to the real ones with a '.draft' suffix,
+        at a lower frame rate and with the fastest preset.
+    """
+    if not 0 < scale <= 1:
+        raise Exception("Draft scale must be between 0 and 1")
+
+    for op in ops:
+        if type(op) == OpDefine:
+            op.scale = scale
+
+        elif type(op) == OpEffect:
+            if op.type == 'resize':
+                op.height = _scale(op.height, scale)
+                op.width = _scale(op.width, scale)
+
+            elif op.type == 'position':
+                op.x = _scale(op.x, scale)
+                op.y = _scale(op.y, scale)
+
+            elif op.type == 'margin' and op.size:
+                op.size = max(1, _scale(op.size, scale))
+
+        elif type(op) == OpMix and op.type == 'composition':
+            op.width, op.height = scaled_size((op.width, op.height), scale)
+
+        elif type(op) == OpExport:
+            op.out = draft_path(op.out)
+            op.fps = min(op.fps, DRAFT_FPS)
+            op.preset = DRAFT_PRESET
+            op.width = _scale_even(op.width, scale)
+            op.height = _scale_even(op.height, scale)
+
+def draft_path(path):
+    """ Return the path a draft of an export is written to. """
+    name, ext = os.path.splitext(path)
+
+    return name + '.draft' + ext
+
+def scale_video(clip, scale):
+    """ Make a video file clip decode its frames at a reduced size.
+
+        clip  - VideoFileClip to scale, modified in place
+        scale - factor applied to the width and height
+
+        FFMPEG does the scaling while decoding, so full size frames never
+        reach Python. The reader is changed, as the clip reads frames from
+        it directly, and must be reopened with initialize() from
+        vidmaster.seeking, as done by the Seeker serving it.
+    """
+    reader = clip.reader
+    reader.size = scaled_size(reader.size, scale)
+    reader.bufsize = reader.depth * reader.size[0] * reader.size[1] + 100
+
+    # Restart the decoder with the scaling filter
+    reader.filters = ['scale=%d:%d' % reader.size]
+    initialize(reader)
+    reader.pos = 1
+    reader.lastread = reader.read_frame()
+
+    clip.size = reader.size
+    if clip.mask is not None:
+        clip.mask.size = reader.size
+
+    return clip
+
+def scaled_size(size, scale):
+    """ Scale a (width, height) size, keeping both dimensions even. """
+    return tuple(max(2, int(round(d * scale / 2.0)) * 2) for d in size)
+
+def _scale(value, scale):
+    """ Scale a length, leaving missing values as they are. """
+    if value is None:
+        return None
+
+    return int(round(value * scale))
+
+def _scale_even(value, scale):
+    """ Scale a dimension of a video, keeping it even. """
+    if value is None:
+        return None
+
+    return max(2, int(round(value * scale / 2.0)) * 2)
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 Rafael Medina García
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+from moviepy.config import get_setting
+
+import os
+import subprocess
+import tempfile
+
+
+def concat_files(paths, out, audio=None):
+    """ Join several media files without re-encoding them.
+
+        paths - ordered list of files to join, they must share codec
+            and encoding parameters
+        out   - absolute path to the resulting file
+        audio - optional audio file to use as soundtrack of the result
+
+        Uses the concat demuxer of FFMPEG.
+    """
+    fd, listing = tempfile.mkstemp(suffix='.txt',
+            dir=os.path.dirname(os.path.abspath(out)))
+
+    try:
+        with os.fdopen(fd, 'w') as f:
+            for path in paths:
+                f.write("file '%s'\n" % _escape(os.path.abspath(path)))
+
+        args = ['-f', 'concat', '-safe', '0', '-i', listing]
+
+        if audio:
+            args += ['-i', audio, '-map', '0:v', '-map', '1:a']
+
+        args += ['-c', 'copy', out]
+
+        run_ffmpeg(args)
+
+    finally:
+        os.remove(listing)
+
+def run_ffmpeg(args):
+    """ Run FFMPEG with the given arguments, overwriting the output.
+
+        Raises an exception with the error output if FFMPEG fails.
+    """
+    cmd = [get_setting('FFMPEG_BINARY'), '-y', '-loglevel', 'error'] + args
+
+    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = proc.communicate()
+
+    if proc.returncode != 0:
+        raise Exception("FFMPEG failed: %s" % err.decode('utf-8', 'replace'))
+
+    return out
+
+def _escape(path):
+    """ Escape a path for a concat demuxer listing. """
+    return path.replace("'", "'\\''")
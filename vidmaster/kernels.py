@@ -0,0 +1,363 @@
+# -*- coding: utf-8 -*-
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 Rafael Medina García
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+from moviepy.video.VideoClip import ImageClip
+
+from fractions import Fraction
+import numpy as np
+
+try:
+    import cv2
+except ImportError:
+    cv2 = None
+
+# Output buffers each kernel writes to in turn, so a frame stays valid while
+# the next one is computed
+BUFFERS = 2
+# Largest period (in output pixels) of a sampling pattern computed with
+# strided views of the frame, longer ones gather the pixels instead
+MAX_PERIOD = 16
+# Largest difference (in 8-bit levels) between a frame resized with the
+# sampling tables and by OpenCV, as vfx.resize does when it is installed.
+# Checked by the 'kernels' benchmarks, margins are exact
+TOLERANCE = 1
+
+
+class Resize(object):
+    """ Resizes frames to a fixed size, reusing the output buffers.
+
+        Frames are resampled with the area filter of OpenCV: a box filter
+        when shrinking, and a blend of the two nearest pixels when
+        enlarging. OpenCV does it when installed, as MoviePy would.
+        Otherwise, the sampling tables of each axis are
+        built once for the size of the frames, as a list of terms that add
+        a weighted set of rows (or columns) of the input to a set of rows
+        of the output. When the ratio of the sizes is a simple fraction,
+        the sampling pattern repeats and each term is a strided view of
+        the frame with a single weight, so no pixel is gathered. Color
+        channels are handled as separate planes, so the innermost loops
+        run along the rows.
+
+        The tables give frames within TOLERANCE levels of OpenCV, which
+        only computes its weights with less precision. MoviePy uses the
+        Lanczos filter of PIL when OpenCV is not installed, which is
+        sharper, so frames differ from those of MoviePy in that case.
+    """
+
+    def __init__(self, size, ismask=False, tables=False):
+        """ Create the kernel.
+
+            size   - (width, height) of the resized frames
+            ismask - whether the frames are masks, with values from 0 to 1
+            tables - whether to use the sampling tables even if OpenCV is
+                installed, to compare them with it
+        """
+        self.size = tuple(size)
+        self.ismask = ismask
+        self.tables = tables
+        self.shape = None
+        self.dtype = None
+
+    def __call__(self, frame):
+        """ Return the resized frame, in a buffer reused by later calls.
+
+            Frames are returned as uint8, or as floats for masks.
+        """
+        if frame.shape[1::-1] == self.size:
+            return frame
+
+        if frame.shape != self.shape or frame.dtype != self.dtype:
+            self._prepare(frame)
+
+        out = self.outputs[self.turn]
+        self.turn = (self.turn + 1) % len(self.outputs)
+
+        if self.passes is None:
+            return cv2.resize(np.ascontiguousarray(frame), self.size,
+                    dst=out, interpolation=cv2.INTER_AREA)
+
+        src = _planes(frame)
+        for axis, terms, acc, scratch in self.passes:
+            _resample(src, acc, axis, terms, scratch)
+            src = acc
+
+        if out.dtype == np.uint8:
+            np.add(src, 0.5, out=src)
+
+        np.copyto(_planes(out), src, casting='unsafe')
+
+        return out
+
+    def _prepare(self, frame):
+        """ Build the tables and buffers for frames of a shape. """
+        h, w = frame.shape[:2]
+        nw, nh = self.size
+
+        dtype = np.dtype('uint8')
+        if self.ismask:
+            dtype = frame.dtype if frame.dtype.kind == 'f' else np.float32
+
+        self.outputs = [np.empty((nh, nw) + frame.shape[2:], dtype)
+                for _ in range(BUFFERS)]
+
+        self.shape = frame.shape
+        self.dtype = frame.dtype
+        self.turn = 0
+        self.passes = None
+
+        if cv2 is not None and frame.dtype == dtype and not self.tables:
+            return
+
+        channels = frame.shape[2] if frame.ndim == 3 else 1
+
+        # Same as OpenCV, which only averages areas when both axes shrink
+        area = nw <= w and nh <= h
+        rows = (1, _terms(h, nh, 1, area))
+        cols = (2, _terms(w, nw, 2, area))
+
+        # The first pass works on the full size of the other axis
+        if nh * w <= h * nw:
+            order = [rows, cols]
+            middle = (channels, nh, w)
+
+        else:
+            order = [cols, rows]
+            middle = (channels, h, nw)
+
+        self.passes = []
+        for (axis, terms), shape in zip(order, [middle, (channels, nh, nw)]):
+            self.passes.append((axis, terms, np.empty(shape, 'float32'),
+                np.empty(shape, 'float32')))
+
+
+class Margin(object):
+    """ Adds a margin around frames, reusing prefilled canvases.
+
+        The margin of the canvases is filled once, so each frame only
+        takes a copy of the frame into their center.
+    """
+
+    def __init__(self, size, fill):
+        """ Create the kernel.
+
+            size - width of the margin in pixels
+            fill - color (or mask value) of the margin
+        """
+        self.size = size
+        self.fill = fill
+        self.shape = None
+
+    def __call__(self, frame):
+        """ Return the frame with the margin, in a buffer reused by later
+            calls.
+        """
+        if frame.shape != self.shape or frame.dtype != self.canvases[0].dtype:
+            h, w = frame.shape[:2]
+            shape = (h + 2 * self.size, w + 2 * self.size) + frame.shape[2:]
+
+            self.canvases = []
+            for _ in range(BUFFERS):
+                canvas = np.empty(shape, frame.dtype)
+                canvas[...] = self.fill
+                self.canvases.append(canvas)
+
+            self.shape = frame.shape
+            self.turn = 0
+
+        canvas = self.canvases[self.turn]
+        self.turn = (self.turn + 1) % len(self.canvases)
+
+        m = self.size
+        canvas[m:m + frame.shape[0], m:m + frame.shape[1]] = frame
+
+        return canvas
+
+
+def margin(clip, size, color=None, opacity=None):
+    """ Add a margin to a clip, same as vfx.margin.
+
+        clip    - clip to apply the margin to
+        size    - width of the margin in pixels
+        color   - (red, green, blue) color of the margin, black by default
+        opacity - opacity of the margin (0-1), opaque by default
+
+        Clips get a mask if the margin is not opaque.
+    """
+    opacity = 1 if opacity is None else opacity
+
+    if opacity != 1 and clip.mask is None and not clip.ismask:
+        clip = clip.add_mask()
+
+    if clip.ismask:
+        fill = opacity
+
+    else:
+        fill = [c or 0 for c in color or (0, 0, 0)]
+
+    result = _apply(clip, Margin(size, fill))
+
+    if clip.mask is not None:
+        result.mask = margin(clip.mask, size, opacity=opacity)
+
+    return result
+
+def resize(clip, size):
+    """ Resize a clip and its mask, same as vfx.resize.
+
+        clip - clip to resize
+        size - (width, height) of the resulting clip
+    """
+    result = _apply(clip, Resize(size, clip.ismask))
+
+    if clip.mask is not None:
+        result.mask = resize(clip.mask, size)
+
+    return result
+
+def _apply(clip, kernel):
+    """ Apply a kernel to the frames of a clip. """
+    if isinstance(clip, ImageClip):
+        # Images are transformed once and keep the result
+        return clip.fl_image(lambda pic: kernel(pic).copy())
+
+    return clip.fl_image(kernel)
+
+def _resample(src, dst, axis, terms, scratch):
+    """ Resample an axis of a set of planes using a list of terms. """
+    head = (slice(None),) * axis
+
+    for out, index, weight, first in terms:
+        if isinstance(index, slice):
+            view = src[head + (index,)]
+
+        else:
+            view = np.take(src, index, axis=axis)
+
+        target = dst[head + (out,)]
+
+        if first:
+            np.multiply(view, weight, out=target)
+
+        else:
+            part = scratch[head + (out,)]
+            np.multiply(view, weight, out=part)
+            np.add(target, part, out=target)
+
+def _planes(frame):
+    """ Return a (channels, height, width) view of a frame. """
+    if frame.ndim == 3:
+        return frame.transpose(2, 0, 1)
+
+    return frame[None]
+
+def _taps(n_in, n_out, area):
+    """ Return the source indices and weights of each output pixel.
+
+        n_in  - number of input pixels
+        n_out - number of output pixels
+        area  - whether to average the areas of the input pixels, when
+            the frame shrinks along both axes
+
+        Both are arrays of n_out rows, one column per tap.
+    """
+    scale = float(n_in) / n_out
+    out = np.arange(n_out)
+
+    if area:
+        # Box filter: overlap of each source pixel with the output one
+        taps = int(np.ceil(scale)) + 1
+        start = np.floor(out * scale).astype(int)
+        index = start[:, None] + np.arange(taps)[None, :]
+
+        lo = np.maximum(index, (out * scale)[:, None])
+        hi = np.minimum(index + 1, ((out + 1) * scale)[:, None])
+        weight = np.clip(hi - lo, 0, None)
+
+    else:
+        # Each output pixel takes the source pixel it starts in, and the
+        # next one for the part of the output pixel past its end
+        start = np.floor(out * scale).astype(int)
+        frac = (out + 1) - (start + 1) / scale
+        frac = np.where(frac <= 0, 0, frac - np.floor(frac))
+
+        index = np.stack([start, start + 1], 1)
+        weight = np.stack([1 - frac, frac], 1)
+
+    index = np.clip(index, 0, n_in - 1)
+    weight = weight / weight.sum(1, keepdims=True)
+    weight[weight < 1e-6] = 0
+
+    return index, weight
+
+def _terms(n_in, n_out, axis, area):
+    """ Return the terms that resample an axis of a frame.
+
+        Each term is an (output index, input index, weight, first) tuple,
+        first telling whether the term is the first one writing to its
+        outputs. See _taps() for the rest of arguments.
+    """
+    index, weight = _taps(n_in, n_out, area)
+    ratio = Fraction(n_in, n_out)
+    p, q = ratio.numerator, ratio.denominator
+
+    if q <= MAX_PERIOD:
+        terms = _periodic(index, weight, p, q)
+
+        if terms is not None:
+            return terms
+
+    # Gather the pixels of each tap, with a weight per output pixel
+    shape = [1] * 3
+    shape[axis] = n_out
+
+    return [(slice(None), index[:, k].copy(),
+        weight[:, k].astype('float32').reshape(shape), k == 0)
+        for k in range(index.shape[1])]
+
+def _periodic(index, weight, p, q):
+    """ Return the terms of a sampling pattern that repeats every q output
+        pixels (and p input pixels), or None if it does not.
+    """
+    n_out = len(index)
+    terms = []
+
+    for r in range(q):
+        first = True
+
+        for k in range(index.shape[1]):
+            idx = index[r::q, k]
+            w = weight[r::q, k]
+
+            if not w.any():
+                continue
+
+            # Irregular patterns, such as the edges when enlarging
+            if (w != w[0]).any() or (np.diff(idx) != p).any():
+                return None
+
+            terms.append((slice(r, n_out, q),
+                slice(idx[0], idx[-1] + 1, p), float(w[0]), first))
+            first = False
+
+    return terms
@@ -21,14 +21,19 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import json
+import os
 import re
 
 # REGEX_VAR = re.compile('(\w+)\s*=\s*(\w+)')
 REGEX_VAR = re.compile('(\w+)\s*=\s*([a-zA-Z0-9_\/.:\s]+)')
-BOOL_VARS = ['hasaudio']
+BOOL_VARS = ['hasaudio', 'streamcopy', 'resumable']
 INT_VARS = ['duration', 'height', 'width', 'x', 'y', 'size', 'opacity',
-    'red', 'green', 'blue', 'fps', 'threads']
+    'red', 'green', 'blue', 'fps', 'threads', 'segments']
 TIME_VARS = ['start', 'end']
+# Changing the operation classes or the syntax requires a new version, so
+# that compiled scripts are parsed again
+PARSER_VERSION = 4
 
 
 class OpDefine(object):
@@ -48,6 +53,9 @@ class OpDefine(object):
                     of another video clip
 
                 Priority is given to the duration parameter.
+
+            scale    - (for video and image) factor to shrink the source
+                by when loading it, used by draft previews (default 1)
         """
         self.name = kwargs['name']
         self.type = kwargs['type']
@@ -58,6 +66,8 @@ class OpDefine(object):
         self.duration = kwargs.get('duration', None)
         self.duration_from = kwargs.get('duration_from', None)
 
+        self.scale = kwargs.get('scale', 1)
+
 
 class OpEffect(object):
     """ Apply effects to clips. """
@@ -145,6 +155,23 @@ class OpExport(object):
                 ultrafast, superfast, fast, medium, slow, superslow.
             threads - number of threads to use for ffmpeg
             params  - additional params for FFMPEG
+            segments - number of time segments to render in parallel
+                processes (1 renders the whole clip in this process)
+            streamcopy - whether to copy the source streams instead of
+                re-encoding when the clip is only made of cuts and
+                concatenations of compatible videos, and they can be
+                copied frame accurately (default 1)
+            engine  - moviepy (default) to let MoviePy write the file, or
+                pipeline to decode, compose and encode concurrently
+            resumable - whether to render through checkpoints kept next to
+                the output, so that an interrupted export resumes where
+                it stopped when run again (default 0)
+            height  - height to scale the video to when encoding
+            width   - width to scale the video to when encoding. If only
+                one of them is given, the aspect ratio is kept
+
+            Exports of the same clip at the same fps are renditions of it:
+            they are written at once, composing each frame a single time.
         """
         self.clip = kwargs['clip']
         self.out = kwargs['out']
@@ -153,6 +180,12 @@ class OpExport(object):
         self.preset = kwargs.get('preset', 'medium')
         self.threads = kwargs.get('threads', None)
         self.params = kwargs.get('params', "").split()
+        self.segments = kwargs.get('segments', 1)
+        self.streamcopy = kwargs.get('streamcopy', True)
+        self.engine = kwargs.get('engine', 'moviepy')
+        self.resumable = kwargs.get('resumable', False)
+        self.height = kwargs.get('height', None)
+        self.width = kwargs.get('width', None)
 
 
 class OpSubclip(object):
@@ -175,6 +208,11 @@ class OpSubclip(object):
         self.out = kwargs['out']
 
 
+# Operation classes by name, for compiled scripts
+OPERATIONS = dict((cls.__name__, cls) for cls in [OpDefine, OpEffect, OpMix,
+    OpExport, OpSubclip])
+
+
 def get_val(var, val):
     """ Return the appropriate value for a given variable.
 
@@ -203,6 +241,10 @@ def get_val(var, val):
     # Regular string
     return val
 
+def get_seconds(t):
+    """ Return the number of seconds of a parsed timestamp. """
+    return t[0] * 3600 + t[1] * 60 + t[2]
+
 def fill_dict(lines):
     """ Return a dict that can be used as parameter for the operation
         objects.
@@ -214,20 +256,29 @@ def fill_dict(lines):
         if not line or line.startswith('//'):
             continue
 
-        match = REGEX_VAR.match(line).groups()
-        kwargs[match[0]] = get_val(*match)
+        match = REGEX_VAR.match(line)
+
+        if match is None:
+            raise Exception("Invalid line '%s'" % line)
+
+        kwargs[match.group(1)] = get_val(*match.groups())
 
     return kwargs
 
 def parse_block(lines):
     """ Parse a given block of code.
 
-        lines - information stored within the block
+        lines - information stored within the block, including the '#do'
+            and '#end' lines
     """
-    # Remove first and list lines of the block
-    btype = lines.pop(0).lstrip('#do').strip()
-    lines.pop(-1)
+    return parse_body(lines[0][3:].strip(), lines[1:-1])
 
+def parse_body(btype, lines):
+    """ Parse the contents of a block.
+
+        btype - type of the block, as written after '#do'
+        lines - lines between the '#do' and '#end' lines
+    """
     if btype == 'define':
         return parse_define(lines)
 
@@ -243,6 +294,8 @@ def parse_block(lines):
     elif btype == 'subclip':
         return parse_subclip(lines)
 
+    raise Exception("Unknown block type '%s'" % btype)
+
 def parse_define(lines):
     """ Parse a clip definition.
 
@@ -283,6 +336,149 @@ def parse_mix(lines, btype):
 
     return OpMix(**kwargs)
 
+def dump_op(op):
+    """ Return an operation as a JSON serializable dict. """
+    return {'type': type(op).__name__, 'vars': vars(op)}
+
+def load_op(data):
+    """ Return the operation of a dict made by dump_op(). """
+    if data['type'] not in OPERATIONS:
+        raise Exception("Unknown operation '%s'" % data['type'])
+
+    op = OPERATIONS[data['type']].__new__(OPERATIONS[data['type']])
+    op.__dict__.update(data['vars'])
+
+    # JSON has no tuples
+    for var in TIME_VARS:
+        if getattr(op, var, None) is not None:
+            setattr(op, var, tuple(getattr(op, var)))
+
+    return op
+
+def load_script(path, cache=False):
+    """ Return the list of operations of a script file.
+
+        path  - path to the script
+        cache - whether to keep the parsed operations in a compiled file
+            next to the script ('.<name>.ops'), reused while the script
+            does not change
+
+        Compiled files are plain JSON, so reading one cannot run code
+        even if someone else can write to the directory of the script.
+    """
+    st = os.stat(path)
+    stamp = [PARSER_VERSION, st.st_size, st.st_mtime]
+    compiled = os.path.join(os.path.dirname(path),
+            '.%s.ops' % os.path.basename(path))
+
+    if cache and os.path.isfile(compiled):
+        try:
+            with open(compiled, 'r') as f:
+                saved, ops = json.load(f)
+
+            if saved == stamp:
+                return [load_op(op) for op in ops]
+
+        except Exception:
+            # Unreadable or from an incompatible version, parse again
+            pass
+
+    with open(path, 'r') as f:
+        ops = list(parse_stream(f, path))
+
+    if cache:
+        tmp = compiled + '.%d' % os.getpid()
+
+        try:
+            with open(tmp, 'w') as f:
+                json.dump([stamp, [dump_op(op) for op in ops]], f)
+
+            os.rename(tmp, compiled)
+
+        except (IOError, OSError):
+            # The directory may be read only, parsing still worked
+            pass
+
+    return ops
+
+def parse_stream(f, name='script', errors=None):
+    """ Parse the blocks of a script as they are read.
+
+        f      - iterable of lines, such as an open file
+        name   - name of the script, used in error messages
+        errors - optional list to collect the errors in, instead of
+            raising them
+
+        Yields an operation object per block, with the number of the line
+        the block starts at as 'lineno' attribute. Errors are raised with
+        the position of the block that caused them. When collected, they
+        are (line, message, names) tuples, names being the clips the block
+        seems to define, and parsing goes on with the next block.
+    """
+    block = None
+
+    for lineno, line in enumerate(f, 1):
+        line = line.rstrip('\r\n')
+
+        if block is None:
+            if line.startswith('#do'):
+                btype = line[3:].strip()
+                start = lineno
+                block = []
+
+            continue
+
+        if line.startswith('#do'):
+            break
+
+        if line.startswith('#end'):
+            try:
+                op = parse_body(btype, block)
+
+            except Exception as e:
+                message = str(e)
+
+                if isinstance(e, KeyError):
+                    message = "Missing parameter %s" % e
+
+                if errors is None:
+                    raise Exception("%s:%d: %s" % (name, start, message))
+
+                errors.append((start, message, _defined(block)))
+                block = None
+                continue
+
+            op.lineno = start
+            block = None
+
+            yield op
+            continue
+
+        if line and not line.startswith('//'):
+            block.append(line)
+
+    if block is not None:
+        if errors is None:
+            raise Exception("%s:%d: Block is not closed with #end" % (
+                name, start))
+
+        errors.append((start, "Block is not closed with #end",
+            _defined(block)))
+
+def _defined(lines):
+    """ Return the names of the clips a block that failed to parse seems
+        to define.
+    """
+    names = []
+
+    for line in lines:
+        match = REGEX_VAR.match(line)
+
+        if match is not None and match.group(1) in ['name', 'out']:
+            names.append(match.group(2).strip())
+
+    return names
+
 def parse_subclip(lines):
     """ Parse a subclip.
 
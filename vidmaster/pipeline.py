@@ -0,0 +1,579 @@
+# -*- coding: utf-8 -*-
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 Rafael Medina García
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+from moviepy.video.io.ffmpeg_writer import FFMPEG_VideoWriter
+from vidmaster.clip_builder import export_params
+from vidmaster.seeking import MAX_CURSORS, SKIP_LIMIT
+from vidmaster.segments import write_audio
+
+import numpy as np
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+try:
+    from queue import Empty, Queue
+except ImportError:
+    from Queue import Empty, Queue
+
+# Number of frame buffers between two stages
+QUEUE_SIZE = 8
+
+
+class Stage(object):
+    """ Throughput statistics of a pipeline stage. """
+
+    def __init__(self, name):
+        self.name = name
+        self.frames = 0
+        self.busy = 0.0
+
+    def add(self, elapsed):
+        """ Account for a frame processed in the given number of seconds. """
+        self.frames += 1
+        self.busy += elapsed
+
+    def summary(self, total):
+        """ Return a line describing the stage.
+
+            total - wall time of the whole pipeline in seconds
+        """
+        fps = self.frames / self.busy if self.busy else 0.0
+        load = 100.0 * self.busy / total if total else 0.0
+
+        return "%-24s %7d frames %8.1f fps %5.1f%% busy" % (
+                self.name, self.frames, fps, load)
+
+
+class Prefetcher(object):
+    """ Decodes the frames of a video reader ahead of time in a thread.
+
+        While installed, the get_frame() method of the reader is replaced,
+        so every clip derived from the reader is served by the prefetcher.
+        Frames are read straight from FFMPEG into a fixed set of buffers.
+
+        Readers served by a Seeker are read through it instead, with one
+        ReadAhead per place the frames are read from, so subclips of the
+        same source keep sharing its cursors rather than restarting the
+        decoder on every frame.
+    """
+
+    def __init__(self, reader, depth=QUEUE_SIZE):
+        """ Wrap a FFMPEG_VideoReader.
+
+            reader - reader to wrap
+            depth  - number of frames to decode ahead
+        """
+        self.reader = reader
+        self.depth = depth
+        self.stage = Stage('decode ' + os.path.basename(reader.filename))
+
+        w, h = reader.size
+        self.nbytes = reader.depth * w * h
+        self.buffers = []
+
+        self.thread = None
+        self.current = None
+        self.pos = reader.pos
+        self.previous = None
+        # Read-aheads through the Seeker, least recently used first
+        self.lanes = []
+
+    def install(self):
+        """ Serve the frames of the reader from now on. """
+        # The reader may already be served by a Seeker
+        self.previous = self.reader.__dict__.get('get_frame')
+        self.reader.get_frame = self.get_frame
+
+        if self.previous is None:
+            w, h = self.reader.size
+            self.buffers = [np.empty((h, w, self.reader.depth),
+                dtype='uint8') for _ in range(self.depth + 1)]
+
+    def uninstall(self):
+        """ Stop prefetching and give the reader back its get_frame(). """
+        self._stop()
+
+        for lane in self.lanes:
+            lane.stop()
+
+        self.lanes = []
+
+        if self.previous is not None:
+            self.reader.get_frame = self.previous
+
+        else:
+            del self.reader.get_frame
+
+    def get_frame(self, t):
+        """ Return the frame at time t, same as FFMPEG_VideoReader. """
+        pos = int(self.reader.fps * t + 0.00001) + 1
+
+        if self.previous is not None:
+            return self._read_ahead(pos, t)
+
+        if pos == self.pos and self.current is not None:
+            return self.current[1]
+
+        if self.thread is None or pos < self.pos or pos > self.pos + 100:
+            self._stop()
+
+            reader = self.reader
+            if pos <= reader.pos or pos > reader.pos + 100:
+                reader.initialize(t)
+                reader.pos = pos - 1
+
+            self._start()
+
+        while True:
+            p, buf = self.ready.get()
+
+            if buf is None:
+                # End of the stream, keep the last valid frame
+                self.ready.put((p, buf))
+                break
+
+            if self.current is not None:
+                self.free.put(self.current[1])
+
+            self.current = (p, buf)
+
+            if p >= pos:
+                break
+
+        self.pos = pos
+
+        if self.current is None:
+            return self.reader.lastread
+
+        return self.current[1]
+
+    def _read_ahead(self, pos, t):
+        """ Return a frame from the read-ahead reading on to it. """
+        lane = None
+        for candidate in self.lanes:
+            if candidate.pos <= pos <= candidate.pos + SKIP_LIMIT:
+                lane = candidate
+                break
+
+        if lane is None:
+            # One per cursor of the Seeker at most
+            if len(self.lanes) >= MAX_CURSORS:
+                self.lanes.pop(0).stop()
+
+            lane = ReadAhead(self.previous, self.reader.fps, pos,
+                    self.reader.nframes, self.stage, self.depth)
+
+        else:
+            self.lanes.remove(lane)
+
+        self.lanes.append(lane)
+        frame = lane.frame(pos)
+
+        if frame is None:
+            # Past the end of the stream, as the reader handles it
+            return self.previous(t)
+
+        return frame
+
+    def _run(self):
+        """ Read frames until stopped or at the end of the stream. """
+        stdout = self.reader.proc.stdout
+
+        while True:
+            buf = self.free.get()
+
+            if buf is None:
+                break
+
+            start = time.time()
+            view = memoryview(buf.reshape(-1))
+            read = 0
+
+            while read < self.nbytes:
+                n = stdout.readinto(view[read:])
+
+                if not n:
+                    break
+
+                read += n
+
+            if read < self.nbytes:
+                self.ready.put((None, None))
+                break
+
+            self.reader.pos += 1
+            self.stage.add(time.time() - start)
+            self.ready.put((self.reader.pos, buf))
+
+    def _start(self):
+        """ Start decoding from the current position of the reader. """
+        self.free = Queue()
+        self.ready = Queue()
+
+        for buf in self.buffers:
+            if self.current is None or buf is not self.current[1]:
+                self.free.put(buf)
+
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _stop(self):
+        """ Stop decoding, leaving the reader consistent. """
+        if self.thread is None:
+            return
+
+        self.free.put(None)
+        self.thread.join()
+        self.thread = None
+
+        # The reader is positioned after the last frame decoded
+        last = self.current
+        while not self.ready.empty():
+            p, buf = self.ready.get()
+
+            if buf is not None:
+                last = (p, buf)
+
+        if last is not None:
+            self.reader.lastread = last[1].copy()
+
+
+class ReadAhead(object):
+    """ Reads the frames of a source on from a position in a thread.
+
+        Frames are requested in order to the get_frame() of a Seeker, so
+        the read-ahead keeps one of its cursors moving forward.
+    """
+
+    def __init__(self, get_frame, fps, pos, end, stage, depth=QUEUE_SIZE):
+        """ Start reading.
+
+            get_frame - function returning the frame at a time
+            fps       - frame rate of the source
+            pos       - first frame to read (starting at 1, as readers do)
+            end       - last frame of the source
+            stage     - Stage to account the frames to
+            depth     - number of frames to read ahead
+        """
+        self.get_frame = get_frame
+        self.fps = fps
+        self.stage = stage
+
+        # Last frame returned and its position
+        self.current = None
+        self.pos = pos - 1
+
+        self.ready = Queue(depth)
+        self.stopped = False
+
+        self.thread = threading.Thread(target=self._run, args=(pos, end))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def frame(self, pos):
+        """ Return the frame at a position, None past the end. """
+        if pos == self.pos and self.current is not None:
+            return self.current
+
+        while self.pos < pos:
+            p, frame = self.ready.get()
+
+            if frame is None:
+                # Keep the end mark for later requests
+                self.ready.put((p, frame))
+                return None
+
+            self.current = frame
+            self.pos = p
+
+        return self.current
+
+    def stop(self):
+        """ Stop reading, waiting for the frame being read. """
+        self.stopped = True
+
+        # Make room for the thread to finish
+        while self.thread.is_alive():
+            try:
+                self.ready.get(timeout=0.05)
+
+            except Empty:
+                pass
+
+        self.thread.join()
+
+    def _run(self, pos, end):
+        """ Read frames until stopped or at the end of the source. """
+        while pos <= end and not self.stopped:
+            start = time.time()
+            frame = self.get_frame((pos - 1.0) / self.fps)
+            self.stage.add(time.time() - start)
+
+            self.ready.put((pos, frame))
+            pos += 1
+
+        self.ready.put((None, None))
+
+
+def export_pipelined(clip, op, readers=()):
+    """ Export a clip running decoding, composition and encoding at once.
+
+        clip    - clip to export
+        op      - export operation
+        readers - FFMPEG_VideoReader objects of the source videos
+
+        Each source is decoded in its own thread, frames are composed in
+        another thread and the main thread feeds the encoder. Stages are
+        connected by bounded queues of reused frame buffers, so memory
+        does not grow with the length of the clip. Returns the list of
+        Stage statistics, which are also printed at the end.
+    """
+    fps = op.fps
+    nframes = int(clip.duration * fps)
+    w, h = clip.size
+
+    tmpdir = tempfile.mkdtemp(prefix='.vidmaster-',
+            dir=os.path.dirname(os.path.abspath(op.out)))
+
+    prefetchers = [Prefetcher(r) for r in readers]
+    compose = Stage('compose')
+    encode = Stage('encode')
+
+    free = Queue()
+    ready = Queue()
+    errors = []
+
+    for _ in range(QUEUE_SIZE):
+        free.put(np.empty((h, w, 3), dtype='uint8'))
+
+    def produce():
+        try:
+            for i in range(nframes):
+                buf = free.get()
+
+                if buf is None:
+                    return
+
+                start = time.time()
+                buf[...] = clip.get_frame(float(i) / fps)
+                compose.add(time.time() - start)
+
+                ready.put(buf)
+
+        except Exception as e:
+            errors.append(e)
+
+        finally:
+            ready.put(None)
+
+    started = time.time()
+
+    try:
+        audio = None
+        if clip.audio is not None:
+            audio = write_audio(clip, op, tmpdir)
+
+        writer = FFMPEG_VideoWriter(op.out, clip.size, fps, codec=op.codec,
+                preset=op.preset, audiofile=audio, threads=op.threads,
+                ffmpeg_params=export_params(op, clip.size))
+
+        for p in prefetchers:
+            p.install()
+
+        producer = threading.Thread(target=produce)
+        producer.daemon = True
+        producer.start()
+
+        try:
+            while True:
+                buf = ready.get()
+
+                if buf is None:
+                    break
+
+                start = time.time()
+                writer.proc.stdin.write(buf.data)
+                encode.add(time.time() - start)
+
+                free.put(buf)
+
+        finally:
+            # Unblock the producer if the encoder failed
+            free.put(None)
+            producer.join()
+
+            writer.close()
+
+            for p in prefetchers:
+                p.uninstall()
+
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    if errors:
+        raise errors[0]
+
+    total = time.time() - started
+    stages = [p.stage for p in prefetchers if p.stage.frames]
+    stages += [compose, encode]
+
+    for stage in stages:
+        print(stage.summary(total))
+
+    return stages
+
+def export_renditions(clip, ops, readers=()):
+    """ Export a clip to several files, composing each frame once.
+
+        clip    - clip to export
+        ops     - export operations, all of them at the same fps
+        readers - FFMPEG_VideoReader objects of the source videos
+
+        Every frame is composed in the main thread and handed to one
+        thread per export, which feeds its encoder. Each encoder scales
+        the frames to the size of its export, so the encoders (and the
+        scaling) run in parallel and the whole set takes about as long as
+        the slowest export. Returns the list of Stage statistics, which
+        are also printed at the end.
+    """
+    fps = ops[0].fps
+    nframes = int(clip.duration * fps)
+    w, h = clip.size
+
+    tmpdir = tempfile.mkdtemp(prefix='.vidmaster-',
+            dir=os.path.dirname(os.path.abspath(ops[0].out)))
+
+    prefetchers = [Prefetcher(r) for r in readers]
+    compose = Stage('compose')
+    encoders = [Stage('encode ' + os.path.basename(op.out)) for op in ops]
+
+    free = Queue()
+    queues = [Queue() for _ in ops]
+    # Number of encoders yet to write each buffer
+    pending = {}
+    lock = threading.Lock()
+    errors = []
+
+    for _ in range(QUEUE_SIZE):
+        free.put(np.empty((h, w, 3), dtype='uint8'))
+
+    def encode(writer, queue, stage):
+        while True:
+            buf = queue.get()
+
+            if buf is None:
+                break
+
+            # After a failure frames are only given back
+            if not errors:
+                start = time.time()
+
+                try:
+                    writer.proc.stdin.write(buf.data)
+
+                except Exception as e:
+                    errors.append(e)
+
+                stage.add(time.time() - start)
+
+            with lock:
+                pending[id(buf)] -= 1
+
+                if not pending[id(buf)]:
+                    free.put(buf)
+
+    started = time.time()
+    writers = []
+    threads = []
+    installed = []
+
+    try:
+        # Files that need the same audio codec share the audio
+        audios = {}
+        for op in ops:
+            ext = os.path.splitext(op.out)[1].lower()
+            if clip.audio is not None and ext not in audios:
+                audios[ext] = write_audio(clip, op, tmpdir)
+
+        for op in ops:
+            writers.append(FFMPEG_VideoWriter(op.out, clip.size, fps,
+                codec=op.codec, preset=op.preset,
+                audiofile=audios.get(os.path.splitext(op.out)[1].lower()),
+                threads=op.threads, ffmpeg_params=export_params(op,
+                    clip.size)))
+
+        for p in prefetchers:
+            p.install()
+            installed.append(p)
+
+        for writer, queue, stage in zip(writers, queues, encoders):
+            thread = threading.Thread(target=encode,
+                    args=(writer, queue, stage))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        for i in range(nframes):
+            buf = free.get()
+
+            if errors:
+                break
+
+            start = time.time()
+            buf[...] = clip.get_frame(float(i) / fps)
+            compose.add(time.time() - start)
+
+            pending[id(buf)] = len(queues)
+            for queue in queues:
+                queue.put(buf)
+
+    finally:
+        for queue in queues:
+            queue.put(None)
+
+        for thread in threads:
+            thread.join()
+
+        for writer in writers:
+            writer.close()
+
+        for p in installed:
+            p.uninstall()
+
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    if errors:
+        raise errors[0]
+
+    total = time.time() - started
+    stages = [p.stage for p in prefetchers if p.stage.frames]
+    stages += [compose] + encoders
+
+    for stage in stages:
+        print(stage.summary(total))
+
+    return stages
@@ -0,0 +1,352 @@
+# -*- coding: utf-8 -*-
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 Rafael Medina García
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+from vidmaster.parser import OpDefine, OpEffect, OpMix, OpSubclip, OpExport
+from vidmaster.draft import scaled_size
+from vidmaster.parser import get_seconds
+
+
+class Graph(object):
+    """ Dependency graph of the operations of a script.
+
+        Nodes are the indices of the operations in the list. Clip names
+        may be overwritten, so each name read by an operation is resolved
+        to the last operation that wrote it before that point.
+    """
+
+    def __init__(self, ops):
+        """ Build the graph.
+
+            ops - ordered list of operations, as parsed from the script
+        """
+        self.ops = ops
+
+        # Operations each node reads from (in op_inputs() order)
+        self.inputs = [[] for _ in ops]
+        # Operations that read from each node
+        self.consumers = [[] for _ in ops]
+        # (node, name) pairs for names read before being defined
+        self.missing = []
+
+        producers = {}
+
+        for i, op in enumerate(ops):
+            for name in op_inputs(op):
+                if name not in producers:
+                    self.missing.append((i, name))
+                    continue
+
+                self.inputs[i].append(producers[name])
+                self.consumers[producers[name]].append(i)
+
+            out = op_output(op)
+            if out:
+                producers[out] = i
+
+    def exports(self):
+        """ Return the nodes of the export operations. """
+        return [i for i, op in enumerate(self.ops) if type(op) == OpExport]
+
+    def last_uses(self, nodes):
+        """ Find out when the result of each operation stops being needed.
+
+            nodes - sorted list of the nodes that are performed
+
+            Clips are lazy, so a clip is needed until every operation built
+            on it, directly or not, has been performed. Returns a dict with
+            the last of those nodes by node (itself if none).
+        """
+        performed = set(nodes)
+        last = {}
+
+        # Consumers always come after the nodes they read from
+        for node in reversed(nodes):
+            last[node] = max([node] + [last[c] for c in self.consumers[node]
+                if c in performed])
+
+        return last
+
+    def renditions(self, nodes):
+        """ Group the exports that can be written from the same frames.
+
+            nodes - nodes that are performed
+
+            Exports of the same clip at the same fps, not split in
+            segments nor resumable, are renditions of the clip. Returns a
+            dict with the list of nodes of each group by its first node,
+            and an empty list by the rest of nodes of the group.
+        """
+        groups = {}
+        result = {}
+
+        for node in nodes:
+            op = self.ops[node]
+
+            if type(op) != OpExport or not self.inputs[node]:
+                continue
+
+            if op.segments > 1 or op.resumable:
+                result[node] = [node]
+                continue
+
+            key = (self.inputs[node][0], op.fps)
+
+            if key in groups:
+                result[groups[key]].append(node)
+                result[node] = []
+
+            else:
+                groups[key] = node
+                result[node] = [node]
+
+        return result
+
+    def prune(self, roots=None, stop=()):
+        """ Return the ordered list of nodes needed to compute the roots.
+
+            roots - nodes to compute, defaults to every export of the script
+            stop  - nodes whose result is already available, their inputs
+                are not needed
+
+            Raises an exception if any of the needed nodes reads a clip
+            that has not been defined.
+        """
+        if roots is None:
+            roots = self.exports()
+
+        needed = set()
+        pending = list(roots)
+
+        while pending:
+            node = pending.pop()
+
+            if node in needed:
+                continue
+
+            needed.add(node)
+
+            if node not in stop:
+                pending.extend(self.inputs[node])
+
+        for node, name in self.missing:
+            if node in needed:
+                where = getattr(self.ops[node], 'lineno', None)
+
+                raise Exception("Clip '%s' is used before being defined%s"
+                        % (name, " (line %d)" % where if where else ''))
+
+        return sorted(needed)
+
+
+def describe(op):
+    """ Return a short, human readable description of an operation. """
+    if type(op) == OpDefine:
+        return "define %s '%s' <- %s" % (op.type, op.name, op.source)
+
+    elif type(op) == OpExport:
+        return "export '%s' -> %s" % (op.clip, op.out)
+
+    return "%s %s -> '%s'" % (_kind(op), ", ".join(
+        "'%s'" % name for name in op_inputs(op)), op.out)
+
+def export_size(op, size):
+    """ Return the size of the video written by an export.
+
+        op   - export operation
+        size - (width, height) of the exported clip
+
+        Sizes computed from the aspect ratio are rounded to even numbers,
+        as most encoders require.
+    """
+    w, h = size
+
+    if op.width and op.height:
+        return (op.width, op.height)
+
+    elif op.height:
+        return (max(2, int(round(float(w) * op.height / h / 2)) * 2),
+                op.height)
+
+    elif op.width:
+        return (op.width, max(2, int(round(float(h) * op.width / w / 2)) * 2))
+
+    return tuple(size)
+
+def infer(graph, nodes, probe):
+    """ Infer the metadata of the clips produced by some operations.
+
+        graph - dependency graph of the operations
+        nodes - ordered list of nodes to infer, including their inputs
+        probe - function returning the metadata of a source file, as
+            vidmaster.probe.probe() does
+
+        Returns a dict of dicts by node with the keys 'size' (width and
+        height, None for audio), 'duration' (None if unknown), 'fps',
+        'audio' (whether it has sound) and 'pos' (position in a
+        composition). The values follow the rules MoviePy uses, without
+        opening any clip.
+    """
+    infos = {}
+    result = {}
+
+    for node in nodes:
+        op = graph.ops[node]
+        inputs = [result[i] for i in graph.inputs[node]]
+        meta = {'size': None, 'duration': None, 'fps': None, 'audio': False,
+                'pos': (0, 0)}
+
+        if type(op) == OpDefine:
+            if op.source not in infos:
+                infos[op.source] = probe(op.source)
+
+            info = infos[op.source]
+
+            if op.type == 'audio':
+                meta['duration'] = info['duration']
+                meta['audio'] = True
+
+            elif op.type == 'image':
+                meta['size'] = _source_size(op, info)
+                meta['duration'] = (op.duration if op.duration
+                        else inputs[0]['duration'])
+
+            else:
+                meta['size'] = _source_size(op, info)
+                meta['duration'] = info['duration']
+                meta['fps'] = info['fps']
+                meta['audio'] = bool(op.hasaudio and info['audio_codec'])
+
+        elif type(op) == OpEffect:
+            meta.update(inputs[0])
+            w, h = meta['size']
+
+            if op.type == 'resize':
+                meta['size'] = resize_size(op, meta['size'])
+
+            elif op.type == 'margin':
+                meta['size'] = (w + 2 * op.size, h + 2 * op.size)
+
+            elif op.type == 'position':
+                meta['pos'] = (op.x, op.y)
+
+        elif type(op) == OpExport:
+            meta.update(inputs[0])
+
+            if meta['size']:
+                meta['size'] = export_size(op, meta['size'])
+
+        elif type(op) == OpSubclip:
+            meta.update(inputs[0])
+
+            end = get_seconds(op.end) if op.end else meta['duration']
+            meta['duration'] = (None if end is None
+                    else end - get_seconds(op.start))
+
+        elif type(op) == OpMix:
+            durations = [i['duration'] for i in inputs]
+            rates = set(i['fps'] for i in inputs if i['fps'])
+
+            meta['fps'] = rates.pop() if len(rates) == 1 else None
+            meta['audio'] = any(i['audio'] for i in inputs)
+
+            if op.type == 'setaudio':
+                meta.update(inputs[0])
+                meta['audio'] = True
+
+            elif op.type == 'composition':
+                meta['size'] = (op.width, op.height)
+                meta['duration'] = (None if None in durations
+                        else max(durations))
+
+            else:
+                meta['size'] = inputs[0]['size']
+                meta['duration'] = (None if None in durations
+                        else sum(durations))
+
+        result[node] = meta
+
+    return result
+
+def op_inputs(op):
+    """ Return the names of the clips read by an operation. """
+    if type(op) == OpDefine:
+        # Images only read the other clip when no duration is given
+        if op.type == 'image' and not op.duration:
+            return [op.duration_from]
+
+        return []
+
+    elif type(op) == OpMix:
+        if op.type == 'setaudio':
+            return [op.clip, op.audio]
+
+        return list(op.clips)
+
+    elif type(op) in [OpEffect, OpSubclip, OpExport]:
+        return [op.clip]
+
+    return []
+
+def op_output(op):
+    """ Return the name of the clip written by an operation, if any. """
+    if type(op) == OpDefine:
+        return op.name
+
+    elif type(op) in [OpEffect, OpMix, OpSubclip]:
+        return op.out
+
+    return None
+
+def resize_size(op, size):
+    """ Return the size of a clip after a resize operation.
+
+        op   - resize operation
+        size - (width, height) of the clip
+
+        If only one dimension is given, the aspect ratio is kept.
+    """
+    w, h = size
+
+    if op.height and op.width:
+        return (op.width, op.height)
+
+    elif op.height:
+        return (int(float(w) * op.height / h), op.height)
+
+    return (op.width, int(float(h) * op.width / w))
+
+def _source_size(op, info):
+    """ Return the size of a defined clip, taking its scale into account. """
+    size = (info['width'], info['height'])
+
+    if op.scale != 1:
+        size = scaled_size(size, op.scale)
+
+    return size
+
+def _kind(op):
+    """ Return the block name of an operation. """
+    if type(op) == OpSubclip:
+        return 'subclip'
+
+    return op.type
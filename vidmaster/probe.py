@@ -0,0 +1,287 @@
+# -*- coding: utf-8 -*-
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 Rafael Medina García
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+from moviepy.config import get_setting
+import moviepy.audio.io.readers
+import moviepy.video.io.ffmpeg_reader
+
+import json
+import multiprocessing
+import os
+import re
+import sqlite3
+import subprocess
+
+REGEX_DURATION = re.compile(r'Duration: (\d+):(\d+):(\d+(?:\.\d+)?)')
+REGEX_VIDEO = re.compile(
+        r' Video: (\w+)[^,]*, (\w+)(?:\([^)]*\))?[^,]*, (\d+)x(\d+)')
+REGEX_FPS = re.compile(r'([\d.]+) (?:fps|tbr)')
+REGEX_AUDIO = re.compile(r' Audio: (\w+)[^,]*, (\d+) Hz, ([^,]+)')
+REGEX_PTS = re.compile(r'pts_time:\s*(-?[\d.]+)')
+
+DEFAULT_INDEX = os.path.join(os.path.expanduser('~'), '.cache', 'vidmaster',
+        'probe.sqlite')
+# Extensions of the files probed when warming the index for a directory
+MEDIA_EXTENSIONS = ['.avi', '.flac', '.jpg', '.jpeg', '.m4a', '.mkv', '.mov',
+        '.mp3', '.mp4', '.mpg', '.ogg', '.ogv', '.png', '.wav', '.webm']
+
+# Index used by probe() and MoviePy, see install_index()
+_index = None
+_parse_infos = moviepy.video.io.ffmpeg_reader.ffmpeg_parse_infos
+
+
+class ProbeIndex(object):
+    """ Persistent index of the metadata of media files.
+
+        Entries are stored in a SQLite database, keyed by the path of the
+        file and the kind of metadata, and are valid while the size and
+        modification time of the file do not change. The database can be
+        shared by several processes.
+    """
+
+    def __init__(self, path=DEFAULT_INDEX):
+        """ Open (or create) an index.
+
+            path - path to the database file
+        """
+        self.path = path
+        self.pid = None
+        self.db = None
+
+        directory = os.path.dirname(os.path.abspath(path))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def get(self, path, kind):
+        """ Return the stored metadata of a file, or None if stale. """
+        path = os.path.abspath(path)
+        st = os.stat(path)
+
+        row = self._connect().execute('SELECT size, mtime, data FROM media '
+                'WHERE path = ? AND kind = ?', (path, kind)).fetchone()
+
+        if row is None or row[0] != st.st_size or row[1] != st.st_mtime:
+            return None
+
+        return json.loads(row[2])
+
+    def lookup(self, path, kind, compute):
+        """ Return the metadata of a file, computing it if needed.
+
+            path    - path to the media file
+            kind    - name of the metadata
+            compute - function returning the metadata for the file, it
+                must be JSON serializable
+        """
+        data = self.get(path, kind)
+
+        if data is None:
+            data = compute(path)
+            self.put(path, kind, data)
+
+        return data
+
+    def put(self, path, kind, data):
+        """ Store the metadata of a file. """
+        path = os.path.abspath(path)
+        st = os.stat(path)
+
+        db = self._connect()
+        db.execute('INSERT OR REPLACE INTO media VALUES (?, ?, ?, ?, ?)',
+                (path, kind, st.st_size, st.st_mtime, json.dumps(data)))
+        db.commit()
+
+    def warm(self, directory, jobs=None):
+        """ Probe every media file in a directory tree.
+
+            directory - directory to walk
+            jobs      - number of files probed at once, defaults to the
+                number of CPUs
+
+            Only files whose entries are missing or stale are probed.
+            Returns the number of files probed.
+        """
+        paths = []
+
+        for root, _, files in os.walk(directory):
+            for name in sorted(files):
+                if os.path.splitext(name)[1].lower() not in MEDIA_EXTENSIONS:
+                    continue
+
+                path = os.path.abspath(os.path.join(root, name))
+
+                if self.get(path, 'probe') is None:
+                    paths.append(path)
+
+        if not paths:
+            return 0
+
+        pool = multiprocessing.Pool(jobs or multiprocessing.cpu_count())
+
+        try:
+            for path, infos in pool.imap_unordered(_warm_job, paths):
+                self.put(path, 'probe', infos['probe'])
+
+                if infos['moviepy'] is not None:
+                    self.put(path, 'moviepy', infos['moviepy'])
+
+        finally:
+            pool.close()
+            pool.join()
+
+        return len(paths)
+
+    def _connect(self):
+        """ Return the connection of this process to the database. """
+        # Connections cannot be used across forks
+        if self.pid != os.getpid():
+            self.db = sqlite3.connect(self.path, timeout=60)
+            self.db.execute('CREATE TABLE IF NOT EXISTS media (path TEXT, '
+                    'kind TEXT, size INTEGER, mtime REAL, data TEXT, '
+                    'PRIMARY KEY (path, kind))')
+            self.pid = os.getpid()
+
+        return self.db
+
+
+def probe(path):
+    """ Obtain the metadata of a media file using FFMPEG.
+
+        Returns a dict with the following keys (None when not found):
+
+            duration       - duration in seconds
+            video_codec    - name of the codec of the first video stream
+            pix_fmt        - pixel format of the first video stream
+            width          - width of the first video stream
+            height         - height of the first video stream
+            fps            - frame rate of the first video stream
+            audio_codec    - name of the codec of the first audio stream
+            audio_rate     - sample rate of the first audio stream
+            audio_channels - channel layout of the first audio stream
+    """
+    if _index is not None and os.path.isfile(path):
+        return _index.lookup(path, 'probe', _probe)
+
+    return _probe(path)
+
+def install_index(index):
+    """ Use an index for the metadata of every media file.
+
+        index - ProbeIndex to use, or None to stop using one
+
+        Besides probe(), MoviePy takes the metadata of the files it opens
+        from the index, so they are not probed again in later runs.
+    """
+    global _index
+    _index = index
+
+    parse = _parse_infos if index is None else _indexed_parse_infos
+
+    moviepy.video.io.ffmpeg_reader.ffmpeg_parse_infos = parse
+    moviepy.audio.io.readers.ffmpeg_parse_infos = parse
+
+def keyframes(path):
+    """ Return the sorted timestamps of the keyframes of a video file.
+
+        Only keyframes are decoded, so this is much faster than reading
+        the whole file. The timestamps are kept in the index, if any.
+    """
+    if _index is not None and os.path.isfile(path):
+        return _index.lookup(path, 'keyframes', _keyframes)
+
+    return _keyframes(path)
+
+def _keyframes(path):
+    """ Run FFMPEG to find the keyframes of a video file. """
+    proc = subprocess.Popen([get_setting('FFMPEG_BINARY'), '-skip_frame',
+            'nokey', '-i', path, '-an', '-vf', 'showinfo', '-f', 'null', '-'],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE)
+    infos = proc.communicate()[1].decode('utf-8', 'replace')
+
+    if proc.returncode != 0:
+        raise IOError("Cannot read keyframes of %s" % path)
+
+    return sorted(float(t) for t in REGEX_PTS.findall(infos))
+
+def _indexed_parse_infos(filename, print_infos=False, check_duration=True):
+    """ Index backed replacement of the MoviePy probing function. """
+    if print_infos or _index is None or not os.path.isfile(filename):
+        return _parse_infos(filename, print_infos, check_duration)
+
+    return _index.lookup(filename, 'moviepy' if check_duration
+            else 'moviepy_nocheck',
+            lambda path: _parse_infos(path, False, check_duration))
+
+def _probe(path):
+    """ Run FFMPEG to obtain the metadata of a media file. """
+    proc = subprocess.Popen([get_setting('FFMPEG_BINARY'), '-i', path],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE)
+    infos = proc.communicate()[1].decode('utf-8', 'replace')
+
+    if 'No such file or directory' in infos:
+        raise IOError("Cannot access media file %s" % path)
+
+    return parse_infos(infos)
+
+def _warm_job(path):
+    """ Probe a file in a worker process. """
+    try:
+        moviepy = _parse_infos(path)
+
+    except IOError:
+        # Images have no duration, MoviePy does not open them this way
+        moviepy = None
+
+    return path, {'probe': _probe(path), 'moviepy': moviepy}
+
+def parse_infos(infos):
+    """ Parse the information FFMPEG prints about an input file. """
+    result = dict.fromkeys(['duration', 'video_codec', 'pix_fmt', 'width',
+        'height', 'fps', 'audio_codec', 'audio_rate', 'audio_channels'])
+
+    match = REGEX_DURATION.search(infos)
+    if match:
+        h, m, s = match.groups()
+        result['duration'] = int(h) * 3600 + int(m) * 60 + float(s)
+
+    for line in infos.splitlines():
+        video = REGEX_VIDEO.search(line)
+        if video and result['video_codec'] is None:
+            result['video_codec'] = video.group(1)
+            result['pix_fmt'] = video.group(2)
+            result['width'] = int(video.group(3))
+            result['height'] = int(video.group(4))
+
+            fps = REGEX_FPS.search(line)
+            if fps:
+                result['fps'] = float(fps.group(1))
+
+        audio = REGEX_AUDIO.search(line)
+        if audio and result['audio_codec'] is None:
+            result['audio_codec'] = audio.group(1)
+            result['audio_rate'] = int(audio.group(2))
+            result['audio_channels'] = audio.group(3).strip()
+
+    return result
@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 Rafael Medina García
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+from vidmaster.parser import OpExport
+from vidmaster.planner import describe, op_output
+
+import json
+import math
+import os
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+# Frames beyond this number are counted but left out of the trace
+MAX_FRAME_EVENTS = 200000
+
+
+class OpStats(object):
+    """ Measurements of a single operation. """
+
+    def __init__(self, node, op):
+        self.node = node
+        self.name = op_output(op) or op.out
+        self.description = describe(op)
+        self.export = type(op) == OpExport
+
+        # Seconds spent performing the operation itself
+        self.wall = 0.0
+        # Frames computed by the clip of the operation and the seconds
+        # spent on them, excluding the time of the clips it reads from
+        self.frames = 0
+        self.self_time = 0.0
+        # Number of frames by log2 of their self time in microseconds
+        self.histogram = {}
+        # Peak resident set size of the process in KiB when the operation
+        # ended, and how much it grew while the operation was performed.
+        # Frames are computed lazily, so their memory mostly shows up in
+        # the exports that read them
+        self.max_rss = None
+        self.rss_growth = None
+
+    def add_frame(self, elapsed):
+        """ Account for a frame computed in the given number of seconds. """
+        self.frames += 1
+        self.self_time += elapsed
+
+        bucket = int(math.log(max(elapsed * 1e6, 1), 2))
+        self.histogram[bucket] = self.histogram.get(bucket, 0) + 1
+
+    def percentile(self, p):
+        """ Return an upper bound of a percentile of the frame times. """
+        if not self.frames:
+            return 0.0
+
+        seen = 0
+        for bucket in sorted(self.histogram):
+            seen += self.histogram[bucket]
+
+            if seen >= p * self.frames:
+                return 2 ** (bucket + 1) / 1e6
+
+    def as_dict(self):
+        """ Return the measurements as a JSON serializable dict. """
+        return {
+            'node': self.node,
+            'name': self.name,
+            'operation': self.description,
+            'wall': self.wall,
+            'frames': self.frames,
+            'self_time': self.self_time,
+            'histogram_us_log2': dict((str(k), v)
+                for k, v in self.histogram.items()),
+            'max_rss_so_far_kb': self.max_rss,
+            'peak_rss_growth_kb': self.rss_growth,
+        }
+
+
+class Profiler(object):
+    """ Records where the time of a build goes.
+
+        Each operation is timed while it is performed, and the clip it
+        produces is instrumented so that every frame computed from it is
+        timed too. Frame times exclude the time spent in the clips they
+        read from, so decoding is accounted to the definitions, scaling to
+        the resizes and so on. For exports, the time not spent computing
+        frames is mostly encoding.
+    """
+
+    def __init__(self):
+        self.stats = {}
+        self.events = []
+        self.dropped = 0
+        self.origin = time.time()
+
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+        # Seconds spent in frames requested from outside any clip
+        self.frame_time = 0.0
+        self.current = None
+
+    def begin(self, node, op):
+        """ Start timing an operation.
+
+            node - index of the operation
+            op   - operation to time
+        """
+        self.stats[node] = OpStats(node, op)
+        self.current = (node, time.time(), self.frame_time, _peak_rss())
+
+    def end(self, clip=None):
+        """ Stop timing the current operation.
+
+            clip - clip produced by the operation, if any, to instrument
+        """
+        node, started, frame_time, rss = self.current
+        self.current = None
+
+        stats = self.stats[node]
+        stats.wall = time.time() - started
+        stats.max_rss = _peak_rss()
+
+        if rss is not None:
+            stats.rss_growth = stats.max_rss - rss
+
+        if stats.export:
+            # The frames were accounted to the clips that computed them
+            stats.self_time = stats.wall - (self.frame_time - frame_time)
+
+        self._event(stats.name, 'operation', started, stats.wall,
+                {'operation': stats.description})
+
+        if clip is not None:
+            self.instrument(node, clip)
+
+    def instrument(self, node, clip):
+        """ Time every frame computed by a clip.
+
+            The make_frame() function of the clip instance is replaced, so
+            clips derived from it report through it as well.
+        """
+        stats = self.stats[node]
+        make_frame = clip.make_frame
+        local = self.local
+
+        def timed(t):
+            stack = getattr(local, 'stack', None)
+            if stack is None:
+                stack = local.stack = []
+
+            # Time spent by the clips read from this one
+            stack.append(0.0)
+            started = time.time()
+
+            try:
+                return make_frame(t)
+
+            finally:
+                elapsed = time.time() - started
+                children = stack.pop()
+
+                with self.lock:
+                    stats.add_frame(elapsed - children)
+
+                    if stack:
+                        stack[-1] += elapsed
+
+                    else:
+                        self.frame_time += elapsed
+
+                    self._event(stats.name, 'frame', started, elapsed,
+                            {'t': float(t)})
+
+        clip.make_frame = timed
+
+    def save(self, path):
+        """ Write the trace in the Chrome trace event format.
+
+            The file can be opened in chrome://tracing or Perfetto. The
+            measurements of each operation are stored in the metadata.
+        """
+        trace = {
+            'traceEvents': self.events,
+            'displayTimeUnit': 'ms',
+            'metadata': {
+                'operations': [self.stats[n].as_dict()
+                    for n in sorted(self.stats)],
+                'dropped_frame_events': self.dropped,
+            },
+        }
+
+        with open(path, 'w') as f:
+            json.dump(trace, f)
+
+    def summary(self):
+        """ Return a text table with the measurements of each operation. """
+        lines = ["%-5s %-20s %9s %8s %10s %9s %9s %10s %10s" % ('node',
+            'clip', 'op (s)', 'frames', 'self (s)', 'mean ms', 'p95 ms',
+            'peak +MiB', 'max MiB')]
+
+        for node in sorted(self.stats):
+            s = self.stats[node]
+            mean = 1000.0 * s.self_time / s.frames if s.frames else 0.0
+            rss = ' '.join('%10.1f' % (kb / 1024.0) if kb is not None
+                    else ' ' * 9 + '-' for kb in (s.rss_growth, s.max_rss))
+
+            lines.append("%-5d %-20s %9.3f %8d %10.3f %9.2f %9.2f %s" % (
+                node, s.name[-20:], s.wall, s.frames, s.self_time, mean,
+                1000.0 * s.percentile(0.95), rss))
+
+        return '\n'.join(lines)
+
+    def _event(self, name, category, started, elapsed, args):
+        """ Add a complete event to the trace. """
+        if category == 'frame' and len(self.events) >= MAX_FRAME_EVENTS:
+            self.dropped += 1
+            return
+
+        self.events.append({
+            'name': name,
+            'cat': category,
+            'ph': 'X',
+            'ts': (started - self.origin) * 1e6,
+            'dur': elapsed * 1e6,
+            'pid': os.getpid(),
+            'tid': threading.current_thread().ident,
+            'args': args,
+        })
+
+
+def _peak_rss():
+    """ Return the peak resident set size of the process in KiB, or None. """
+    if resource is None:
+        return None
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
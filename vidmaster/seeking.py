@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 Rafael Medina García
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+from moviepy.config import get_setting
+from vidmaster.probe import keyframes
+
+import copy
+import subprocess
+import threading
+
+# Frames it takes to restart the decoder, seeking is only worth it when it
+# saves decoding more frames than this
+SEEK_COST = 30
+# Forward distance MoviePy reads through when keyframes are unknown
+SKIP_LIMIT = 100
+# Readers kept open for a single source
+MAX_CURSORS = 3
+
+# Threads reading frames ahead of time, see read_ahead()
+_local = threading.local()
+
+
+class Seeker(object):
+    """ Serves the frames of a video reader using the keyframes of its file.
+
+        Frames are read on while the next keyframe is close, and otherwise
+        the decoder is restarted right at the requested frame, so only the
+        frames since the previous keyframe are decoded. Every subclip of a
+        source shares its reader, and a few extra cursors (readers of the
+        same file) are opened for clips that read from different places at
+        the same time, such as two subclips of a source in a composition.
+        Cursors decode in parallel when frames are read from several
+        threads, as when a concatenation prefetches its next clip.
+
+        While installed, the get_frame(), initialize() and close() methods
+        of the reader are replaced.
+    """
+
+    def __init__(self, reader, cursors=MAX_CURSORS):
+        """ Wrap a FFMPEG_VideoReader.
+
+            reader  - reader to wrap
+            cursors - maximum number of readers open for the file
+        """
+        self.reader = reader
+        self.limit = cursors
+        self.cursors = [reader]
+        self.used = {id(reader): 0}
+        self.clock = 0
+        self.keyframes = None
+        self.lock = threading.Condition()
+        # Frame each cursor being read by a thread is moving to, by id
+        self.busy = {}
+
+    def install(self):
+        """ Serve the frames of the reader from now on. """
+        reader = self.reader
+
+        reader.get_frame = self.get_frame
+        reader.initialize = lambda starttime=0: initialize(reader, starttime)
+        reader.close = self.close
+
+    def close(self):
+        """ Close every cursor, the reader can still be reopened. """
+        with self.lock:
+            while self.busy:
+                self.lock.wait()
+
+            for cursor in self.cursors[1:]:
+                cursor.__class__.close(cursor)
+
+            self.cursors = [self.reader]
+            self.reader.__class__.close(self.reader)
+
+    def get_frame(self, t):
+        """ Return the frame at time t, same as FFMPEG_VideoReader. """
+        pos = int(self.reader.fps * t + 0.00001) + 1
+
+        with self.lock:
+            # A cursor being moved to the frame will have it soon
+            cursor = None
+            while cursor is None:
+                if pos not in self.busy.values():
+                    cursor = self._cursor(pos)
+
+                if cursor is None:
+                    self.lock.wait()
+
+            if pos == cursor.pos:
+                self._use(cursor)
+                return cursor.lastread
+
+            if getattr(_local, 'ahead', False) and cursor is self._latest():
+                # Playback gets there reading on, nothing to prepare
+                return None
+
+            self._use(cursor)
+
+            self.busy[id(cursor)] = pos
+
+        # Decoded without the lock, so other cursors can be read meanwhile
+        try:
+            if not hasattr(cursor, 'proc') or not self._forward(
+                    cursor.pos, pos):
+                initialize(cursor, t)
+                cursor.pos = pos - 1
+
+            cursor.skip_frames(pos - cursor.pos - 1)
+            frame = cursor.read_frame()
+            cursor.pos = pos
+
+            return frame
+
+        finally:
+            with self.lock:
+                self.busy.pop(id(cursor), None)
+                self.lock.notify_all()
+
+    def _cursor(self, pos):
+        """ Return the reader that gets to a frame the cheapest.
+
+            Returns None if every cursor is being read by another thread.
+        """
+        best = None
+        closed = None
+        spare = None
+
+        if getattr(_local, 'ahead', False):
+            if self.limit < 2:
+                raise IOError("No cursor to read ahead with")
+
+            # Reading ahead leaves alone the cursor read last, the one
+            # playback is most likely to need next
+            spare = self._latest()
+
+        for cursor in self.cursors:
+            if id(cursor) in self.busy:
+                continue
+
+            if cursor is spare and not (cursor.pos == pos or (
+                    cursor.pos < pos and self._forward(cursor.pos, pos))):
+                continue
+
+            if not hasattr(cursor, 'proc'):
+                closed = closed or cursor
+                continue
+
+            if cursor.pos == pos:
+                return cursor
+
+            if cursor.pos < pos and self._forward(cursor.pos, pos) and (
+                    best is None or cursor.pos > best.pos):
+                best = cursor
+
+        if best is not None:
+            return best
+
+        if closed is not None:
+            return closed
+
+        if len(self.cursors) < self.limit:
+            cursor = copy.copy(self.reader)
+
+            # The copy must use the methods of its class and its own pipe
+            for name in ['get_frame', 'initialize', 'close', 'proc']:
+                cursor.__dict__.pop(name, None)
+
+            self.cursors.append(cursor)
+            return cursor
+
+        idle = [c for c in self.cursors
+                if id(c) not in self.busy and c is not spare]
+
+        if not idle:
+            return None
+
+        # Restart the cursor that has been idle the longest
+        return min(idle, key=lambda c: self.used.get(id(c), 0))
+
+    def _latest(self):
+        """ Return the cursor read last. """
+        return max(self.cursors, key=lambda c: self.used.get(id(c), 0))
+
+    def _use(self, cursor):
+        """ Record that a cursor is being read. """
+        self.clock += 1
+        self.used[id(cursor)] = self.clock
+
+    def _forward(self, pos, target):
+        """ Whether reading on from a frame is cheaper than seeking. """
+        if target <= pos:
+            return False
+
+        if target - pos <= SEEK_COST:
+            return True
+
+        if self.keyframes is None:
+            self.keyframes = self._load_keyframes()
+
+        if not self.keyframes:
+            return target - pos <= SKIP_LIMIT
+
+        # Seeking decodes from the last keyframe before the target
+        last = pos
+        for k in self.keyframes:
+            if k > target:
+                break
+
+            last = k
+
+        return last - pos <= SEEK_COST
+
+    def _load_keyframes(self):
+        """ Return the frame positions of the keyframes of the file. """
+        fps = self.reader.fps
+
+        try:
+            times = keyframes(self.reader.filename)
+
+        except IOError:
+            return []
+
+        return [int(round(t * fps)) + 1 for t in times]
+
+
+def read_ahead(function, *args):
+    """ Call a function that reads frames before they are needed.
+
+        Seekers do not move the cursor read last to serve the frames read
+        by the function, so reading ahead does not make playback seek.
+    """
+    _local.ahead = True
+
+    try:
+        return function(*args)
+
+    finally:
+        _local.ahead = False
+
+def initialize(reader, starttime=0):
+    """ Open the pipe of a reader so the next frame read is at a time.
+
+        reader    - FFMPEG_VideoReader to (re)open
+        starttime - time of the frame to start at, in seconds
+
+        FFMPEG seeks to the keyframe before the frame and decodes from
+        there, dropping the frames before it. The filters in the 'filters'
+        attribute of the reader, if any, are applied to the frames.
+    """
+    reader.__class__.close(reader)
+
+    cmd = [get_setting('FFMPEG_BINARY')]
+
+    if starttime > 0:
+        # Start half a frame early, so the frame showing at starttime is
+        # kept even if its timestamp is slightly before it
+        frame = int(reader.fps * starttime + 0.00001)
+        cmd += ['-ss', '%.06f' % max(0, (frame - 0.5) / reader.fps)]
+
+    cmd += ['-i', reader.filename, '-loglevel', 'error']
+
+    filters = getattr(reader, 'filters', None)
+    if filters:
+        cmd += ['-vf', ','.join(filters)]
+
+    cmd += ['-f', 'image2pipe', '-pix_fmt', reader.pix_fmt,
+            '-vcodec', 'rawvideo', '-']
+
+    reader.proc = subprocess.Popen(cmd, bufsize=reader.bufsize,
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE)
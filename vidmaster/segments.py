@@ -0,0 +1,329 @@
+# -*- coding: utf-8 -*-
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 Rafael Medina García
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+from vidmaster.cache import fingerprint
+from vidmaster.clip_builder import export_params
+from vidmaster.ffmpeg import concat_files
+from vidmaster.planner import Graph
+from vidmaster.probe import probe
+
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+# Segment boundaries are placed on multiples of this many seconds of frames
+# so that every segment starts on a regular keyframe interval
+KEYFRAME_INTERVAL = 2
+# Length in seconds of the segments of resumable exports
+CHECKPOINT_LENGTH = 30
+# Changing the layout of the checkpoints of resumable exports requires a new
+# version, so that older ones are discarded
+CHECKPOINT_VERSION = 1
+
+
+def export_segmented(workbench, node):
+    """ Export a clip rendering time segments in parallel.
+
+        workbench - workbench the export belongs to, it must have been
+            created from a script with start_workbench()
+        node      - index of the export operation in the workbench
+
+        Each segment is rendered by a separate process that rebuilds the
+        workbench from the script. The segments are then joined without
+        re-encoding and the audio, rendered once, is added as soundtrack.
+    """
+    op = workbench.ops[node]
+    clip = workbench.clips[op.clip]
+
+    if clip.duration is None:
+        raise Exception("Cannot split a clip without duration")
+
+    if not workbench.script:
+        raise Exception("Segmented exports require a script file")
+
+    tmpdir = tempfile.mkdtemp(prefix='.vidmaster-',
+            dir=os.path.dirname(os.path.abspath(op.out)))
+
+    try:
+        ext = os.path.splitext(op.out)[1]
+        jobs = []
+
+        for i, (start, end) in enumerate(split_timeline(
+                clip.duration, op.fps, op.segments)):
+            path = os.path.join(tmpdir, 'segment%05d%s' % (i, ext))
+            jobs.append((workbench.script, workbench.draft, node, start,
+                end, path))
+
+        pool = multiprocessing.Pool(
+                min(len(jobs), multiprocessing.cpu_count()))
+
+        try:
+            result = pool.map_async(_render_job, jobs)
+
+            # The audio is rendered meanwhile in this process
+            audio = None
+            if clip.audio is not None:
+                audio = write_audio(clip, op, tmpdir)
+
+            paths = result.get()
+
+        finally:
+            pool.close()
+            pool.join()
+
+        concat_files(paths, op.out, audio)
+
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+def export_resumable(workbench, node):
+    """ Export a clip through checkpoints that survive interruptions.
+
+        workbench - workbench the export belongs to
+        node      - index of the export operation in the workbench
+
+        The clip is rendered in segments of CHECKPOINT_LENGTH seconds,
+        kept with a manifest in a '.<name>.parts' directory next to the
+        output. If the export is interrupted, running it again with the
+        same clip and settings only renders the segments that are not
+        done (or fail validation). Segments are rendered in parallel
+        processes if the export sets several segments. They are finally
+        joined without re-encoding and the directory is removed.
+    """
+    op = workbench.ops[node]
+    clip = workbench.clips[op.clip]
+
+    if clip.duration is None:
+        raise Exception("Cannot split a clip without duration")
+
+    graph = Graph(workbench.ops)
+    key = fingerprint(graph, graph.inputs[node][0], {})
+    settings = [op.fps, op.codec, op.preset, op.params, op.width, op.height]
+
+    directory = os.path.join(os.path.dirname(os.path.abspath(op.out)),
+            '.%s.parts' % os.path.basename(op.out))
+
+    frames = int(clip.duration * op.fps)
+    count = max(1, -(-frames // int(CHECKPOINT_LENGTH * op.fps)))
+    bounds = split_timeline(clip.duration, op.fps, count)
+
+    manifest = {'version': CHECKPOINT_VERSION, 'key': key,
+            'settings': settings, 'bounds': bounds, 'done': {}}
+    done = _load_checkpoints(directory, manifest)
+    manifest['done'] = done
+
+    ext = os.path.splitext(op.out)[1]
+    names = ['segment%05d%s' % (i, ext) for i in range(len(bounds))]
+    pending = [i for i, name in enumerate(names) if name not in done]
+
+    def finish(name):
+        # Only complete files get their final name and enter the manifest
+        path = os.path.join(directory, name)
+        os.rename(_partial(path), path)
+
+        done[name] = os.path.getsize(path)
+        _save_checkpoints(directory, manifest)
+
+    if pending and op.segments > 1 and workbench.script:
+        jobs = [(workbench.script, workbench.draft, node, bounds[i][0],
+            bounds[i][1], _partial(os.path.join(directory, names[i])))
+            for i in pending]
+
+        pool = multiprocessing.Pool(
+                min(op.segments, len(jobs), multiprocessing.cpu_count()))
+
+        try:
+            for path in pool.imap_unordered(_render_job, jobs):
+                finish(os.path.basename(path)[:-len('.part' + ext)] + ext)
+
+        finally:
+            pool.close()
+            pool.join()
+
+    else:
+        for i in pending:
+            render_segment(clip, op, bounds[i][0], bounds[i][1],
+                    _partial(os.path.join(directory, names[i])))
+            finish(names[i])
+
+    audio = None
+    if clip.audio is not None:
+        audio = [name for name in done if name.startswith('audio')]
+        audio = os.path.join(directory, audio[0]) if audio else None
+
+        if audio is None:
+            path = write_audio(clip, op, directory)
+            name = os.path.basename(path)
+
+            done[name] = os.path.getsize(path)
+            _save_checkpoints(directory, manifest)
+
+            audio = path
+
+    concat_files([os.path.join(directory, name) for name in names],
+            op.out, audio)
+
+    shutil.rmtree(directory, ignore_errors=True)
+
+def render_segment(clip, op, start, end, path):
+    """ Render the video of a time segment of a clip to a file.
+
+        clip  - clip to render
+        op    - export operation with the encoding parameters
+        start - start of the segment in seconds
+        end   - end of the segment in seconds
+        path  - absolute path to the resulting file
+    """
+    clip.subclip(start, end).write_videofile(
+            path,
+            fps=op.fps,
+            codec=op.codec,
+            preset=op.preset,
+            audio=False,
+            threads=op.threads,
+            ffmpeg_params=export_params(op, clip.size),
+            verbose=False)
+
+def split_timeline(duration, fps, count):
+    """ Split a duration into at most count consecutive time segments.
+
+        Boundaries are aligned to frames and, when possible, to the
+        keyframe interval. Returns a list of (start, end) tuples.
+    """
+    frames = int(duration * fps)
+    align = int(KEYFRAME_INTERVAL * fps)
+
+    # Frames per segment, rounded up to the keyframe interval
+    step = max(1, -(-frames // count))
+    if step > align:
+        step = -(-step // align) * align
+
+    bounds = list(range(0, frames, step)) + [frames]
+
+    return [(float(a) / fps, float(b) / fps)
+            for a, b in zip(bounds[:-1], bounds[1:])]
+
+def write_audio(clip, op, directory):
+    """ Render the audio of a clip to a temporary file.
+
+        Uses the same audio codec write_videofile() would choose for the
+        output file. Returns the path to the file.
+    """
+    if os.path.splitext(op.out)[1].lower() in ['.ogv', '.webm']:
+        codec, ext = 'libvorbis', '.ogg'
+
+    else:
+        codec, ext = 'libmp3lame', '.mp3'
+
+    path = os.path.join(directory, 'audio' + ext)
+    clip.audio.write_audiofile(path, codec=codec, verbose=False)
+
+    return path
+
+def _load_checkpoints(directory, manifest):
+    """ Return the valid files in a checkpoint directory.
+
+        directory - directory of the checkpoints, created if missing
+        manifest  - expected manifest, without the done files
+
+        Returns a dict with the size of each file by name. Checkpoints of
+        a different clip, settings or version are removed, as well as the
+        files that are incomplete or do not match the manifest.
+    """
+    path = os.path.join(directory, 'manifest.json')
+    saved = None
+
+    if os.path.isfile(path):
+        try:
+            with open(path, 'r') as f:
+                saved = json.load(f)
+
+        except ValueError:
+            pass
+
+    expected = dict(manifest, done=None)
+
+    if saved is None or dict(saved, done=None) != json.loads(
+            json.dumps(expected)):
+        shutil.rmtree(directory, ignore_errors=True)
+
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+        return {}
+
+    done = {}
+    bounds = manifest['bounds']
+
+    for name, size in saved['done'].items():
+        path = os.path.join(directory, name)
+
+        if not os.path.isfile(path) or os.path.getsize(path) != size:
+            continue
+
+        # The duration of a segment must match its bounds
+        if name.startswith('segment'):
+            start, end = bounds[int(name[7:12])]
+            duration = probe(path)['duration']
+
+            if duration is None or abs(duration - (end - start)) > 0.5:
+                continue
+
+        done[name] = size
+
+    return done
+
+def _partial(path):
+    """ Return the path a file is written to before being complete. """
+    name, ext = os.path.splitext(path)
+
+    return name + '.part' + ext
+
+def _save_checkpoints(directory, manifest):
+    """ Atomically write the manifest of a checkpoint directory. """
+    path = os.path.join(directory, 'manifest.json')
+    tmp = path + '.%d' % os.getpid()
+
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f)
+
+    os.rename(tmp, path)
+
+def _render_job(job):
+    """ Rebuild the workbench from the script and render a segment.
+
+        Runs in a worker process.
+    """
+    # Imported here to avoid a circular import
+    from vidmaster.workbench import start_workbench
+
+    script, draft, node, start, end, path = job
+
+    workbench = start_workbench(script, draft)
+    workbench.prepare(node)
+
+    op = workbench.ops[node]
+    render_segment(workbench.clips[op.clip], op, start, end, path)
+
+    return path
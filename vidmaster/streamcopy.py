@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 Rafael Medina García
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+from vidmaster.ffmpeg import concat_files, run_ffmpeg
+from vidmaster.parser import OpDefine, OpMix, OpSubclip, get_seconds
+from vidmaster.probe import keyframes, probe
+
+import bisect
+import os
+import shutil
+import tempfile
+
+# Name FFMPEG reports for the streams produced by each encoder
+CODECS = {
+    'libx264': 'h264',
+    'libx265': 'hevc',
+    'libvpx': 'vp8',
+    'libtheora': 'theora',
+    'libxvid': 'mpeg4',
+    'mpeg4': 'mpeg4',
+}
+
+
+def copy_export(pieces, op):
+    """ Export a list of source pieces without re-encoding them.
+
+        pieces - list of (source, start, end, hasaudio) tuples
+        op     - export operation
+
+        Every piece must start on a keyframe of its source, as stream
+        copies cannot start on an arbitrary frame. Pieces that end between
+        keyframes may not be copied exactly either, when their frames are
+        stored out of order.
+
+        Returns False, without an output, if a piece was not copied
+        exactly, in which case the export has to be rendered instead.
+    """
+    if len(pieces) == 1:
+        if cut_piece(pieces[0], op.out, op.fps):
+            return True
+
+        os.remove(op.out)
+        return False
+
+    tmpdir = tempfile.mkdtemp(prefix='.vidmaster-',
+            dir=os.path.dirname(os.path.abspath(op.out)))
+
+    try:
+        ext = os.path.splitext(op.out)[1]
+        paths = []
+
+        for i, piece in enumerate(pieces):
+            path = os.path.join(tmpdir, 'piece%05d%s' % (i, ext))
+
+            if not cut_piece(piece, path, op.fps):
+                return False
+
+            paths.append(path)
+
+        concat_files(paths, op.out)
+        return True
+
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+def cut_piece(piece, path, fps):
+    """ Copy a time range of a source file to a new file.
+
+        piece - (source, start, end, hasaudio) tuple
+        path  - absolute path to the resulting file
+        fps   - frame rate of the source
+
+        Returns whether the copy holds exactly the frames of the range.
+    """
+    source, start, end, hasaudio = piece
+    frames = int(round((end - start) * fps))
+
+    args = ['-ss', '%.3f' % start, '-i', source,
+            '-t', '%.3f' % (end - start), '-frames:v', str(frames),
+            '-map', '0:v:0']
+
+    if hasaudio:
+        args += ['-map', '0:a:0']
+
+    args += ['-c', 'copy', '-avoid_negative_ts', 'make_zero', path]
+
+    run_ffmpeg(args)
+
+    return _consecutive(path, frames, fps)
+
+def find_pieces(graph, node):
+    """ Find the source pieces an export can be copied from.
+
+        graph - dependency graph of the workbench operations
+        node  - index of the export operation
+
+        Returns a list of (source, start, end, hasaudio) tuples, or None if
+        the exported clip requires decoding the frames: effects,
+        compositions, images, audio replacement or differences in the
+        encoding of the sources or the export.
+    """
+    op = graph.ops[node]
+
+    if not op.streamcopy or op.params or op.codec not in CODECS:
+        return None
+
+    if op.width or op.height:
+        return None
+
+    if not graph.inputs[node]:
+        return None
+
+    infos = {}
+    pieces = _pieces(graph, graph.inputs[node][0], infos)
+
+    if not pieces:
+        return None
+
+    # Every piece must share the encoding the export asks for
+    video = set((i['video_codec'], i['pix_fmt'], i['width'], i['height'],
+        i['fps']) for i in infos.values())
+    audio = set(p[3] for p in pieces)
+
+    if len(video) != 1 or len(audio) != 1:
+        return None
+
+    codec, _, _, _, fps = video.pop()
+
+    if codec != CODECS[op.codec] or fps is None or abs(fps - op.fps) > 0.01:
+        return None
+
+    if audio.pop():
+        streams = set((i['audio_codec'], i['audio_rate'],
+            i['audio_channels']) for i in infos.values())
+
+        if len(streams) != 1 or None in streams.pop():
+            return None
+
+    # Cuts must start on a keyframe to be frame accurate, each source is
+    # scanned once however many pieces it has
+    result = []
+    times = {}
+    for source, start, end, hasaudio in pieces:
+        if start > 0:
+            if source not in times:
+                times[source] = keyframes(source)
+
+            start = _snap(times[source], start, 1.0 / fps)
+
+            if start is None:
+                return None
+
+        result.append((source, start, end, hasaudio))
+
+    return result
+
+def _consecutive(path, frames, fps):
+    """ Check that the video of a file is a run of consecutive frames.
+
+        The timestamps of the packets are compared, without decoding them.
+        Copies that end between keyframes keep the packets stored before
+        the end, which may include frames after it and leave out frames
+        before it.
+    """
+    out = run_ffmpeg(['-i', path, '-map', '0:v:0', '-c', 'copy',
+        '-f', 'framecrc', '-'])
+
+    step = None
+    times = []
+
+    for line in out.decode('utf-8', 'replace').splitlines():
+        if line.startswith('#tb 0:'):
+            num, den = line.split(':', 1)[1].strip().split('/')
+            # Time base units per frame
+            step = float(den) / float(num) / fps
+
+        elif line and not line.startswith('#'):
+            times.append(int(line.split(',')[2]))
+
+    if step is None or len(times) != frames:
+        return False
+
+    times.sort()
+
+    return all(abs(t - times[0] - i * step) < step / 2
+            for i, t in enumerate(times))
+
+def _cut(pieces, start, end):
+    """ Return the part of a list of pieces between two timestamps. """
+    result = []
+    offset = 0.0
+
+    for source, s, e, hasaudio in pieces:
+        length = e - s
+
+        a = max(start, offset)
+        b = length + offset if end is None else min(end, length + offset)
+
+        if a < b:
+            result.append((source, s + a - offset, s + b - offset, hasaudio))
+
+        offset += length
+
+    return result
+
+def _snap(times, t, tolerance):
+    """ Return the timestamp closest to t within a tolerance, or None. """
+    i = bisect.bisect_left(times, t)
+
+    near = [times[j] for j in (i - 1, i) if 0 <= j < len(times)]
+    near = [n for n in near if abs(n - t) < tolerance]
+
+    return min(near, key=lambda n: abs(n - t)) if near else None
+
+def _pieces(graph, node, infos):
+    """ Recursively obtain the source pieces of a clip, or None. """
+    op = graph.ops[node]
+
+    if type(op) == OpDefine:
+        if op.type != 'video':
+            return None
+
+        if op.source not in infos:
+            infos[op.source] = probe(op.source)
+
+        if infos[op.source]['duration'] is None:
+            return None
+
+        return [(op.source, 0.0, infos[op.source]['duration'], op.hasaudio)]
+
+    elif type(op) == OpSubclip and graph.inputs[node]:
+        pieces = _pieces(graph, graph.inputs[node][0], infos)
+
+        if pieces is None:
+            return None
+
+        end = get_seconds(op.end) if op.end else None
+
+        return _cut(pieces, get_seconds(op.start), end)
+
+    elif type(op) == OpMix and op.type in ['concatenate', 'concatenation']:
+        result = []
+
+        for child in graph.inputs[node]:
+            pieces = _pieces(graph, child, infos)
+
+            if pieces is None:
+                return None
+
+            result.extend(pieces)
+
+        return result
+
+    return None
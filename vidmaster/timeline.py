@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 Rafael Medina García
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+from moviepy.audio.AudioClip import CompositeAudioClip
+from moviepy.video.VideoClip import ColorClip, VideoClip
+from moviepy.video.io.VideoFileClip import VideoFileClip
+from vidmaster.seeking import Seeker, read_ahead
+
+import bisect
+import math
+import multiprocessing
+import threading
+
+# Seconds before a cut at which the next clip starts being prepared
+PREFETCH_TIME = 1.0
+
+
+class Timeline(object):
+    """ Index of the clips played one after another by a concatenation.
+
+        Clips that are concatenations themselves are replaced by their
+        own clips, so a single index covers every level. The clip playing
+        at a given time is found by bisection, instead of scanning every
+        start time as MoviePy does.
+
+        When a frame gets close to the start of a clip read straight from
+        a video source, its first frame is requested in a thread, so the
+        source is already positioned (or open) at the cut. With a single
+        CPU this would only take time from playback, so it is not done.
+    """
+
+    def __init__(self, clips, fps=None):
+        """ Build the index.
+
+            clips - ordered list of clips, they must have a duration
+            fps   - frame rate the concatenation is played at, if known
+        """
+        self.clips = []
+
+        for clip in clips:
+            self.clips.extend(flatten(clip))
+
+        self.starts = [0.0]
+        for clip in self.clips:
+            self.starts.append(self.starts[-1] + clip.duration)
+
+        self.duration = self.starts.pop()
+        self.fps = fps
+
+        # Clip and audio the concatenation was made with, see flatten()
+        self.mask = None
+        self.audio = None
+
+        self.prefetched = set()
+        self.time = 0
+        self.ahead = PREFETCH_TIME if multiprocessing.cpu_count() > 1 else -1
+
+    def find(self, t):
+        """ Return the index of the clip playing at time t. """
+        i = bisect.bisect_right(self.starts, t) - 1
+
+        return min(max(i, 0), len(self.clips) - 1)
+
+    def make_frame(self, t):
+        """ Return the frame of the concatenation at time t. """
+        i = self.find(t)
+        following = i + 1
+
+        if t < self.time:
+            # Played again, as when exporting it twice
+            self.prefetched.clear()
+
+        self.time = t
+
+        if (following < len(self.clips) and following not in self.prefetched
+                and self.starts[following] - t <= self.ahead):
+            self.prefetched.add(following)
+            self._prefetch(following)
+
+        return self.clips[i].get_frame(t - self.starts[i])
+
+    def _prefetch(self, i):
+        """ Request the first frame of a clip in a thread.
+
+            Only clips that read a video source served by a Seeker are
+            prefetched, as the rest may not support several threads.
+        """
+        clip = self.clips[i]
+
+        if not isinstance(clip, VideoFileClip):
+            return
+
+        served = getattr(clip.reader.__dict__.get('get_frame'), '__self__',
+                None)
+
+        if not isinstance(served, Seeker):
+            return
+
+        # Time of the first frame played from the clip
+        t = 0.0
+        if self.fps:
+            t = max(0.0, math.ceil(self.starts[i] * self.fps - 1e-6)
+                    / self.fps - self.starts[i])
+
+        thread = threading.Thread(target=_warm, args=(clip, t))
+        thread.daemon = True
+        thread.start()
+
+
+def concatenate(clips):
+    """ Concatenate clips one after another, as MoviePy's 'chain' method.
+
+        clips - ordered list of clips, they must have a duration
+
+        The result has a mask if any of the clips has one, plays the
+        audio of the clips that have it and has the highest frame rate of
+        the clips.
+    """
+    fps = [c.fps for c in clips if getattr(c, 'fps', None)]
+    fps = max(fps) if fps else None
+
+    timeline = Timeline(clips, fps)
+    flat = timeline.clips
+
+    result = VideoClip(make_frame=timeline.make_frame)
+    result.timeline = timeline
+
+    if any(c.mask is not None for c in flat):
+        masks = [c.mask if c.mask is not None
+                else ColorClip(c.size, col=1, ismask=True,
+                    duration=c.duration) for c in flat]
+
+        masks = Timeline(masks)
+
+        result.mask = VideoClip(ismask=True, make_frame=masks.make_frame)
+        result.mask.timeline = masks
+        result.mask.duration = masks.duration
+
+    timeline.mask = result.mask
+
+    # Same attributes MoviePy sets
+    starts = timeline.starts + [timeline.duration]
+    result.tt = starts
+    result.start_times = timeline.starts
+    result.clips = flat
+    result.start, result.duration, result.end = (0, timeline.duration,
+            timeline.duration)
+
+    audio = [c.audio.set_start(t) for c, t in zip(flat, timeline.starts)
+            if c.audio is not None]
+
+    if audio:
+        result.audio = CompositeAudioClip(audio)
+
+    timeline.audio = result.audio
+
+    if fps:
+        result.fps = fps
+
+    return result
+
+def flatten(clip):
+    """ Return the clips a clip plays one after another.
+
+        A concatenation made by concatenate() is replaced by its clips, as
+        long as it has not been changed since (effects, masks, audio...).
+        Any other clip is returned alone.
+    """
+    timeline = getattr(clip, 'timeline', None)
+
+    if (timeline is None or clip.make_frame != timeline.make_frame
+            or clip.mask is not timeline.mask
+            or clip.audio is not timeline.audio
+            or clip.duration != timeline.duration):
+        return [clip]
+
+    return list(timeline.clips)
+
+def _warm(clip, t):
+    """ Read a frame of a clip ahead, leaving errors to the actual read. """
+    try:
+        read_ahead(clip.get_frame, t)
+
+    except Exception:
+        pass
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+# The MIT License (MIT)
+#
+# Copyright (c) 2015 Rafael Medina García
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+from vidmaster.cache import fingerprint
+from vidmaster.clip_builder import close_clip
+from vidmaster.parser import OpDefine, OpExport
+from vidmaster.planner import Graph, describe
+from vidmaster.workbench import start_workbench
+
+import os
+import time
+
+# Seconds between two checks of the files
+POLL_INTERVAL = 0.5
+
+
+class Watcher(object):
+    """ Rebuilds a script incrementally as it and its sources change.
+
+        Every clip stays open between builds, along with its readers and
+        the decoded images, keyed by its cache fingerprint. When the
+        script is parsed again, operations whose fingerprint was already
+        built (same parameters, inputs and source files) take their
+        previous result, so only the clips downstream of a change, and the
+        exports that use them, are computed again.
+    """
+
+    def __init__(self, script, draft=None, cache=None, backend='moviepy'):
+        """ Create a watcher.
+
+            script  - path to the script file
+            draft   - optional scale factor to render low resolution
+                previews instead (see vidmaster.draft.apply_draft())
+            cache   - optional ClipCache for the intermediate clips
+            backend - library used to render the exports
+        """
+        self.script = script
+        self.draft = draft
+        self.cache = cache
+        self.backend = backend
+
+        # (clip, closable) tuples by fingerprint, clip is None for exports
+        self.results = {}
+        # Operations of the last build and modification times of the files
+        self.ops = []
+        self.stamps = {}
+
+    def build(self):
+        """ Parse the script and build what changed since the last build.
+
+            Prints and returns the list of operations that were
+            invalidated (the ones performed again).
+        """
+        workbench = start_workbench(self.script, self.draft)
+        workbench.cache = self.cache
+        workbench.backend = self.backend
+        workbench.keep = True
+
+        graph = Graph(workbench.ops)
+        keys = _fingerprints(graph)
+
+        for node, key in keys.items():
+            if key not in self.results:
+                continue
+
+            op = workbench.ops[node]
+
+            # Exports are written again if their file went missing
+            if type(op) == OpExport and not os.path.isfile(op.out):
+                continue
+
+            workbench.reuse[node] = self.results[key][0]
+
+        roots = [n for n in graph.exports() if n not in workbench.reuse]
+        invalid = [workbench.ops[n] for n in graph.prune(roots,
+            set(workbench.reuse)) if n not in workbench.reuse]
+
+        for op in invalid:
+            print("invalidated %5d  %s" % (op.lineno, describe(op)))
+
+        self.ops = workbench.ops
+        self.stamps = self._stamps()
+        workbench.build()
+
+        results = {}
+        for node in workbench.reuse:
+            results[keys[node]] = self.results[keys[node]]
+
+        for node, clip in workbench.live.items():
+            if keys.get(node) is None:
+                continue
+
+            op = workbench.ops[node]
+            closable = type(op) == OpDefine or node in workbench.owned
+
+            results[keys[node]] = self.results.get(keys[node],
+                    (clip, closable))
+
+        for node in graph.exports():
+            if keys.get(node) is not None and os.path.isfile(
+                    workbench.ops[node].out):
+                results[keys[node]] = (None, False)
+
+        # Close the files of the clips that are not used anymore
+        for key, (clip, closable) in self.results.items():
+            if key not in results and closable:
+                close_clip(clip)
+
+        self.results = results
+
+        return invalid
+
+    def changed(self):
+        """ Check whether the script or a source changed since the build. """
+        return self._stamps() != self.stamps
+
+    def watch(self, interval=POLL_INTERVAL):
+        """ Build the script and rebuild it whenever it changes.
+
+            interval - seconds between two checks of the files
+
+            Runs until interrupted. Errors are printed and the previous
+            results are kept until the next change.
+        """
+        while True:
+            start = time.time()
+
+            try:
+                invalid = self.build()
+
+            except Exception as e:
+                print("Error: %s" % e)
+
+                # Wait for the next change
+                self.stamps = self._stamps()
+
+            else:
+                print("Built %d operations in %.2fs, watching for changes"
+                        % (len(invalid), time.time() - start))
+
+            while not self.changed():
+                time.sleep(interval)
+
+    def _stamps(self):
+        """ Return the modification times of the script and its sources. """
+        paths = [self.script]
+        paths += [op.source for op in self.ops if type(op) == OpDefine]
+
+        stamps = {}
+        for path in paths:
+            try:
+                st = os.stat(path)
+                stamps[path] = (st.st_size, st.st_mtime)
+
+            except OSError:
+                stamps[path] = None
+
+        return stamps
+
+
+def _fingerprints(graph):
+    """ Return the fingerprint of every operation, None if unavailable. """
+    memo = {}
+    keys = {}
+
+    for node in range(len(graph.ops)):
+        try:
+            keys[node] = fingerprint(graph, node, memo)
+
+        except OSError:
+            # Missing source file
+            keys[node] = None
+            continue
+
+        # Fingerprints leave names out, but exports are files
+        op = graph.ops[node]
+        if type(op) == OpExport:
+            keys[node] += ':' + os.path.abspath(op.out)
+
+    return keys
@@ -21,130 +21,375 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import copy
 import os
+from vidmaster.cache import can_store, fingerprint, is_expensive
 from vidmaster.clip_builder import define_audio, define_image, define_video
 from vidmaster.clip_builder import do_concatenate, do_composite, do_subclip, do_set_audio
 from vidmaster.clip_builder import effect_margin, effect_position, effect_resize
-from vidmaster.clip_builder import export_video
+from vidmaster.clip_builder import close_clip, export_video, find_readers
+from vidmaster.compiler import render
+from vidmaster.draft import apply_draft, draft_path
 from vidmaster.parser import OpDefine, OpEffect, OpMix, OpSubclip, OpExport
-from vidmaster.parser import parse_block
+from vidmaster.parser import load_script
+from vidmaster.pipeline import export_pipelined, export_renditions
+from vidmaster.planner import Graph, infer, op_output
+from vidmaster.probe import probe
+from vidmaster.segments import export_resumable, export_segmented
+from vidmaster.streamcopy import copy_export, find_pieces
 
 
 class Workbench(object):
 
-    def __init__(self, ops=[], clips={}):
-        self.ops = ops
-        self.clips = clips
+    def __init__(self, ops=None, clips=None):
+        self.ops = ops if ops is not None else []
+        self.clips = clips if clips is not None else {}
+        # Clips produced by the operations performed and still needed, by
+        # node (names in self.clips may have been overwritten)
+        self.live = {}
         self.final = None
+        self.script = None
+        self.cache = None
+        self.backend = 'moviepy'
+        self.draft = None
+        self.profiler = None
+        # Exports written together, see Graph.renditions()
+        self.renditions = {}
+        # Results kept from a previous build, by node: the clip of each
+        # operation, or None for exports already written
+        self.reuse = {}
+        # Whether to keep every clip open after the build, for later builds
+        self.keep = False
+        # Nodes whose clips were read from the cache (or stored in it)
+        self.owned = set()
+
+    def build(self, exports=None):
+        """ Perform the operations stored and build the final video.
+
+            exports - optional nodes of the exports to perform, defaults
+                to every export of the script
+
+            Operations that do not contribute to any export are skipped.
+            Exports that only cut and concatenate compatible videos are
+            copied directly from the sources. With the 'ffmpeg' backend,
+            the rest of exports are rendered by a single FFMPEG process.
+            Otherwise, renditions of the same clip are written at once.
+
+            Clips are released as soon as the last operation that needs
+            them is performed, closing the files they read from, unless
+            they must be kept. Results in self.reuse are not computed
+            again.
+
+            If a profiler is set, the time of each operation and frame is
+            recorded and a summary printed at the end.
+        """
+        graph = Graph(self.ops)
+        roots = []
+
+        for node in graph.exports():
+            if node in self.reuse or (exports is not None
+                    and node not in exports):
+                continue
+
+            pieces = find_pieces(graph, node)
+
+            if pieces and copy_export(pieces, self.ops[node]):
+                continue
+
+            # Rendered when the cuts cannot be copied exactly as well
+            if self.backend == 'ffmpeg':
+                render(graph, node)
 
-    def build(self):
-        """ Perform the operations stored and build the final video. """
-        for op in self.ops:
+            else:
+                roots.append(node)
 
-            if type(op) == OpDefine:
+        # Parsed operations are left untouched, for later builds
+        graph = Graph(self.resolve_durations(graph, roots))
 
-                if op.type == 'audio':
-                    self.clips[op.name] = define_audio(op)
+        keys = {}
+        # Clips read from the cache by node, opened right away as other
+        # processes sharing the cache may evict them meanwhile
+        hits = {}
 
-                elif op.type == 'image':
-                    if op.duration:
-                        self.clips[op.name] = define_image(op)
+        if self.cache:
+            memo = {}
 
-                    else:
-                        self.clips[op.name] = define_image(op,
-                                self.clips[op.duration_from])
+            for node in graph.prune(roots):
+                if is_expensive(graph.ops[node]):
+                    keys[node] = fingerprint(graph, node, memo)
 
-                elif op.type == 'video':
-                    self.clips[op.name] = define_video(op)
+                    if node not in self.reuse:
+                        clip = self.cache.get(keys[node])
 
-                else:
-                    raise Exception("Unknown definition type")
+                        if clip is not None:
+                            hits[node] = clip
 
-            elif type(op) == OpEffect:
+        nodes = graph.prune(roots, set(hits) | set(self.reuse))
 
-                if op.type == 'margin':
-                    self.clips[op.out] = effect_margin(
-                            self.clips[op.clip], op)
+        # Hits only needed by other hits
+        for node in set(hits) - set(nodes):
+            close_clip(hits.pop(node))
 
-                elif op.type == 'position':
-                    self.clips[op.out] = effect_position(
-                            self.clips[op.clip], op)
+        self.owned = set(hits)
+        self.renditions = graph.renditions(nodes)
 
-                elif op.type == 'resize':
-                    self.clips[op.out] = effect_resize(
-                            self.clips[op.clip], op)
+        # Nodes whose clips can be released after each node
+        releases = {}
+        for done, node in graph.last_uses(nodes).items():
+            releases.setdefault(node, []).append(done)
 
-                else:
-                    raise Exception("Unknown effect type")
+        for node in nodes:
+            op = graph.ops[node]
+
+            if self.profiler:
+                self.profiler.begin(node, op)
+
+            if node in self.reuse:
+                self.clips[op_output(op)] = self.reuse[node]
+
+            elif node in hits:
+                self.clips[op.out] = hits[node]
+
+            else:
+                self.run(op)
+
+                if node in keys and self._store(graph, node):
+                    self.clips[op.out] = self.cache.put(keys[node],
+                            self.clips[op.out])
+                    # Read back from the cache file, which is not closed
+                    # with the sources
+                    self.owned.add(node)
+
+            self.live[node] = self.clips.get(op_output(op))
+
+            if self.profiler:
+                self.profiler.end(self.live[node])
+
+            if self.keep:
+                continue
+
+            for done in releases.get(node, []):
+                self.release(done, done in self.owned)
+
+        if self.profiler:
+            print(self.profiler.summary())
+
+    def resolve_durations(self, graph, roots):
+        """ Give images the duration of their duration_from clips.
+
+            graph - dependency graph of the operations
+            roots - nodes that are going to be performed
+
+            The durations are inferred from the metadata of the sources,
+            so the clips do not have to be opened just for this (and may
+            not be needed at all). Only the images needed by the roots are
+            resolved. Returns the list of operations with copies of the
+            resolved images, the rest are the same objects. Images whose
+            duration cannot be inferred keep reading it from the clip.
+        """
+        ops = list(self.ops)
 
-            elif type(op) == OpMix:
+        for node in graph.prune(roots):
+            op = ops[node]
 
-                affected = []
-                for c in op.clips:
-                    affected.append(self.clips[c])
+            if (type(op) != OpDefine or op.type != 'image' or op.duration
+                    or not graph.inputs[node]):
+                continue
 
-                if op.type == 'setaudio':
-                    self.clips[op.out] = do_set_audio(
-                            self.clips[op.clip],
-                            self.clips[op.audio])
+            source = graph.inputs[node][0]
 
-                elif op.type == 'concatenation':
-                    self.clips[op.out] = do_concatenate(affected)
+            try:
+                meta = infer(graph, graph.prune([source]), probe)
 
-                elif op.type == 'composition':
-                    self.clips[op.out] = do_composite(affected,
-                            op.height, op.width)
+            except Exception:
+                # Left to MoviePy, which reports errors better
+                continue
+
+            if meta[source]['duration'] is not None:
+                ops[node] = copy.copy(op)
+                ops[node].duration = meta[source]['duration']
+
+        return ops
+
+    def plan(self):
+        """ Return the operations that build() will perform, in order.
+
+            No media is accessed, so this can be used to inspect a script
+            before rendering it.
+        """
+        graph = Graph(self.ops)
+
+        return [self.ops[i] for i in graph.prune()]
+
+    def prepare(self, node):
+        """ Perform the operations needed by another operation.
+
+            node - index of the operation in the list, it is not performed
+        """
+        graph = Graph(self.ops)
+
+        for i in graph.prune([node]):
+            if i != node:
+                self.run(self.ops[i])
+                self.live[i] = self.clips.get(op_output(self.ops[i]))
+
+    def run(self, op):
+        """ Perform a single operation. """
+        if type(op) == OpDefine:
+
+            if op.type == 'audio':
+                self.clips[op.name] = define_audio(op)
+
+            elif op.type == 'image':
+                if op.duration:
+                    self.clips[op.name] = define_image(op)
 
                 else:
-                    raise Exception("Unknown mix type")
+                    self.clips[op.name] = define_image(op,
+                            self.clips[op.duration_from])
 
-            elif type(op) == OpExport:
-                export_video(self.clips[op.clip], op)
+            elif op.type == 'video':
+                self.clips[op.name] = define_video(op)
+
+            else:
+                raise Exception("Unknown definition type")
+
+        elif type(op) == OpEffect:
+
+            if op.type == 'margin':
+                self.clips[op.out] = effect_margin(
+                        self.clips[op.clip], op)
+
+            elif op.type == 'position':
+                self.clips[op.out] = effect_position(
+                        self.clips[op.clip], op)
 
-            elif type(op) == OpSubclip:
-                self.clips[op.out] = do_subclip(self.clips[op.clip], op)
+            elif op.type == 'resize':
+                self.clips[op.out] = effect_resize(
+                        self.clips[op.clip], op)
 
             else:
-                raise Exception("Unknown operation type")
+                raise Exception("Unknown effect type")
 
+        elif type(op) == OpMix:
 
-def start_workbench(script):
-    """ Initialize the workbench parsing the script file.
+            affected = []
+            for c in op.clips:
+                affected.append(self.clips[c])
 
-        This will return a Workbench object that includes all the
-        operations to apply.
-    """
-    if not os.path.isfile(script):
-        raise Exception("Cannot access script")
+            if op.type == 'setaudio':
+                self.clips[op.out] = do_set_audio(
+                        self.clips[op.clip],
+                        self.clips[op.audio])
+
+            elif op.type in ['concatenate', 'concatenation']:
+                self.clips[op.out] = do_concatenate(affected)
+
+            elif op.type == 'composition':
+                self.clips[op.out] = do_composite(affected,
+                        op.height, op.width)
+
+            else:
+                raise Exception("Unknown mix type")
+
+        elif type(op) == OpExport:
+            node = self.ops.index(op)
+            group = self.renditions.get(node, [node])
+
+            if not group:
+                # Written along with the first rendition of the clip
+                pass
+
+            elif op.resumable:
+                export_resumable(self, node)
+
+            elif op.segments > 1:
+                export_segmented(self, node)
+
+            elif len(group) > 1 or op.width or op.height:
+                export_renditions(self.clips[op.clip],
+                        [self.ops[n] for n in group],
+                        find_readers(self.live.values()))
+
+            elif op.engine == 'pipeline':
+                export_pipelined(self.clips[op.clip], op,
+                        find_readers(self.live.values()))
+
+            else:
+                export_video(self.clips[op.clip], op)
+
+        elif type(op) == OpSubclip:
+            self.clips[op.out] = do_subclip(self.clips[op.clip], op)
+
+        else:
+            raise Exception("Unknown operation type")
+
+    def release(self, node, owned=False):
+        """ Forget the clip produced by an operation.
+
+            node  - index of the operation
+            owned - whether the clip was read from a file other than its
+                source (as the ones from the cache are)
+
+            The files of definitions are closed. Other clips share the
+            readers of the clips they are made from, so they are just
+            dropped.
+        """
+        clip = self.live.pop(node, None)
+        op = self.ops[node]
+        name = op_output(op)
+
+        if clip is None:
+            return
+
+        if name and self.clips.get(name) is clip:
+            del self.clips[name]
 
-    wb = Workbench()
+        if type(op) == OpDefine or owned:
+            close_clip(clip)
 
-    # Parse the script
-    with open(script, 'r') as f:
-        file_lines = f.read().splitlines()
+    def _store(self, graph, node):
+        """ Check whether the result of an operation should be cached.
 
-    while file_lines:
-        line = file_lines.pop(0)
+            Only results that can be stored losslessly and fit in the cache
+            are cached, and only if they are not immediately fed to other
+            cached operations.
+        """
+        clip = self.clips[self.ops[node].out]
 
-        # Check if block
-        if line.startswith('#do'):
-            block = []
-            block.append(line)
+        if not can_store(clip) or not self.cache.fits(clip):
+            return False
 
-            # Read all the block
-            while not line.startswith('#end') and file_lines:
-                line = file_lines.pop(0)
+        return not all(is_expensive(self.ops[i])
+                for i in graph.consumers[node])
 
-                if not line or line.startswith('//'):
-                    continue
 
-                block.append(line)
+def start_workbench(script, draft=None, op_cache=False):
+    """ Initialize the workbench parsing the script file.
+
+        script   - path to the script file
+        draft    - optional scale factor to render a low resolution preview
+            instead (see vidmaster.draft.apply_draft())
+        op_cache - whether to reuse the operations compiled by a previous
+            run if the script did not change
+
+        This will return a Workbench object that includes all the
+        operations to apply.
+    """
+    if not os.path.isfile(script):
+        raise Exception("Cannot access script")
 
-            parsed = parse_block(block)
+    wb = Workbench([], {})
+    wb.script = os.path.abspath(script)
+    wb.ops = load_script(wb.script, op_cache)
 
-            if type(parsed) == OpExport:
-                wb.final = parsed.out
+    for op in wb.ops:
+        if type(op) == OpExport:
+            wb.final = op.out
 
-            wb.ops.append(parsed)
+    if draft:
+        apply_draft(wb.ops, draft)
+        wb.final = draft_path(wb.final) if wb.final else None
+        wb.draft = draft
 
     return wb